@@ -0,0 +1,576 @@
+"""
+async_gmail.py
+
+Native asyncio client for the Gmail and Calendar REST APIs.
+
+All requests go through one pooled `httpx.AsyncClient` per event loop, so
+connections are kept alive between calls and no discovery documents are built.
+Graph nodes and the cron job can await Google I/O directly instead of hopping
+to a thread for every blocking `googleapiclient` call.
+"""
+import asyncio
+import logging
+import os
+import weakref
+from datetime import datetime
+from typing import Any, AsyncIterator, Awaitable
+
+import httpx
+from google.oauth2.credentials import Credentials
+
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import tool
+
+from eaia.calendar_availability import (
+    availability_settings,
+    busy_from_freebusy,
+    format_availability,
+    query_range,
+)
+from eaia.calendar_cache import CalendarMirror
+from eaia.dead_letter import DeadLetterStore
+from eaia.gmail import (
+    CalInput,
+    calendar_event,
+    create_message,
+    freebusy_body,
+    get_recipients,
+)
+from eaia.gmail_fetch import (
+    BATCH_SIZE,
+    BODY_PARAMS,
+    MESSAGE_PARAMS,
+    REPLY_HEADERS,
+    THREAD_PARAMS,
+    MessageFetch,
+    add_history_messages,
+    check_batch_size,
+    due_retries,
+    history_order,
+    window_query,
+)
+from eaia.gmail_labels import LabelWriteQueue
+from eaia.google_auth import registry
+from eaia.main.config import get_config_async
+from eaia.rate_limit import (
+    MAX_ATTEMPTS,
+    RateLimiter,
+    is_rate_limited,
+    is_retryable,
+    quota_for,
+    retry_delay,
+)
+from eaia.schemas import EmailData
+
+logger = logging.getLogger(__name__)
+
+_GMAIL_URL = "https://gmail.googleapis.com/gmail/v1/users/me"
+_CALENDAR_URL = "https://www.googleapis.com/calendar/v3"
+_LIMITS = httpx.Limits(
+    max_connections=20, max_keepalive_connections=20, keepalive_expiry=60
+)
+_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+# Per-loop client cache; httpx connection pools cannot be shared across loops.
+_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+class AsyncGoogleClient:
+    """Thin async wrapper over the Gmail and Calendar REST endpoints.
+
+    Responses are the same JSON documents `googleapiclient` returns, so the
+    parsing helpers in `eaia.gmail` work on them unchanged. Non-2xx responses
+    raise `httpx.HTTPStatusError`.
+    """
+
+    def __init__(
+        self,
+        creds: Credentials,
+        http: httpx.AsyncClient | None = None,
+        concurrency: int = 10,
+        gmail_token: str | None = None,
+        gmail_secret: str | None = None,
+        limiter: RateLimiter | None = None,
+    ):
+        self.creds = creds
+        self.gmail_token = gmail_token
+        self.gmail_secret = gmail_secret
+        # Only a pool created here is closed by `aclose`.
+        self._owns_http = http is None
+        self.http = http or httpx.AsyncClient(limits=_LIMITS, timeout=_TIMEOUT)
+        self.limiter = limiter
+        # Requests sent so far, for throughput reporting.
+        self.calls = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._refresh_lock = asyncio.Lock()
+
+    async def aclose(self) -> None:
+        """Close the connection pool, for clients not cached by `get_client`."""
+        if self._owns_http:
+            await self.http.aclose()
+
+    async def __aenter__(self) -> "AsyncGoogleClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def _auth_headers(self) -> dict[str, str]:
+        if registry.needs_refresh(self.creds):
+            async with self._refresh_lock:
+                if registry.needs_refresh(self.creds):
+                    # The registry refreshes the shared credentials in place.
+                    self.creds = await asyncio.to_thread(
+                        registry.credentials, self.gmail_token, self.gmail_secret
+                    )
+        return {"Authorization": f"Bearer {self.creds.token}"}
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        params: dict | None = None,
+        json: Any = None,
+        method_id: str | None = None,
+    ) -> dict:
+        """Send one request, retrying throttled and 5xx responses.
+
+        `method_id` (e.g. `gmail.users.messages.get`) selects the quota
+        limiter and the number of quota units the call costs.
+        """
+        quota, units = quota_for(method_id)
+        for attempt in range(MAX_ATTEMPTS):
+            await quota.acquire(units)
+            if self.limiter is not None:
+                await self.limiter.acquire()
+            self.calls += 1
+            async with self._semaphore:
+                response = await self.http.request(
+                    method,
+                    url,
+                    params=params,
+                    json=json,
+                    headers=await self._auth_headers(),
+                )
+            if attempt == MAX_ATTEMPTS - 1 or not is_retryable(
+                response.status_code, response.content, method_id
+            ):
+                break
+            if is_rate_limited(response.status_code, response.content):
+                quota.throttle()
+            delay = retry_delay(attempt, response.headers.get("Retry-After"))
+            logger.info(
+                f"{method_id or url} returned {response.status_code}, "
+                f"retrying in {delay:.1f}s"
+            )
+            await asyncio.sleep(delay)
+        response.raise_for_status()
+        if not response.content:
+            return {}
+        return response.json()
+
+    # Gmail
+
+    async def get_profile(self) -> dict:
+        return await self.request(
+            "GET", f"{_GMAIL_URL}/profile", method_id="gmail.users.getProfile"
+        )
+
+    async def list_messages(
+        self, q: str, page_token: str | None = None, max_results: int | None = None
+    ) -> dict:
+        params = {"q": q}
+        if page_token:
+            params["pageToken"] = page_token
+        if max_results:
+            params["maxResults"] = max_results
+        return await self.request(
+            "GET",
+            f"{_GMAIL_URL}/messages",
+            params=params,
+            method_id="gmail.users.messages.list",
+        )
+
+    async def list_history(
+        self, start_history_id: str, page_token: str | None = None
+    ) -> dict:
+        params = {"startHistoryId": start_history_id, "historyTypes": "messageAdded"}
+        if page_token:
+            params["pageToken"] = page_token
+        return await self.request(
+            "GET",
+            f"{_GMAIL_URL}/history",
+            params=params,
+            method_id="gmail.users.history.list",
+        )
+
+    async def get_message(self, message_id: str, **params) -> dict:
+        return await self.request(
+            "GET",
+            f"{_GMAIL_URL}/messages/{message_id}",
+            params=params or None,
+            method_id="gmail.users.messages.get",
+        )
+
+    async def get_thread(self, thread_id: str, **params) -> dict:
+        return await self.request(
+            "GET",
+            f"{_GMAIL_URL}/threads/{thread_id}",
+            params=params or None,
+            method_id="gmail.users.threads.get",
+        )
+
+    async def modify_message(self, message_id: str, body: dict) -> dict:
+        return await self.request(
+            "POST",
+            f"{_GMAIL_URL}/messages/{message_id}/modify",
+            json=body,
+            method_id="gmail.users.messages.modify",
+        )
+
+    async def batch_modify(
+        self,
+        message_ids: list[str],
+        add_label_ids: list[str] | None = None,
+        remove_label_ids: list[str] | None = None,
+    ) -> dict:
+        body = {"ids": message_ids}
+        if add_label_ids:
+            body["addLabelIds"] = add_label_ids
+        if remove_label_ids:
+            body["removeLabelIds"] = remove_label_ids
+        return await self.request(
+            "POST",
+            f"{_GMAIL_URL}/messages/batchModify",
+            json=body,
+            method_id="gmail.users.messages.batchModify",
+        )
+
+    async def list_labels(self) -> dict:
+        return await self.request(
+            "GET", f"{_GMAIL_URL}/labels", method_id="gmail.users.labels.list"
+        )
+
+    async def create_label(self, name: str) -> dict:
+        return await self.request(
+            "POST",
+            f"{_GMAIL_URL}/labels",
+            json={"name": name},
+            method_id="gmail.users.labels.create",
+        )
+
+    async def send_message(self, body: dict) -> dict:
+        return await self.request(
+            "POST",
+            f"{_GMAIL_URL}/messages/send",
+            json=body,
+            method_id="gmail.users.messages.send",
+        )
+
+    # Calendar
+
+    async def list_events(self, calendar_id: str = "primary", **params) -> dict:
+        return await self.request(
+            "GET",
+            f"{_CALENDAR_URL}/calendars/{calendar_id}/events",
+            params=params,
+            method_id="calendar.events.list",
+        )
+
+    async def freebusy(self, body: dict) -> dict:
+        return await self.request(
+            "POST",
+            f"{_CALENDAR_URL}/freeBusy",
+            json=body,
+            method_id="calendar.freebusy.query",
+        )
+
+    async def insert_event(
+        self, body: dict, calendar_id: str = "primary", **params
+    ) -> dict:
+        return await self.request(
+            "POST",
+            f"{_CALENDAR_URL}/calendars/{calendar_id}/events",
+            params=params,
+            json=body,
+            method_id="calendar.events.insert",
+        )
+
+
+async def get_client(
+    gmail_token: str | None = None, gmail_secret: str | None = None
+) -> AsyncGoogleClient:
+    """Return the pooled client for the running event loop, creating it once."""
+    clients = _CLIENTS.setdefault(asyncio.get_running_loop(), {})
+    key = (gmail_token, gmail_secret)
+    if key not in clients:
+        creds = await asyncio.to_thread(
+            registry.credentials, gmail_token, gmail_secret
+        )
+        clients[key] = AsyncGoogleClient(
+            creds, gmail_token=gmail_token, gmail_secret=gmail_secret
+        )
+    return clients[key]
+
+
+async def _list_window_messages(
+    client: AsyncGoogleClient, to_email, minutes_since: int
+) -> list[dict]:
+    query = window_query(to_email, minutes_since)
+    messages = []
+    nextPageToken = None
+    while True:
+        results = await client.list_messages(query, nextPageToken)
+        if "messages" in results:
+            messages.extend(results["messages"])
+        nextPageToken = results.get("nextPageToken")
+        if not nextPageToken:
+            break
+    return messages
+
+
+async def _list_history_messages(
+    client: AsyncGoogleClient, start_history_id: str
+) -> list[dict] | None:
+    messages = {}
+    nextPageToken = None
+    while True:
+        try:
+            results = await client.list_history(start_history_id, nextPageToken)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                return None
+            raise e
+        add_history_messages(results, messages)
+        nextPageToken = results.get("nextPageToken")
+        if not nextPageToken:
+            break
+    return history_order(messages)
+
+
+async def _gather_keyed(calls: dict[str, Awaitable]) -> tuple[dict, dict]:
+    """Await keyed calls concurrently; the async counterpart of `_batch_execute`."""
+    keys = list(calls)
+    results = await asyncio.gather(*calls.values(), return_exceptions=True)
+    responses = {}
+    errors = {}
+    for key, result in zip(keys, results):
+        if isinstance(result, BaseException):
+            errors[key] = result
+        else:
+            responses[key] = result
+    return responses, errors
+
+
+async def afetch_group_emails(
+    to_email,
+    minutes_since: int = 30,
+    gmail_token: str | None = None,
+    gmail_secret: str | None = None,
+    batch_size: int = BATCH_SIZE,
+    sync_state: dict | None = None,
+    dead_letters: DeadLetterStore | None = None,
+) -> AsyncIterator[EmailData]:
+    """Async generator version of `eaia.gmail.fetch_group_emails`.
+
+    Messages and threads are fetched `batch_size` at a time as concurrent
+    requests over the pooled client, with the same metadata-first tiering,
+    and yield the same `EmailData` dicts.
+    """
+    check_batch_size(batch_size)
+    client = await get_client(gmail_token, gmail_secret)
+    messages = None
+    if sync_state is not None:
+        profile = await client.get_profile()
+        if sync_state.get("history_id"):
+            messages = await _list_history_messages(client, sync_state["history_id"])
+            if messages is None:
+                logger.info("Gmail history id expired, running a full sync.")
+        sync_state["history_id"] = profile["historyId"]
+    incremental = messages is not None
+    if not incremental:
+        messages = await _list_window_messages(client, to_email, minutes_since)
+    async for email_data in aemails_from_messages(
+        client, to_email, messages, batch_size, incremental, dead_letters
+    ):
+        yield email_data
+
+
+async def afetch_dead_letter_emails(
+    to_email,
+    dead_letters: DeadLetterStore,
+    gmail_token: str | None = None,
+    gmail_secret: str | None = None,
+    batch_size: int = BATCH_SIZE,
+) -> AsyncIterator[EmailData]:
+    """Async generator version of `eaia.gmail.fetch_dead_letter_emails`."""
+    client = await get_client(gmail_token, gmail_secret)
+    # A retry may come from an unfiltered history listing, hence `incremental`.
+    async for email_data in aemails_from_messages(
+        client, to_email, due_retries(dead_letters), batch_size, True, dead_letters
+    ):
+        yield email_data
+
+
+async def aemails_from_messages(
+    client: AsyncGoogleClient,
+    to_email,
+    messages: list[dict],
+    batch_size: int = BATCH_SIZE,
+    incremental: bool = False,
+    dead_letters: DeadLetterStore | None = None,
+) -> AsyncIterator[EmailData]:
+    """Async version of `eaia.gmail.emails_from_messages`: each tier of a
+    chunk is sent as concurrent requests over the pooled client."""
+    fetch = MessageFetch(to_email, messages, batch_size, incremental, dead_letters)
+    for chunk in fetch.chunks():
+        msgs, msg_errors = await _gather_keyed(
+            {
+                message["id"]: client.get_message(message["id"], **MESSAGE_PARAMS)
+                for message in chunk
+            }
+        )
+        threads, thread_errors = await _gather_keyed(
+            {
+                thread_id: client.get_thread(thread_id, **THREAD_PARAMS)
+                for thread_id in fetch.thread_ids(msgs)
+            }
+        )
+        fetch.add_threads(threads.values())
+        bodies, body_errors = await _gather_keyed(
+            {
+                message_id: client.get_message(message_id, **BODY_PARAMS)
+                for message_id in fetch.body_ids(msgs)
+            }
+        )
+        emails = fetch.emails(
+            chunk, msgs, msg_errors, thread_errors, bodies, body_errors
+        )
+        try:
+            for email_data in emails:
+                yield email_data
+        finally:
+            # Settles the chunk's dead letters when the consumer stops early.
+            emails.close()
+    fetch.log_summary()
+
+
+async def asend_email(
+    email_id,
+    response_text,
+    email_address,
+    gmail_token: str | None = None,
+    gmail_secret: str | None = None,
+    addn_receipients=None,
+):
+    client = await get_client(gmail_token, gmail_secret)
+    message = await client.get_message(
+        email_id, format="metadata", metadataHeaders=REPLY_HEADERS
+    )
+
+    headers = message["payload"]["headers"]
+    message_id = next(
+        header["value"] for header in headers if header["name"].lower() == "message-id"
+    )
+    thread_id = message["threadId"]
+    recipients = get_recipients(headers, email_address, addn_receipients)
+    subject = next(
+        header["value"] for header in headers if header["name"].lower() == "subject"
+    )
+    response_message = create_message(
+        "me", recipients, subject, response_text, thread_id, message_id
+    )
+    await client.send_message(response_message)
+
+
+async def get_label_queue(
+    gmail_token: str | None = None, gmail_secret: str | None = None
+) -> LabelWriteQueue:
+    """Return the label write queue for the running event loop."""
+    clients = _CLIENTS.setdefault(asyncio.get_running_loop(), {})
+    key = ("labels", gmail_token, gmail_secret)
+    if key not in clients:
+        clients[key] = LabelWriteQueue(await get_client(gmail_token, gmail_secret))
+    return clients[key]
+
+
+async def amark_as_read(
+    message_id,
+    gmail_token: str | None = None,
+    gmail_secret: str | None = None,
+    labels: list[str] | None = None,
+):
+    """Mark an email as read, optionally adding `labels`, via the write queue."""
+    queue = await get_label_queue(gmail_token, gmail_secret)
+    await queue.modify(message_id, add=labels or [], remove=["UNREAD"])
+
+
+async def aapply_labels(
+    message_id,
+    labels: list[str],
+    gmail_token: str | None = None,
+    gmail_secret: str | None = None,
+):
+    queue = await get_label_queue(gmail_token, gmail_secret)
+    await queue.modify(message_id, add=labels)
+
+
+def get_calendar_mirror() -> CalendarMirror:
+    """Return the calendar mirror for the running event loop.
+
+    Set `EAIA_CALENDAR_DB` to a file path to back the mirror with SQLite.
+    """
+    clients = _CLIENTS.setdefault(asyncio.get_running_loop(), {})
+    if "calendar" not in clients:
+        clients["calendar"] = CalendarMirror(db_path=os.getenv("EAIA_CALENDAR_DB"))
+    return clients["calendar"]
+
+
+@tool(args_schema=CalInput)
+async def get_events_for_days(date_strs: list[str], config: RunnableConfig) -> str:
+    """
+    Retrieves availability for a list of days. If you want to check for multiple days, call this with multiple inputs.
+
+    Input in the format of ['dd-mm-yyyy', 'dd-mm-yyyy']
+
+    Args:
+    date_strs: The days for which to retrieve availability (dd-mm-yyyy string).
+
+    Returns: the free time slots within working hours for each of those days.
+    """
+    # Served from the calendar mirror, which our own invites keep current, so
+    # there is no second path that could disagree with it.
+    client = await get_client()
+    tz, working_hours, min_length = availability_settings(
+        await get_config_async(config)
+    )
+    days = [datetime.strptime(date_str, "%d-%m-%Y").date() for date_str in date_strs]
+    time_min, time_max = query_range(days, tz)
+    busy = await get_calendar_mirror().busy(client, time_min, time_max, tz)
+    if busy is None:
+        # Outside the mirrored window, ask Calendar directly.
+        response = await client.freebusy(freebusy_body(time_min, time_max, tz))
+        busy = busy_from_freebusy(response)
+    return format_availability(date_strs, busy, tz, working_hours, min_length)
+
+
+async def asend_calendar_invite(
+    emails, title, start_time, end_time, email_address, timezone="PST"
+):
+    client = await get_client()
+    event = calendar_event(emails, title, start_time, end_time, email_address, timezone)
+
+    try:
+        created = await client.insert_event(
+            event, sendNotifications="true", conferenceDataVersion=1
+        )
+        # Never offer the slot we just booked.
+        mirror = get_calendar_mirror()
+        mirror.apply(created)
+        mirror.invalidate()
+        return True
+    except Exception as e:
+        logger.info(f"An error occurred while sending the calendar invite: {e}")
+        return False
@@ -0,0 +1,192 @@
+"""
+backfill.py
+
+Resumable ingest of a date range of mailbox history, for onboarding.
+
+The range is walked oldest first in chunks of `chunk_days`. Each chunk is
+listed one Gmail page at a time, and every page is fetched and dispatched
+before the next one is listed. A JSON checkpoint is written after each page,
+so a restarted backfill continues from the last finished page. Emails of the
+page that was interrupted are not dispatched again: `dispatch_email` skips
+threads whose stored `email_id` already matches (via the ledger when
+possible).
+"""
+import asyncio
+import json
+import os
+import time
+from datetime import date, datetime, timedelta
+from typing import AsyncIterator, Callable
+
+from eaia.async_gmail import AsyncGoogleClient, aemails_from_messages
+from eaia.dead_letter import DeadLetterStore
+from eaia.gmail_fetch import BATCH_SIZE, check_batch_size
+from eaia.google_auth import registry
+from eaia.ingest import DEFAULT_CONCURRENCY, dispatch_emails
+from eaia.ledger import DispatchLedger
+from eaia.rate_limit import RateLimiter, gmail_quota
+from eaia.schemas import EmailData
+
+DEFAULT_CHUNK_DAYS = 7
+# Gmail allows up to 500 ids per `messages.list` page.
+DEFAULT_PAGE_SIZE = 100
+_MAX_PAGE_SIZE = 500
+
+
+class BackfillCheckpoint:
+    """Progress of one backfill, persisted as JSON after every page."""
+
+    def __init__(self, path: str, start: date, end: date, chunk_days: int):
+        self.path = path
+        self.state = {
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "chunk_days": chunk_days,
+            "chunk_start": start.isoformat(),
+            "page_token": None,
+            "pages": 0,
+            "listed": 0,
+            "dispatched": 0,
+            "calls": 0,
+            "done": False,
+        }
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            for key in ("start", "end", "chunk_days"):
+                if saved[key] != self.state[key]:
+                    raise ValueError(
+                        f"Checkpoint {path} is for a different backfill "
+                        f"({key}={saved[key]!r}); remove it or pass another path."
+                    )
+            self.state = saved
+
+    @property
+    def chunk_start(self) -> date:
+        return date.fromisoformat(self.state["chunk_start"])
+
+    def save(self) -> None:
+        # Write and rename, so a crash never leaves a truncated checkpoint.
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def _query(to_email: str, start: date, end: date) -> str:
+    after = int(datetime.combine(start, datetime.min.time()).timestamp())
+    before = int(datetime.combine(end, datetime.min.time()).timestamp())
+    return f"(to:{to_email} OR from:{to_email}) after:{after} before:{before}"
+
+
+async def _paced(
+    emails: AsyncIterator[EmailData], limiter: RateLimiter
+) -> AsyncIterator[EmailData]:
+    async for email in emails:
+        await limiter.acquire()
+        yield email
+
+
+async def backfill(
+    client,
+    to_email: str,
+    start: date,
+    end: date,
+    checkpoint_path: str,
+    chunk_days: int = DEFAULT_CHUNK_DAYS,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    batch_size: int = BATCH_SIZE,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    gmail_concurrency: int = 10,
+    gmail_rate: float | None = None,
+    dispatch_rate: float | None = None,
+    gmail_token: str | None = None,
+    gmail_secret: str | None = None,
+    ledger: DispatchLedger | None = None,
+    dead_letters: DeadLetterStore | None = None,
+    report: Callable[[str], None] = print,
+) -> dict:
+    """Ingest every email in `[start, end)`, resuming from `checkpoint_path`.
+
+    `client` is the LangGraph SDK client. Gmail calls always go through the
+    shared quota limiter; `gmail_rate` additionally caps them per second and
+    `dispatch_rate` caps dispatched emails per second (None for no limit).
+    Each page is fetched `batch_size` messages at a time. Returns the final
+    checkpoint state.
+    """
+    check_batch_size(batch_size)
+    if not 1 <= page_size <= _MAX_PAGE_SIZE:
+        raise ValueError(
+            f"page_size must be between 1 and {_MAX_PAGE_SIZE}, got {page_size}"
+        )
+    checkpoint = BackfillCheckpoint(checkpoint_path, start, end, chunk_days)
+    if checkpoint.state["done"]:
+        report(f"Backfill already finished: {checkpoint.state}")
+        return checkpoint.state
+    creds = await asyncio.to_thread(registry.credentials, gmail_token, gmail_secret)
+    gmail = AsyncGoogleClient(
+        creds,
+        concurrency=gmail_concurrency,
+        gmail_token=gmail_token,
+        gmail_secret=gmail_secret,
+        limiter=RateLimiter(gmail_rate) if gmail_rate else None,
+    )
+    dispatch_limiter = RateLimiter(dispatch_rate) if dispatch_rate else None
+    started = time.monotonic()
+    # Counts for this run only; the checkpoint holds the totals.
+    listed = calls = 0
+
+    try:
+        chunk_start = checkpoint.chunk_start
+        page_token = checkpoint.state["page_token"]
+        while chunk_start < end:
+            chunk_end = min(chunk_start + timedelta(days=chunk_days), end)
+            query = _query(to_email, chunk_start, chunk_end)
+            while True:
+                response = await gmail.list_messages(query, page_token, max_results=page_size)
+                messages = response.get("messages", [])
+                emails = aemails_from_messages(
+                    gmail, to_email, messages, batch_size, dead_letters=dead_letters
+                )
+                if dispatch_limiter is not None:
+                    emails = _paced(emails, dispatch_limiter)
+                page_dispatched = await dispatch_emails(
+                    client, emails, concurrency=concurrency, early=False, ledger=ledger
+                )
+                listed += len(messages)
+                calls += gmail.calls
+                page_token = response.get("nextPageToken")
+
+                state = checkpoint.state
+                state["chunk_start"] = (chunk_start if page_token else chunk_end).isoformat()
+                state["page_token"] = page_token
+                state["pages"] += 1
+                state["listed"] += len(messages)
+                state["dispatched"] += page_dispatched
+                state["calls"] += gmail.calls
+                gmail.calls = 0
+                checkpoint.save()
+
+                elapsed = time.monotonic() - started
+                report(
+                    f"{chunk_start.isoformat()}..{chunk_end.isoformat()} page done: "
+                    f"{len(messages)} listed, {page_dispatched} dispatched | "
+                    f"total {state['listed']} listed, {state['dispatched']} dispatched | "
+                    f"{listed / elapsed:.1f} emails/s, "
+                    f"{calls / elapsed:.1f} API calls/s, "
+                    f"Gmail quota {gmail_quota.utilization():.0%} used"
+                )
+                if not page_token:
+                    break
+            chunk_start = chunk_end
+    finally:
+        # A one-off client, not the per-loop one, so its pool is closed here.
+        await gmail.aclose()
+
+    checkpoint.state["done"] = True
+    checkpoint.save()
+    report(
+        f"Backfill finished: {checkpoint.state['listed']} emails listed, "
+        f"{checkpoint.state['dispatched']} dispatched."
+    )
+    return checkpoint.state
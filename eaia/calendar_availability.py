@@ -0,0 +1,149 @@
+"""
+calendar_availability.py
+
+Computes open meeting slots from busy intervals.
+
+`get_events_for_days` makes one Calendar `freebusy.query` call covering every
+requested day, merges the busy intervals into an `IntervalSet` and returns the
+free slots inside working hours, instead of a raw listing of every event.
+"""
+from bisect import bisect_right
+from datetime import date, datetime, time, timedelta, tzinfo
+from typing import Iterable
+
+import pytz
+
+# Config uses abbreviations such as "PST", which pytz does not know.
+_TIMEZONE_ALIASES = {
+    "PST": "US/Pacific",
+    "PDT": "US/Pacific",
+    "MST": "US/Mountain",
+    "MDT": "US/Mountain",
+    "CST": "US/Central",
+    "CDT": "US/Central",
+    "EST": "US/Eastern",
+    "EDT": "US/Eastern",
+}
+DEFAULT_WORKING_HOURS = "09:00-17:00"
+DEFAULT_MIN_SLOT_MINUTES = 15
+
+Interval = tuple[datetime, datetime]
+
+
+def resolve_timezone(name: str) -> tzinfo:
+    return pytz.timezone(_TIMEZONE_ALIASES.get(name, name))
+
+
+def parse_working_hours(spec: str) -> tuple[time, time]:
+    """Parse `"HH:MM-HH:MM"` into start and end times."""
+    start, end = (time.fromisoformat(part.strip()) for part in spec.split("-"))
+    return start, end
+
+
+def parse_rfc3339(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class IntervalSet:
+    """Sorted, non-overlapping intervals built by merging arbitrary ones."""
+
+    def __init__(self, intervals: Iterable[Interval] = ()):
+        self.starts: list[datetime] = []
+        self.ends: list[datetime] = []
+        for start, end in sorted(i for i in intervals if i[0] < i[1]):
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    def gaps(
+        self, start: datetime, end: datetime, min_length: timedelta = timedelta(0)
+    ) -> list[Interval]:
+        """Free intervals within `[start, end)` at least `min_length` long."""
+        free = []
+        cursor = start
+        # First interval that could overlap the window.
+        i = max(bisect_right(self.starts, start) - 1, 0)
+        while i < len(self.starts) and self.starts[i] < end:
+            if self.ends[i] > cursor:
+                if self.starts[i] > cursor and self.starts[i] - cursor >= min_length:
+                    free.append((cursor, self.starts[i]))
+                cursor = max(cursor, self.ends[i])
+            i += 1
+        if end > cursor and end - cursor >= min_length:
+            free.append((cursor, end))
+        return free
+
+
+def working_window(day: date, tz: tzinfo, working_hours: tuple[time, time]) -> Interval:
+    start, end = working_hours
+    return (
+        tz.localize(datetime.combine(day, start)),
+        tz.localize(datetime.combine(day, end)),
+    )
+
+
+def query_range(days: list[date], tz: tzinfo) -> Interval:
+    """One range covering all requested days, for a single API call."""
+    return (
+        tz.localize(datetime.combine(min(days), time.min)),
+        tz.localize(datetime.combine(max(days) + timedelta(days=1), time.min)),
+    )
+
+
+def _format_time(dt: datetime) -> str:
+    return dt.strftime("%I:%M %p").lstrip("0")
+
+
+def format_availability(
+    date_strs: list[str],
+    busy: IntervalSet,
+    tz: tzinfo,
+    working_hours: tuple[time, time],
+    min_length: timedelta,
+) -> str:
+    lines = [
+        f"Free time in {tz.zone}, within working hours "
+        f"{working_hours[0].strftime('%H:%M')}-{working_hours[1].strftime('%H:%M')}, "
+        f"slots of at least {int(min_length.total_seconds() // 60)} minutes:"
+    ]
+    for date_str in date_strs:
+        day = datetime.strptime(date_str, "%d-%m-%Y").date()
+        window = working_window(day, tz, working_hours)
+        slots = busy.gaps(*window, min_length)
+        label = f"{day.strftime('%a')} {date_str}"
+        if slots:
+            free = ", ".join(
+                f"{_format_time(start.astimezone(tz))}-{_format_time(end.astimezone(tz))}"
+                for start, end in slots
+            )
+            lines.append(f"{label}: {free}")
+        else:
+            lines.append(f"{label}: no free time")
+    return "\n".join(lines)
+
+
+def availability_settings(prompt_config: dict) -> tuple[tzinfo, tuple[time, time], timedelta]:
+    """Timezone, working hours and minimum slot length from the assistant config."""
+    return (
+        resolve_timezone(prompt_config.get("timezone", "PST")),
+        parse_working_hours(prompt_config.get("working_hours", DEFAULT_WORKING_HOURS)),
+        timedelta(
+            minutes=prompt_config.get("min_slot_minutes", DEFAULT_MIN_SLOT_MINUTES)
+        ),
+    )
+
+
+def busy_from_freebusy(response: dict, calendar_id: str = "primary") -> IntervalSet:
+    busy = response.get("calendars", {}).get(calendar_id, {}).get("busy", [])
+    return IntervalSet(
+        (parse_rfc3339(interval["start"]), parse_rfc3339(interval["end"]))
+        for interval in busy
+    )
@@ -0,0 +1,219 @@
+"""
+calendar_cache.py
+
+Local mirror of the primary calendar, kept current with `events.list` sync tokens.
+
+The meeting agent often checks overlapping days several times in one run.
+`CalendarMirror` does one full sync of a rolling window, then only pulls the
+events that changed since the last sync token, so availability queries are
+answered from memory. The mirror can optionally be backed by SQLite so a
+restarted worker does not need a full sync. Our own invite writes are applied
+to the mirror immediately and also force a resync.
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import time as _time
+from datetime import datetime, time, timedelta, timezone, tzinfo
+
+import httpx
+
+from eaia.calendar_availability import IntervalSet, Interval, parse_rfc3339
+
+logger = logging.getLogger(__name__)
+
+# Incremental syncs at most this often; our own writes bypass it.
+_MAX_STALENESS = 60.0
+# The mirrored window, rolled forward with a full sync once a day.
+_WINDOW_BEFORE = timedelta(days=1)
+_WINDOW_AFTER = timedelta(days=90)
+_FULL_SYNC_INTERVAL = 24 * 60 * 60.0
+
+
+def _is_busy(event: dict) -> bool:
+    if event.get("status") == "cancelled" or event.get("transparency") == "transparent":
+        return False
+    for attendee in event.get("attendees", []):
+        if attendee.get("self") and attendee.get("responseStatus") == "declined":
+            return False
+    return True
+
+
+def _event_interval(event: dict, tz: tzinfo) -> Interval:
+    """Event bounds; all-day events span whole days in `tz`."""
+    bounds = []
+    for edge in ("start", "end"):
+        value = event[edge]
+        if "dateTime" in value:
+            bounds.append(parse_rfc3339(value["dateTime"]))
+        else:
+            day = datetime.strptime(value["date"], "%Y-%m-%d").date()
+            bounds.append(tz.localize(datetime.combine(day, time.min)))
+    return bounds[0], bounds[1]
+
+
+class CalendarMirror:
+    """Busy events of one calendar, synced incrementally."""
+
+    def __init__(
+        self,
+        calendar_id: str = "primary",
+        db_path: str | None = None,
+        max_staleness: float = _MAX_STALENESS,
+    ):
+        self.calendar_id = calendar_id
+        self.max_staleness = max_staleness
+        self.events: dict[str, dict] = {}
+        self.sync_token: str | None = None
+        self.window: tuple[datetime, datetime] | None = None
+        self._synced_at = 0.0
+        self._full_synced_at = 0.0
+        self._dirty = True
+        self._busy: dict[str, IntervalSet] = {}
+        self._lock = asyncio.Lock()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS events (id TEXT PRIMARY KEY, event TEXT)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self._load()
+
+    def covers(self, time_min: datetime, time_max: datetime) -> bool:
+        return (
+            self.window is not None
+            and self.window[0] <= time_min
+            and time_max <= self.window[1]
+        )
+
+    def invalidate(self) -> None:
+        """Force a sync before the next query."""
+        self._dirty = True
+
+    def apply(self, event: dict) -> None:
+        """Apply an event we created or changed ourselves."""
+        self._upsert([event])
+
+    async def busy(self, client, time_min: datetime, time_max: datetime, tz: tzinfo):
+        """Merged busy intervals, or None if the range is outside the mirror."""
+        await self.refresh(client)
+        if not self.covers(time_min, time_max):
+            return None
+        if tz.zone not in self._busy:
+            self._busy[tz.zone] = IntervalSet(
+                _event_interval(event, tz)
+                for event in self.events.values()
+                if _is_busy(event)
+            )
+        return self._busy[tz.zone]
+
+    async def refresh(self, client) -> None:
+        now = _time.monotonic()
+        if not self._dirty and now - self._synced_at < self.max_staleness:
+            return
+        async with self._lock:
+            if not self._dirty and _time.monotonic() - self._synced_at < self.max_staleness:
+                return
+            if (
+                self.sync_token is None
+                or _time.monotonic() - self._full_synced_at > _FULL_SYNC_INTERVAL
+            ):
+                await self._full_sync(client)
+            else:
+                try:
+                    await self._incremental_sync(client)
+                except httpx.HTTPStatusError as e:
+                    # 410 Gone: the sync token expired and a full sync is required.
+                    if e.response.status_code != 410:
+                        raise e
+                    await self._full_sync(client)
+            self._synced_at = _time.monotonic()
+            self._dirty = False
+
+    async def _full_sync(self, client) -> None:
+        now = datetime.now(timezone.utc)
+        window = (now - _WINDOW_BEFORE, now + _WINDOW_AFTER)
+        events, sync_token = await self._list(
+            client, timeMin=window[0].isoformat(), timeMax=window[1].isoformat()
+        )
+        self.events = {}
+        # Rebuilt from the new events, even if the window is now empty.
+        self._busy = {}
+        self._upsert(events)
+        self.sync_token = sync_token
+        self.window = window
+        self._full_synced_at = _time.monotonic()
+        if self._db is not None:
+            self._db.execute("DELETE FROM events")
+            self._save(events)
+
+    async def _incremental_sync(self, client) -> None:
+        events, sync_token = await self._list(client, syncToken=self.sync_token)
+        self._upsert(events)
+        self.sync_token = sync_token
+        if self._db is not None:
+            self._save(events)
+
+    async def _list(self, client, **params) -> tuple[list[dict], str]:
+        events = []
+        page_token = None
+        while True:
+            if page_token:
+                params["pageToken"] = page_token
+            response = await client.list_events(
+                self.calendar_id, singleEvents=True, showDeleted=True, **params
+            )
+            events.extend(response.get("items", []))
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                return events, response.get("nextSyncToken")
+
+    def _upsert(self, events: list[dict]) -> None:
+        # Any added, changed or removed (cancelled) event drops the cached busy
+        # intervals; they are rebuilt on the next query.
+        for event in events:
+            if event.get("status") == "cancelled":
+                self.events.pop(event["id"], None)
+            else:
+                self.events[event["id"]] = event
+        if events:
+            self._busy = {}
+
+    def _load(self) -> None:
+        state = dict(self._db.execute("SELECT key, value FROM state"))
+        if "sync_token" not in state:
+            return
+        self.sync_token = state["sync_token"]
+        start, end = json.loads(state["window"])
+        self.window = (parse_rfc3339(start), parse_rfc3339(end))
+        self.events = {
+            event_id: json.loads(event)
+            for event_id, event in self._db.execute("SELECT id, event FROM events")
+        }
+        # A loaded mirror still needs an incremental sync, but no full sync.
+        self._full_synced_at = _time.monotonic()
+
+    def _save(self, events: list[dict]) -> None:
+        with self._db:
+            for event in events:
+                if event.get("status") == "cancelled":
+                    self._db.execute("DELETE FROM events WHERE id = ?", (event["id"],))
+                else:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO events VALUES (?, ?)",
+                        (event["id"], json.dumps(event)),
+                    )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO state VALUES (?, ?)",
+                [
+                    ("sync_token", self.sync_token),
+                    (
+                        "window",
+                        json.dumps([self.window[0].isoformat(), self.window[1].isoformat()]),
+                    ),
+                ],
+            )
@@ -3,55 +3,91 @@ import os
 from dotenv import load_dotenv
 load_dotenv()
 
+from functools import partial
 from typing import TypedDict
-from eaia.gmail import fetch_group_emails
+from eaia.async_gmail import afetch_dead_letter_emails, afetch_group_emails
+from eaia.dead_letter import get_dead_letters
+from eaia.gmail_fetch import SYNC_NAMESPACE
+from eaia.ingest import DEFAULT_CONCURRENCY, dispatch_emails, get_ledger
 from langgraph_sdk import get_client
-import httpx
-import uuid
-import hashlib
 from langgraph.graph import StateGraph, START, END
+from langgraph.store.base import BaseStore
+from eaia.main.batch_triage import triage_batch
 from eaia.main.config import get_config
+from eaia.main.example_compaction import maybe_compact_examples
 
 client = get_client()
 
 
-class JobKickoff(TypedDict):
+class _JobKickoffRequired(TypedDict):
     minutes_since: int
 
 
-async def main(state: JobKickoff, config):
+# Optional inputs: `total=False` rather than `NotRequired`, which the graph's
+# pydantic input schema rejects.
+class JobKickoff(_JobKickoffRequired, total=False):
+    # Sync from the last seen Gmail history id instead of rescanning the window
+    incremental: bool
+    # Number of emails dispatched to the `main` graph concurrently
+    concurrency: int
+    # Triage this many emails per LLM call before dispatching them (off below 2)
+    triage_batch_size: int
+    # Assistant the `main` runs are started on (default: the graph's own)
+    assistant_id: str
+
+
+async def main(state: JobKickoff, config, store: BaseStore):
     minutes_since: int = state["minutes_since"]
-    email = get_config(config)["email"]
+    email_address = get_config(config)["email"]
+    sync_state = None
+    if state.get("incremental"):
+        item = await store.aget(SYNC_NAMESPACE, email_address)
+        sync_state = dict(item.value) if item else {}
 
-    # TODO: This really should be async
-    for email in fetch_group_emails(email, minutes_since=minutes_since):
-        thread_id = str(
-            uuid.UUID(hex=hashlib.md5(email["thread_id"].encode("UTF-8")).hexdigest())
-        )
-        try:
-            thread_info = await client.threads.get(thread_id)
-        except httpx.HTTPStatusError as e:
-            if "user_respond" in email:
-                continue
-            if e.response.status_code == 404:
-                thread_info = await client.threads.create(thread_id=thread_id)
-            else:
-                raise e
-        if "user_respond" in email:
-            await client.threads.update_state(thread_id, None, as_node="__end__")
-            continue
-        recent_email = thread_info["metadata"].get("email_id")
-        if recent_email == email["id"]:
-            break
-        await client.threads.update(thread_id, metadata={"email_id": email["id"]})
-
-        await client.runs.create(
-            thread_id,
-            "main",
-            input={"email": email},
-            multitask_strategy="rollback",
+    # Batch triage and compaction act for the assistant the runs use, with
+    # its configurable, so they see the same config, model, examples and cache.
+    assistant = await client.assistants.get(state.get("assistant_id", "main"))
+    assistant_id = assistant["assistant_id"]
+    triage = None
+    if state.get("triage_batch_size", 0) > 1:
+        configurable = assistant["config"].get("configurable", {})
+        triage = partial(
+            triage_batch,
+            config={"configurable": {**configurable, "assistant_id": assistant_id}},
+            store=store,
         )
 
+    # Retries first, in their own pass: they are older than the listed mail,
+    # which stops at the first email already dispatched.
+    await dispatch_emails(
+        client,
+        afetch_dead_letter_emails(email_address, get_dead_letters()),
+        concurrency=state.get("concurrency", DEFAULT_CONCURRENCY),
+        early=False,
+        ledger=get_ledger(),
+        assistant_id=assistant_id,
+    )
+    await dispatch_emails(
+        client,
+        afetch_group_emails(
+            email_address,
+            minutes_since=minutes_since,
+            sync_state=sync_state,
+            dead_letters=get_dead_letters(),
+        ),
+        concurrency=state.get("concurrency", DEFAULT_CONCURRENCY),
+        ledger=get_ledger(),
+        triage=triage,
+        triage_batch_size=state.get("triage_batch_size", 0),
+        assistant_id=assistant_id,
+    )
+
+    if sync_state is not None:
+        await store.aput(SYNC_NAMESPACE, email_address, sync_state, index=False)
+
+    # At most once a day; keeps the triage examples from growing without bound.
+    await maybe_compact_examples(store, assistant_id)
+
 
 graph = StateGraph(JobKickoff)
 graph.add_node(main)
@@ -0,0 +1,136 @@
+"""
+dead_letter.py
+
+Persistent dead-letter store for messages that failed during ingest.
+
+A message whose metadata, thread or body fetch failed used to be logged and
+forgotten, and was only seen again if it happened to fall inside a later
+`minutes_since` window. Failed messages are now recorded here with their
+error class, and the next fetch passes retry the ones that are due, by id,
+with exponential backoff between attempts. Failures that cannot succeed on a
+retry (the message is gone) and messages that keep failing are parked
+instead, so they stay visible without being retried forever.
+"""
+import os
+import sqlite3
+import time
+from functools import lru_cache
+
+_BASE_DELAY = 5 * 60.0
+_MAX_DELAY = 12 * 60 * 60.0
+_MAX_ATTEMPTS = 10
+# Retried messages are added to a pass at most this many at a time.
+_DUE_LIMIT = 100
+
+
+def error_class(error: BaseException) -> str:
+    """Exception type, plus the HTTP status for API errors (e.g. `HttpError 429`)."""
+    name = type(error).__name__
+    response = getattr(error, "resp", None) or getattr(error, "response", None)
+    status = getattr(response, "status", None) or getattr(response, "status_code", None)
+    return f"{name} {status}" if status else name
+
+
+def _is_permanent(error: BaseException) -> bool:
+    return error_class(error).endswith((" 404", " 410"))
+
+
+class DeadLetterStore:
+    """Failed `{id, threadId}` messages, keyed by message id."""
+
+    def __init__(self, db_path: str | None = None, max_attempts: int = _MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self._db = sqlite3.connect(db_path or ":memory:", check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS failed ("
+                "message_id TEXT PRIMARY KEY, thread_id TEXT, error_class TEXT, "
+                "error TEXT, attempts INTEGER, first_failed REAL, next_retry REAL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS failure_counts "
+                "(error_class TEXT PRIMARY KEY, count INTEGER)"
+            )
+
+    def record(self, message: dict, error: BaseException) -> None:
+        """Record a failed attempt and schedule the next one."""
+        now = time.time()
+        row = self._db.execute(
+            "SELECT attempts, first_failed FROM failed WHERE message_id = ?",
+            (message["id"],),
+        ).fetchone()
+        attempts, first_failed = (row[0] + 1, row[1]) if row else (1, now)
+        if _is_permanent(error) or attempts >= self.max_attempts:
+            next_retry = None
+        else:
+            next_retry = now + min(_MAX_DELAY, _BASE_DELAY * 2 ** (attempts - 1))
+        kind = error_class(error)
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO failed VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    message["id"],
+                    message["threadId"],
+                    kind,
+                    str(error)[:500],
+                    attempts,
+                    first_failed,
+                    next_retry,
+                ),
+            )
+            self._db.execute(
+                "INSERT INTO failure_counts VALUES (?, 1) "
+                "ON CONFLICT(error_class) DO UPDATE SET count = count + 1",
+                (kind,),
+            )
+
+    def settle(self, messages: list[dict], failures: dict[str, BaseException]) -> None:
+        """Record `failures` and clear every other message of a processed chunk."""
+        for message in messages:
+            if message["id"] in failures:
+                self.record(message, failures[message["id"]])
+        with self._db:
+            self._db.executemany(
+                "DELETE FROM failed WHERE message_id = ?",
+                [(m["id"],) for m in messages if m["id"] not in failures],
+            )
+
+    def due(self, limit: int = _DUE_LIMIT) -> list[dict]:
+        """Messages whose next retry is due, oldest first, as `{id, threadId}`."""
+        rows = self._db.execute(
+            "SELECT message_id, thread_id FROM failed "
+            "WHERE next_retry IS NOT NULL AND next_retry <= ? "
+            "ORDER BY next_retry LIMIT ?",
+            (time.time(), limit),
+        ).fetchall()
+        return [{"id": message_id, "threadId": thread_id} for message_id, thread_id in rows]
+
+    def parked(self) -> list[dict]:
+        """Messages no longer retried, with their last error."""
+        rows = self._db.execute(
+            "SELECT message_id, thread_id, error_class, error, attempts FROM failed "
+            "WHERE next_retry IS NULL"
+        ).fetchall()
+        return [
+            {
+                "id": message_id,
+                "threadId": thread_id,
+                "error_class": kind,
+                "error": error,
+                "attempts": attempts,
+            }
+            for message_id, thread_id, kind, error, attempts in rows
+        ]
+
+    def counts(self) -> dict[str, int]:
+        """Failures recorded so far, per error class."""
+        return dict(self._db.execute("SELECT error_class, count FROM failure_counts"))
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM failed").fetchone()[0]
+
+
+@lru_cache
+def get_dead_letters() -> DeadLetterStore:
+    """Process-wide dead-letter store, stored at `EAIA_DEAD_LETTER_DB` if set."""
+    return DeadLetterStore(db_path=os.getenv("EAIA_DEAD_LETTER_DB"))
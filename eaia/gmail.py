@@ -1,94 +1,51 @@
 import logging
-from datetime import datetime, timedelta, time
-from pathlib import Path
+import time
+from datetime import datetime
 from typing import Iterable
 import pytz
-import os
 
-from dateutil import parser
-from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 import base64
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import email.utils
 
-from langchain_core.tools import tool
 from pydantic import BaseModel, Field
 
+from eaia.dead_letter import DeadLetterStore
+from eaia.gmail_fetch import (
+    BATCH_SIZE,
+    BODY_PARAMS,
+    MESSAGE_PARAMS,
+    REPLY_HEADERS,
+    THREAD_PARAMS,
+    MessageFetch,
+    add_history_messages,
+    check_batch_size,
+    chunks,
+    due_retries,
+    history_order,
+    window_query,
+)
+from eaia.google_auth import registry
+from eaia.rate_limit import (
+    MAX_ATTEMPTS,
+    gmail_quota,
+    is_rate_limited,
+    is_retryable,
+    quota_for,
+    retry_delay,
+)
 from eaia.schemas import EmailData
 
 logger = logging.getLogger(__name__)
-_SCOPES = [
-    "https://www.googleapis.com/auth/gmail.modify",
-    "https://www.googleapis.com/auth/calendar",
-]
-_ROOT = Path(__file__).parent.absolute()
-_PORT = 54191
-_SECRETS_DIR = _ROOT / ".secrets"
-_SECRETS_PATH = str(_SECRETS_DIR / "secrets.json")
-_TOKEN_PATH = str(_SECRETS_DIR / "token.json")
 
 
 def get_credentials(
     gmail_token: str | None = None, gmail_secret: str | None = None
 ) -> Credentials:
-    creds = None
-    _SECRETS_DIR.mkdir(parents=True, exist_ok=True)
-    gmail_token = gmail_token or os.getenv("GMAIL_TOKEN")
-    if gmail_token:
-        with open(_TOKEN_PATH, "w") as token:
-            token.write(gmail_token)
-    gmail_secret = gmail_secret or os.getenv("GMAIL_SECRET")
-    if gmail_secret:
-        with open(_SECRETS_PATH, "w") as secret:
-            secret.write(gmail_secret)
-    if os.path.exists(_TOKEN_PATH):
-        creds = Credentials.from_authorized_user_file(_TOKEN_PATH)
-
-    if not creds or not creds.valid or not creds.has_scopes(_SCOPES):
-        if (
-            creds
-            and creds.expired
-            and creds.refresh_token
-            and creds.has_scopes(_SCOPES)
-        ):
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(_SECRETS_PATH, _SCOPES)
-            creds = flow.run_local_server(port=_PORT)
-        with open(_TOKEN_PATH, "w") as token:
-            token.write(creds.to_json())
-
-    return creds
-
-
-def extract_message_part(msg):
-    """Recursively walk through the email parts to find message body."""
-    if msg["mimeType"] == "text/plain":
-        body_data = msg.get("body", {}).get("data")
-        if body_data:
-            return base64.urlsafe_b64decode(body_data).decode("utf-8")
-    elif msg["mimeType"] == "text/html":
-        body_data = msg.get("body", {}).get("data")
-        if body_data:
-            return base64.urlsafe_b64decode(body_data).decode("utf-8")
-    if "parts" in msg:
-        for part in msg["parts"]:
-            body = extract_message_part(part)
-            if body:
-                return body
-    return "No message body available."
-
-
-def parse_time(send_time: str):
-    try:
-        parsed_time = parser.parse(send_time)
-        return parsed_time
-    except (ValueError, TypeError) as e:
-        raise ValueError(f"Error parsing time: {send_time} - {e}")
+    return registry.credentials(gmail_token, gmail_secret)
 
 
 def create_message(sender, to, subject, message_text, thread_id, original_message_id):
@@ -127,7 +84,7 @@ def get_recipients(
 
 
 def send_message(service, user_id, message):
-    message = service.users().messages().send(userId=user_id, body=message).execute()
+    message = _execute(service.users().messages().send(userId=user_id, body=message))
     return message
 
 
@@ -139,10 +96,17 @@ def send_email(
     gmail_secret: str | None = None,
     addn_receipients=None,
 ):
-    creds = get_credentials(gmail_token, gmail_secret)
-
-    service = build("gmail", "v1", credentials=creds)
-    message = service.users().messages().get(userId="me", id=email_id).execute()
+    service = registry.service("gmail", "v1", gmail_token, gmail_secret)
+    message = _execute(
+        service.users()
+        .messages()
+        .get(
+            userId="me",
+            id=email_id,
+            format="metadata",
+            metadataHeaders=REPLY_HEADERS,
+        )
+    )
 
     headers = message["payload"]["headers"]
     message_id = next(
@@ -165,105 +129,246 @@ def send_email(
     send_message(service, "me", response_message)
 
 
-def fetch_group_emails(
-    to_email,
-    minutes_since: int = 30,
-    gmail_token: str | None = None,
-    gmail_secret: str | None = None,
-) -> Iterable[EmailData]:
-    creds = get_credentials(gmail_token, gmail_secret)
+def _batch_execute(service, requests: dict, batch_size: int = BATCH_SIZE):
+    """Execute requests through the Gmail batch endpoint.
+
+    `requests` maps a unique key to an unexecuted `HttpRequest`. Requests are
+    sent `batch_size` at a time. Returns `(results, errors)` keyed the same way;
+    a failure of one item is recorded in `errors` and does not fail its chunk.
+    """
+    results = {}
+    errors = {}
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            errors[request_id] = exception
+        else:
+            results[request_id] = response
+
+    pending = list(requests.items())
+    for attempt in range(MAX_ATTEMPTS):
+        for chunk in chunks(pending, batch_size):
+            batch = service.new_batch_http_request(callback=callback)
+            for key, request in chunk:
+                quota, units = quota_for(request.methodId)
+                quota.acquire_sync(units)
+                batch.add(request, request_id=key)
+            try:
+                batch.execute()
+            except HttpError as e:
+                # The batch request itself failed; every item in it failed.
+                for key, _ in chunk:
+                    errors[key] = e
+        retry = [
+            (key, request)
+            for key, request in pending
+            if key in errors and _should_retry(errors[key], request.methodId)
+        ]
+        if not retry or attempt == MAX_ATTEMPTS - 1:
+            break
+        if any(_is_throttled(errors[key]) for key, _ in retry):
+            gmail_quota.throttle()
+        time.sleep(retry_delay(attempt))
+        for key, _ in retry:
+            del errors[key]
+        pending = retry
+    return results, errors
+
+
+def _should_retry(error: Exception, method_id: str | None) -> bool:
+    return isinstance(error, HttpError) and is_retryable(
+        error.resp.status, error.content, method_id
+    )
+
+
+def _is_throttled(error: Exception) -> bool:
+    return isinstance(error, HttpError) and is_rate_limited(
+        error.resp.status, error.content
+    )
+
 
-    service = build("gmail", "v1", credentials=creds)
-    after = int((datetime.now() - timedelta(minutes=minutes_since)).timestamp())
+def _execute(request):
+    """Execute one `HttpRequest` under the shared quota limiter.
 
-    query = f"(to:{to_email} OR from:{to_email}) after:{after}"
+    Throttled (429, 403 `rateLimitExceeded`) and 5xx responses are retried
+    with jittered exponential backoff.
+    """
+    quota, units = quota_for(request.methodId)
+    for attempt in range(MAX_ATTEMPTS):
+        quota.acquire_sync(units)
+        try:
+            return request.execute()
+        except HttpError as e:
+            if attempt == MAX_ATTEMPTS - 1 or not _should_retry(e, request.methodId):
+                raise e
+            if _is_throttled(e):
+                quota.throttle()
+            delay = retry_delay(attempt, e.resp.get("retry-after"))
+            logger.info(f"{request.methodId} returned {e.resp.status}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def _list_window_messages(service, to_email, minutes_since: int) -> list[dict]:
+    query = window_query(to_email, minutes_since)
     messages = []
     nextPageToken = None
     # Fetch messages matching the query
     while True:
-        results = (
+        results = _execute(
             service.users()
             .messages()
             .list(userId="me", q=query, pageToken=nextPageToken)
-            .execute()
         )
         if "messages" in results:
             messages.extend(results["messages"])
         nextPageToken = results.get("nextPageToken")
         if not nextPageToken:
             break
+    return messages
+
 
-    count = 0
-    for message in messages:
+def _list_history_messages(service, start_history_id: str) -> list[dict] | None:
+    """List messages added since `start_history_id`, newest first.
+
+    Returns None if Gmail no longer has history that far back (HTTP 404), in
+    which case the caller has to fall back to a full sync.
+    """
+    messages = {}
+    nextPageToken = None
+    while True:
         try:
-            msg = (
-                service.users().messages().get(userId="me", id=message["id"]).execute()
-            )
-            thread_id = msg["threadId"]
-            payload = msg["payload"]
-            headers = payload.get("headers")
-            # Get the thread details
-            thread = service.users().threads().get(userId="me", id=thread_id).execute()
-            messages_in_thread = thread["messages"]
-            # Check the last message in the thread
-            last_message = messages_in_thread[-1]
-            last_headers = last_message["payload"]["headers"]
-            from_header = next(
-                header["value"] for header in last_headers if header["name"] == "From"
-            )
-            last_from_header = next(
-                header["value"]
-                for header in last_message["payload"].get("headers")
-                if header["name"] == "From"
+            results = _execute(
+                service.users()
+                .history()
+                .list(
+                    userId="me",
+                    startHistoryId=start_history_id,
+                    historyTypes=["messageAdded"],
+                    pageToken=nextPageToken,
+                )
             )
-            if to_email in last_from_header:
-                yield {
-                    "id": message["id"],
-                    "thread_id": message["threadId"],
-                    "user_respond": True,
-                }
-            # Check if the last message was from you and if the current message is the last in the thread
-            if to_email not in from_header and message["id"] == last_message["id"]:
-                subject = next(
-                    header["value"] for header in headers if header["name"] == "Subject"
+        except HttpError as e:
+            if e.resp.status == 404:
+                return None
+            raise
+        add_history_messages(results, messages)
+        nextPageToken = results.get("nextPageToken")
+        if not nextPageToken:
+            break
+    return history_order(messages)
+
+
+def fetch_group_emails(
+    to_email,
+    minutes_since: int = 30,
+    gmail_token: str | None = None,
+    gmail_secret: str | None = None,
+    batch_size: int = BATCH_SIZE,
+    sync_state: dict | None = None,
+    dead_letters: DeadLetterStore | None = None,
+) -> Iterable[EmailData]:
+    """Fetch emails to or from `to_email`.
+
+    By default this lists every message in the last `minutes_since` minutes.
+    If `sync_state` is passed, it runs an incremental sync instead: only
+    messages added since `sync_state["history_id"]` are listed, through the
+    Gmail history API. When there is no history id yet, or it has expired,
+    it falls back to the windowed listing. `sync_state["history_id"]` is
+    updated once listing is done, and the caller is responsible for
+    persisting it.
+
+    With `dead_letters`, messages that fail are recorded there. Retry them
+    with `fetch_dead_letter_emails`.
+    """
+    check_batch_size(batch_size)
+    service = registry.service("gmail", "v1", gmail_token, gmail_secret)
+    messages = None
+    if sync_state is not None:
+        # Read the mailbox position before listing, so mail that arrives while
+        # this pass runs is picked up by the next one.
+        profile = _execute(service.users().getProfile(userId="me"))
+        if sync_state.get("history_id"):
+            messages = _list_history_messages(service, sync_state["history_id"])
+            if messages is None:
+                logger.info("Gmail history id expired, running a full sync.")
+        sync_state["history_id"] = profile["historyId"]
+    incremental = messages is not None
+    if not incremental:
+        messages = _list_window_messages(service, to_email, minutes_since)
+    yield from emails_from_messages(
+        service, to_email, messages, batch_size, incremental, dead_letters
+    )
+
+
+def fetch_dead_letter_emails(
+    to_email,
+    dead_letters: DeadLetterStore,
+    gmail_token: str | None = None,
+    gmail_secret: str | None = None,
+    batch_size: int = BATCH_SIZE,
+) -> Iterable[EmailData]:
+    """Fetch the failed messages in `dead_letters` that are due for a retry.
+
+    Run this as its own pass, dispatched without `early` (see `due_retries`).
+    """
+    service = registry.service("gmail", "v1", gmail_token, gmail_secret)
+    # A retry may come from an unfiltered history listing, hence `incremental`.
+    yield from emails_from_messages(
+        service, to_email, due_retries(dead_letters), batch_size, True, dead_letters
+    )
+
+
+def emails_from_messages(
+    service,
+    to_email,
+    messages: list[dict],
+    batch_size: int = BATCH_SIZE,
+    incremental: bool = False,
+    dead_letters: DeadLetterStore | None = None,
+) -> Iterable[EmailData]:
+    """Fetch and yield the emails for already listed `{id, threadId}` messages.
+
+    Each tier of a chunk is one or a few batch round trips instead of a request
+    per message; see `MessageFetch`.
+    """
+    fetch = MessageFetch(to_email, messages, batch_size, incremental, dead_letters)
+    messages_api = service.users().messages()
+    for chunk in fetch.chunks():
+        msgs, msg_errors = _batch_execute(
+            service,
+            {
+                message["id"]: messages_api.get(
+                    userId="me", id=message["id"], **MESSAGE_PARAMS
+                )
+                for message in chunk
+            },
+            batch_size,
+        )
+        threads, thread_errors = _batch_execute(
+            service,
+            {
+                thread_id: service.users().threads().get(
+                    userId="me", id=thread_id, **THREAD_PARAMS
                 )
-                from_email = next(
-                    (header["value"] for header in headers if header["name"] == "From"),
-                    "",
-                ).strip()
-                _to_email = next(
-                    (header["value"] for header in headers if header["name"] == "To"),
-                    "",
-                ).strip()
-                if reply_to := next(
-                    (
-                        header["value"]
-                        for header in headers
-                        if header["name"] == "Reply-To"
-                    ),
-                    "",
-                ).strip():
-                    from_email = reply_to
-                send_time = next(
-                    header["value"] for header in headers if header["name"] == "Date"
+                for thread_id in fetch.thread_ids(msgs)
+            },
+            batch_size,
+        )
+        fetch.add_threads(threads.values())
+        bodies, body_errors = _batch_execute(
+            service,
+            {
+                message_id: messages_api.get(
+                    userId="me", id=message_id, **BODY_PARAMS
                 )
-                # Only process emails that are less than an hour old
-                parsed_time = parse_time(send_time)
-                body = extract_message_part(payload)
-                yield {
-                    "from_email": from_email,
-                    "to_email": _to_email,
-                    "subject": subject,
-                    "page_content": body,
-                    "id": message["id"],
-                    "thread_id": message["threadId"],
-                    "send_time": parsed_time.isoformat(),
-                }
-                count += 1
-        except Exception:
-            logger.info(f"Failed on {message}")
-
-    logger.info(f"Found {count} emails.")
+                for message_id in fetch.body_ids(msgs)
+            },
+            batch_size,
+        )
+        yield from fetch.emails(
+            chunk, msgs, msg_errors, thread_errors, bodies, body_errors
+        )
+    fetch.log_summary()
 
 
 def mark_as_read(
@@ -271,12 +376,12 @@ def mark_as_read(
     gmail_token: str | None = None,
     gmail_secret: str | None = None,
 ):
-    creds = get_credentials(gmail_token, gmail_secret)
-
-    service = build("gmail", "v1", credentials=creds)
-    service.users().messages().modify(
-        userId="me", id=message_id, body={"removeLabelIds": ["UNREAD"]}
-    ).execute()
+    service = registry.service("gmail", "v1", gmail_token, gmail_secret)
+    _execute(
+        service.users().messages().modify(
+            userId="me", id=message_id, body={"removeLabelIds": ["UNREAD"]}
+        )
+    )
 
 
 class CalInput(BaseModel):
@@ -285,44 +390,13 @@ class CalInput(BaseModel):
     )
 
 
-@tool(args_schema=CalInput)
-def get_events_for_days(date_strs: list[str]):
-    """
-    Retrieves events for a list of days. If you want to check for multiple days, call this with multiple inputs.
-
-    Input in the format of ['dd-mm-yyyy', 'dd-mm-yyyy']
-
-    Args:
-    date_strs: The days for which to retrieve events (dd-mm-yyyy string).
-
-    Returns: availability for those days.
-    """
-
-    creds = get_credentials(None, None)
-    service = build("calendar", "v3", credentials=creds)
-    results = ""
-    for date_str in date_strs:
-        # Convert the date string to a datetime.date object
-        day = datetime.strptime(date_str, "%d-%m-%Y").date()
-
-        start_of_day = datetime.combine(day, time.min).isoformat() + "Z"
-        end_of_day = datetime.combine(day, time.max).isoformat() + "Z"
-
-        events_result = (
-            service.events()
-            .list(
-                calendarId="primary",
-                timeMin=start_of_day,
-                timeMax=end_of_day,
-                singleEvents=True,
-                orderBy="startTime",
-            )
-            .execute()
-        )
-        events = events_result.get("items", [])
-
-        results += f"***FOR DAY {date_str}***\n\n" + print_events(events)
-    return results
+def freebusy_body(time_min: datetime, time_max: datetime, tz) -> dict:
+    return {
+        "timeMin": time_min.isoformat(),
+        "timeMax": time_max.isoformat(),
+        "timeZone": tz.zone,
+        "items": [{"id": "primary"}],
+    }
 
 
 def format_datetime_with_timezone(dt_str, timezone="US/Pacific"):
@@ -370,12 +444,8 @@ def print_events(events):
     return result
 
 
-def send_calendar_invite(
-    emails, title, start_time, end_time, email_address, timezone="PST"
-):
-    creds = get_credentials(None, None)
-    service = build("calendar", "v3", credentials=creds)
-
+def calendar_event(emails, title, start_time, end_time, email_address, timezone):
+    """Build the Calendar `events.insert` body for a meeting invite."""
     # Parse the start and end times
     start_datetime = datetime.fromisoformat(start_time)
     end_datetime = datetime.fromisoformat(end_time)
@@ -405,15 +475,4 @@ def send_calendar_invite(
             }
         },
     }
-
-    try:
-        service.events().insert(
-            calendarId="primary",
-            body=event,
-            sendNotifications=True,
-            conferenceDataVersion=1,
-        ).execute()
-        return True
-    except Exception as e:
-        logger.info(f"An error occurred while sending the calendar invite: {e}")
-        return False
+    return event
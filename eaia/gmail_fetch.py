@@ -0,0 +1,441 @@
+"""
+gmail_fetch.py
+
+Transport-independent parts of fetching emails from Gmail.
+
+`eaia.gmail` (googleapiclient, batch endpoint) and `eaia.async_gmail`
+(httpx, concurrent requests) only differ in how they send requests. The
+listing query, the history filtering, the request parameters of each fetch
+tier, the thread index, burst coalescing and the dead-letter bookkeeping all
+live here, so both transports build exactly the same emails.
+"""
+import base64
+import html
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator
+
+from dateutil import parser
+from typing_extensions import TypedDict
+
+from eaia.dead_letter import DeadLetterStore
+from eaia.schemas import CoalescedMessage, EmailData
+
+logger = logging.getLogger(__name__)
+
+# Gmail accepts up to 100 calls per batch request but recommends at most 50.
+BATCH_SIZE = 50
+MAX_BATCH_SIZE = 100
+# Store namespace holding the last synced Gmail `historyId` per mailbox.
+SYNC_NAMESPACE = ("gmail_sync",)
+# Labels of history results that `messages.list` leaves out by default.
+_SKIPPED_LABELS = {"DRAFT", "SPAM", "TRASH"}
+# Headers checked to replicate the `to:... OR from:...` search for history results.
+_ADDRESS_HEADERS = ("From", "To", "Cc", "Delivered-To")
+# Headers passed along in `EmailData["headers"]` for the triage rules.
+_RULE_HEADERS = ["List-Unsubscribe", "List-Id", "Auto-Submitted", "Precedence"]
+# Listing and thread-tail checks only download these headers; full bodies are
+# fetched separately, and only for messages that will be dispatched.
+_METADATA_HEADERS = [
+    "From",
+    "To",
+    "Cc",
+    "Subject",
+    "Date",
+    "Reply-To",
+    "Delivered-To",
+    *_RULE_HEADERS,
+]
+# Parameters of the three fetch tiers: `messages.get` metadata, `threads.get`
+# metadata and `messages.get` bodies.
+MESSAGE_PARAMS = {
+    "format": "metadata",
+    "metadataHeaders": _METADATA_HEADERS,
+    "fields": "id,threadId,historyId,labelIds,payload/headers",
+}
+THREAD_PARAMS = {
+    "format": "metadata",
+    "metadataHeaders": ["From"],
+    "fields": "id,historyId,messages(id,snippet,payload/headers)",
+}
+BODY_PARAMS = {"format": "full", "fields": "id,payload"}
+REPLY_HEADERS = ["Message-ID", "Subject", "From", "To", "Cc"]
+
+
+def check_batch_size(batch_size: int) -> None:
+    if not 1 <= batch_size <= MAX_BATCH_SIZE:
+        raise ValueError(
+            f"batch_size must be between 1 and {MAX_BATCH_SIZE}, got {batch_size}"
+        )
+
+
+def chunks(items: list, size: int) -> Iterable[list]:
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def window_query(to_email: str, minutes_since: int) -> str:
+    """`messages.list` query for mail to or from `to_email` in the window."""
+    after = int((datetime.now() - timedelta(minutes=minutes_since)).timestamp())
+    return f"(to:{to_email} OR from:{to_email}) after:{after}"
+
+
+def add_history_messages(results: dict, messages: dict) -> None:
+    """Collect the messages added in one `history.list` page, except drafts,
+    spam and trash, which the windowed `messages.list` query never returns."""
+    for record in results.get("history", []):
+        for added in record.get("messagesAdded", []):
+            message = added["message"]
+            if _SKIPPED_LABELS.intersection(message.get("labelIds", [])):
+                continue
+            messages.setdefault(
+                message["id"],
+                {"id": message["id"], "threadId": message["threadId"]},
+            )
+
+
+def history_order(messages: dict) -> list[dict]:
+    # History is returned oldest first, `messages.list` newest first.
+    return list(reversed(messages.values()))
+
+
+def due_retries(dead_letters: DeadLetterStore) -> list[dict]:
+    """Dead letters due for a retry, fetched by id in their own pass.
+
+    Retries are older than the newest listed mail, so a listing pass that
+    stops at the first email it already dispatched would rarely reach them.
+    """
+    retries = dead_letters.due()
+    if retries:
+        logger.info(f"Retrying {len(retries)} failed messages.")
+    return retries
+
+
+def is_addressed(msg, to_email) -> bool:
+    return any(
+        to_email in header["value"]
+        for header in msg["payload"].get("headers", [])
+        if header["name"] in _ADDRESS_HEADERS
+    )
+
+
+def extract_message_part(msg):
+    """Recursively walk through the email parts to find message body."""
+    if msg["mimeType"] == "text/plain":
+        body_data = msg.get("body", {}).get("data")
+        if body_data:
+            return base64.urlsafe_b64decode(body_data).decode("utf-8")
+    elif msg["mimeType"] == "text/html":
+        body_data = msg.get("body", {}).get("data")
+        if body_data:
+            return base64.urlsafe_b64decode(body_data).decode("utf-8")
+    if "parts" in msg:
+        for part in msg["parts"]:
+            body = extract_message_part(part)
+            if body:
+                return body
+    return "No message body available."
+
+
+def parse_time(send_time: str):
+    try:
+        parsed_time = parser.parse(send_time)
+        return parsed_time
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Error parsing time: {send_time} - {e}")
+
+
+class ThreadSummary(TypedDict):
+    history_id: int
+    last_message_id: str
+    user_respond: bool
+    # Sender and snippet of every message, in thread order
+    messages: dict[str, CoalescedMessage]
+
+
+class ThreadIndex:
+    """Threads fetched during one ingest pass, keyed by thread id.
+
+    The "last message in thread" and `user_respond` decisions are computed once
+    per thread when it is added, and shared by every message in that thread.
+    A cached thread is only reused while its `historyId` is at least that of
+    the message asking for it - a newer message means the thread changed after
+    it was fetched.
+    """
+
+    def __init__(self, to_email: str):
+        self.to_email = to_email
+        self._threads: dict[str, ThreadSummary] = {}
+
+    def is_fresh(self, msg) -> bool:
+        summary = self._threads.get(msg["threadId"])
+        if summary is None:
+            return False
+        return summary["history_id"] >= int(msg.get("historyId") or 0)
+
+    def add(self, thread) -> ThreadSummary:
+        last_message = thread["messages"][-1]
+        last_from_header = next(
+            header["value"]
+            for header in last_message["payload"]["headers"]
+            if header["name"] == "From"
+        )
+        summary: ThreadSummary = {
+            "history_id": int(thread.get("historyId") or 0),
+            "last_message_id": last_message["id"],
+            "user_respond": self.to_email in last_from_header,
+            "messages": {
+                message["id"]: {
+                    "id": message["id"],
+                    "from_email": next(
+                        (
+                            header["value"]
+                            for header in message["payload"].get("headers", [])
+                            if header["name"] == "From"
+                        ),
+                        "",
+                    ),
+                    "snippet": html.unescape(message.get("snippet", "")),
+                }
+                for message in thread["messages"]
+            },
+        }
+        self._threads[thread["id"]] = summary
+        return summary
+
+    def __contains__(self, thread_id: str) -> bool:
+        return thread_id in self._threads
+
+    def __getitem__(self, thread_id: str) -> ThreadSummary:
+        return self._threads[thread_id]
+
+
+def needs_body(msg, summary: ThreadSummary) -> bool:
+    """Whether `msg` will be dispatched, and so needs its full body fetched."""
+    return not summary["user_respond"] and msg["id"] == summary["last_message_id"]
+
+
+def emails_from_message(
+    message, msg, summary: ThreadSummary, body: dict | None = None
+) -> Iterable[EmailData]:
+    """Build the emails for one listed message.
+
+    `msg` only needs the metadata headers; `body` is the `format=full` message,
+    required when `needs_body` is true.
+    """
+    headers = msg["payload"].get("headers")
+    if summary["user_respond"]:
+        yield {
+            "id": message["id"],
+            "thread_id": message["threadId"],
+            "user_respond": True,
+        }
+    # Check if the last message was from you and if the current message is the last in the thread
+    elif message["id"] == summary["last_message_id"]:
+        subject = next(
+            header["value"] for header in headers if header["name"] == "Subject"
+        )
+        from_email = sender = next(
+            (header["value"] for header in headers if header["name"] == "From"),
+            "",
+        ).strip()
+        _to_email = next(
+            (header["value"] for header in headers if header["name"] == "To"),
+            "",
+        ).strip()
+        if reply_to := next(
+            (header["value"] for header in headers if header["name"] == "Reply-To"),
+            "",
+        ).strip():
+            from_email = reply_to
+        send_time = next(
+            header["value"] for header in headers if header["name"] == "Date"
+        )
+        # Only process emails that are less than an hour old
+        parsed_time = parse_time(send_time)
+        email_data: EmailData = {
+            "from_email": from_email,
+            "to_email": _to_email,
+            "subject": subject,
+            "page_content": extract_message_part(body["payload"]),
+            "id": message["id"],
+            "thread_id": message["threadId"],
+            "send_time": parsed_time.isoformat(),
+        }
+        rule_headers = {
+            header["name"]: header["value"]
+            for header in headers
+            if header["name"] in _RULE_HEADERS
+        }
+        if reply_to:
+            # `from_email` holds the Reply-To address; keep the real sender too.
+            rule_headers["From"] = sender
+        if rule_headers:
+            email_data["headers"] = rule_headers
+        yield email_data
+
+
+class ThreadBursts:
+    """Listed messages grouped by thread, so a burst of replies yields one email.
+
+    Only the thread's last message is dispatched; the other listed messages of
+    that thread are attached to it as `coalesced_ids`, with their senders and
+    snippets as `coalesced_messages`, instead of launching runs that would be
+    rolled back. A thread the user replied to last yields a single
+    `user_respond` entry.
+    """
+
+    def __init__(self, messages: list[dict]):
+        self._listed: dict[str, list[str]] = defaultdict(list)
+        for message in messages:
+            self._listed[message["threadId"]].append(message["id"])
+        self._responded: set[str] = set()
+
+    def coalesce(
+        self, email_data: EmailData, summary: ThreadSummary | None = None
+    ) -> EmailData | None:
+        thread_id = email_data["thread_id"]
+        if "user_respond" in email_data:
+            if thread_id in self._responded:
+                return None
+            self._responded.add(thread_id)
+            return email_data
+        coalesced = [i for i in self._listed[thread_id] if i != email_data["id"]]
+        if coalesced:
+            email_data["coalesced_ids"] = coalesced
+            if summary is not None:
+                email_data["coalesced_messages"] = [
+                    message
+                    for message_id, message in summary["messages"].items()
+                    if message_id in coalesced
+                ]
+        return email_data
+
+
+class MessageFetch:
+    """Fetching the emails of already listed `{id, threadId}` messages.
+
+    A transport drives it a chunk at a time, sending the requests of each
+    tier itself:
+
+        for chunk in fetch.chunks():
+            msgs, msg_errors = <messages.get of the chunk, MESSAGE_PARAMS>
+            threads, thread_errors = <threads.get of fetch.thread_ids(msgs), THREAD_PARAMS>
+            fetch.add_threads(threads.values())
+            bodies, body_errors = <messages.get of fetch.body_ids(msgs), BODY_PARAMS>
+            yield from fetch.emails(chunk, msgs, msg_errors, thread_errors, bodies, body_errors)
+        fetch.log_summary()
+
+    Each thread is downloaded once per pass, however many of its messages were
+    listed. With `incremental`, messages not addressed to or from `to_email`,
+    and spam or trash, are skipped before their thread is fetched, as the
+    listing did not filter them. Failed messages are
+    recorded in `dead_letters`, if given, and the others cleared from it, even
+    when the consumer stops early.
+    """
+
+    def __init__(
+        self,
+        to_email: str,
+        messages: list[dict],
+        batch_size: int = BATCH_SIZE,
+        incremental: bool = False,
+        dead_letters: DeadLetterStore | None = None,
+    ):
+        check_batch_size(batch_size)
+        self.to_email = to_email
+        self.messages = messages
+        self.batch_size = batch_size
+        self.incremental = incremental
+        self.dead_letters = dead_letters
+        self.count = 0
+        self._threads = ThreadIndex(to_email)
+        self._bursts = ThreadBursts(messages)
+
+    def chunks(self) -> Iterable[list[dict]]:
+        return chunks(self.messages, self.batch_size)
+
+    def _wanted(self, msg) -> bool:
+        # Retries come by id, and may have been moved to spam or trash since.
+        return not self.incremental or (
+            is_addressed(msg, self.to_email)
+            and not _SKIPPED_LABELS.intersection(msg.get("labelIds", []))
+        )
+
+    def thread_ids(self, msgs: dict) -> list[str]:
+        """Threads to fetch for a chunk's wanted messages: those not fetched
+        yet, or changed since."""
+        return list(
+            dict.fromkeys(
+                msg["threadId"]
+                for msg in msgs.values()
+                if self._wanted(msg) and not self._threads.is_fresh(msg)
+            )
+        )
+
+    def add_threads(self, threads: Iterable[dict]) -> None:
+        for thread in threads:
+            self._threads.add(thread)
+
+    def body_ids(self, msgs: dict) -> list[str]:
+        """Messages of a chunk that will be dispatched, and need their body."""
+        return [
+            msg["id"]
+            for msg in msgs.values()
+            if msg["threadId"] in self._threads
+            and needs_body(msg, self._threads[msg["threadId"]])
+            and self._wanted(msg)
+        ]
+
+    def emails(
+        self,
+        chunk: list[dict],
+        msgs: dict,
+        msg_errors: dict,
+        thread_errors: dict,
+        bodies: dict,
+        body_errors: dict,
+    ) -> Iterator[EmailData]:
+        """Yield the emails of one fetched chunk and settle its dead letters."""
+        failures = {}
+        # Messages before this position are done. If the consumer stops at a
+        # yield, the message being yielded stays as it was in `dead_letters`.
+        settled = 0
+        try:
+            for settled, message in enumerate(chunk):
+                try:
+                    if message["id"] in msg_errors:
+                        raise msg_errors[message["id"]]
+                    msg = msgs[message["id"]]
+                    if not self._wanted(msg):
+                        continue
+                    if msg["threadId"] in thread_errors:
+                        raise thread_errors[msg["threadId"]]
+                    if message["id"] in body_errors:
+                        raise body_errors[message["id"]]
+                    summary = self._threads[msg["threadId"]]
+                    for email_data in emails_from_message(
+                        message, msg, summary, bodies.get(message["id"])
+                    ):
+                        email_data = self._bursts.coalesce(email_data, summary)
+                        if email_data is None:
+                            continue
+                        yield email_data
+                        if "user_respond" not in email_data:
+                            self.count += 1
+                except Exception as e:
+                    logger.info(f"Failed on {message}")
+                    failures[message["id"]] = e
+            settled = len(chunk)
+        finally:
+            if self.dead_letters is not None:
+                self.dead_letters.settle(chunk[:settled], failures)
+
+    def log_summary(self) -> None:
+        logger.info(f"Found {self.count} emails.")
+        if self.dead_letters is not None and len(self.dead_letters):
+            logger.info(
+                f"{len(self.dead_letters)} messages in the dead-letter store; "
+                f"failures by class: {self.dead_letters.counts()}"
+            )
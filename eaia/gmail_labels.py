@@ -0,0 +1,135 @@
+"""
+gmail_labels.py
+
+Coalescing queue for Gmail label changes.
+
+Marking mail as read used to cost one `messages.modify` call per email. Here
+label changes are collected for a short window, grouped by the exact set of
+labels they add and remove, and flushed with `users.messages.batchModify`
+(up to 1000 message ids per call).
+"""
+import asyncio
+import logging
+from typing import Sequence
+
+logger = logging.getLogger(__name__)
+
+# Labels applied for triage outcomes when `triage_labels` is enabled in config.
+TRIAGE_LABELS = {
+    "no": "eaia/ignored",
+    "notify": "eaia/notify",
+}
+# System label ids can be used as-is, without a `labels.list` lookup.
+_SYSTEM_LABELS = {"INBOX", "UNREAD", "STARRED", "IMPORTANT", "SPAM", "TRASH"}
+# Gmail's limit on ids per `batchModify` call.
+_MAX_IDS = 1000
+_WINDOW_SECONDS = 0.5
+
+
+class LabelWriteQueue:
+    """Collects label changes and flushes them with `batchModify`.
+
+    `client` is an `eaia.async_gmail.AsyncGoogleClient`. Labels can be given by
+    id (system labels such as `UNREAD` or `INBOX`) or by name; unknown names
+    are created on first use.
+    """
+
+    def __init__(
+        self,
+        client,
+        window: float = _WINDOW_SECONDS,
+        max_ids: int = _MAX_IDS,
+    ):
+        self.client = client
+        self.window = window
+        self.max_ids = max_ids
+        self._pending: dict[tuple, list[tuple[str, asyncio.Future]]] = {}
+        self._timer: asyncio.TimerHandle | None = None
+        # Running flush tasks, referenced until done so they are not collected.
+        self._tasks: set[asyncio.Task] = set()
+        self._label_ids: dict[str, str] | None = None
+        self._label_lock = asyncio.Lock()
+
+    async def modify(
+        self,
+        message_id: str,
+        add: Sequence[str] = (),
+        remove: Sequence[str] = (),
+    ) -> None:
+        """Queue a label change and wait until the batch containing it is sent."""
+        if not add and not remove:
+            return
+        key = (tuple(sorted(set(add))), tuple(sorted(set(remove))))
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(key, []).append((message_id, future))
+        if sum(len(items) for items in self._pending.values()) >= self.max_ids:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.window)
+        await future
+
+    def _schedule(self, delay: float) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        loop = asyncio.get_running_loop()
+        self._timer = loop.call_later(delay, self._start_flush)
+
+    def _start_flush(self) -> None:
+        task = asyncio.get_running_loop().create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Label flush failed", exc_info=task.exception())
+
+    async def flush(self) -> None:
+        """Send everything queued so far."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, {}
+        for (add, remove), items in pending.items():
+            try:
+                add_ids = await self._resolve(add)
+                remove_ids = await self._resolve(remove)
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            # One message may be queued twice with the same change.
+            message_ids = list(dict.fromkeys(message_id for message_id, _ in items))
+            failed = {}
+            for i in range(0, len(message_ids), self.max_ids):
+                chunk = message_ids[i : i + self.max_ids]
+                try:
+                    await self.client.batch_modify(chunk, add_ids, remove_ids)
+                except Exception as e:
+                    logger.info(f"batchModify failed for {len(chunk)} messages: {e}")
+                    failed.update(dict.fromkeys(chunk, e))
+            for message_id, future in items:
+                if future.done():
+                    continue
+                if message_id in failed:
+                    future.set_exception(failed[message_id])
+                else:
+                    future.set_result(None)
+
+    async def _resolve(self, labels: Sequence[str]) -> list[str]:
+        """Map label names to ids, creating user labels that do not exist yet."""
+        if all(label in _SYSTEM_LABELS for label in labels):
+            return list(labels)
+        async with self._label_lock:
+            if self._label_ids is None:
+                response = await self.client.list_labels()
+                self._label_ids = {}
+                for label in response.get("labels", []):
+                    self._label_ids[label["name"]] = label["id"]
+                    self._label_ids[label["id"]] = label["id"]
+            for label in labels:
+                if label not in self._label_ids:
+                    created = await self.client.create_label(label)
+                    self._label_ids[label] = created["id"]
+            return [self._label_ids[label] for label in labels]
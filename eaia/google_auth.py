@@ -0,0 +1,142 @@
+"""
+google_auth.py
+
+Process-wide registry of Google credentials and API service objects.
+
+Credentials are loaded once per (token, secret) pair and refreshed shortly
+before they expire. Concurrent callers share a single refresh, and the token
+file is only rewritten when the token actually changed. `build(...)` service
+objects are cached too, using the discovery documents bundled with
+`googleapiclient` instead of fetching them.
+"""
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.discovery import build
+
+logger = logging.getLogger(__name__)
+
+SCOPES = [
+    "https://www.googleapis.com/auth/gmail.modify",
+    "https://www.googleapis.com/auth/calendar",
+]
+_ROOT = Path(__file__).parent.absolute()
+_PORT = 54191
+SECRETS_DIR = _ROOT / ".secrets"
+SECRETS_PATH = str(SECRETS_DIR / "secrets.json")
+TOKEN_PATH = str(SECRETS_DIR / "token.json")
+# Refresh this long before the token expires, so requests never race expiry.
+_REFRESH_MARGIN = timedelta(minutes=5)
+
+
+class CredentialRegistry:
+    """Caches credentials and service objects for the lifetime of the process."""
+
+    def __init__(self, refresh_margin: timedelta = _REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._refresh_locks: dict[tuple, threading.Lock] = {}
+        self._credentials: dict[tuple, Credentials] = {}
+        # httplib2 is not thread-safe, so each thread gets its own services.
+        self._local = threading.local()
+
+    def _key(self, gmail_token: str | None, gmail_secret: str | None) -> tuple:
+        return (
+            gmail_token or os.getenv("GMAIL_TOKEN"),
+            gmail_secret or os.getenv("GMAIL_SECRET"),
+        )
+
+    def credentials(
+        self, gmail_token: str | None = None, gmail_secret: str | None = None
+    ) -> Credentials:
+        """Return valid credentials, loading them on first use."""
+        key = self._key(gmail_token, gmail_secret)
+        with self._lock:
+            creds = self._credentials.get(key)
+            if creds is None:
+                creds = self._credentials[key] = self._load(*key)
+                self._refresh_locks[key] = threading.Lock()
+            refresh_lock = self._refresh_locks[key]
+        if self.needs_refresh(creds):
+            # Single flight: whoever gets the lock refreshes, the rest reuse it.
+            with refresh_lock:
+                if self.needs_refresh(creds):
+                    self._refresh(creds)
+        return creds
+
+    def needs_refresh(self, creds: Credentials) -> bool:
+        if not creds.token or creds.expiry is None:
+            return not creds.valid
+        # `Credentials.expiry` is a naive UTC datetime.
+        expiry = creds.expiry.replace(tzinfo=timezone.utc)
+        return expiry - self.refresh_margin <= datetime.now(timezone.utc)
+
+    def service(
+        self,
+        api: str,
+        version: str,
+        gmail_token: str | None = None,
+        gmail_secret: str | None = None,
+    ):
+        """Return a cached `build(api, version)` service for the calling thread."""
+        creds = self.credentials(gmail_token, gmail_secret)
+        services = self._local.__dict__.setdefault("services", {})
+        key = (api, version, self._key(gmail_token, gmail_secret))
+        if key not in services:
+            services[key] = build(
+                api,
+                version,
+                credentials=creds,
+                static_discovery=True,
+                cache_discovery=False,
+            )
+        return services[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._credentials.clear()
+            self._refresh_locks.clear()
+        self._local = threading.local()
+
+    def _load(self, gmail_token: str | None, gmail_secret: str | None) -> Credentials:
+        creds = None
+        if gmail_token:
+            creds = Credentials.from_authorized_user_info(json.loads(gmail_token))
+        elif os.path.exists(TOKEN_PATH):
+            creds = Credentials.from_authorized_user_file(TOKEN_PATH)
+
+        if creds and creds.has_scopes(SCOPES) and (creds.valid or creds.refresh_token):
+            return creds
+        if gmail_secret:
+            flow = InstalledAppFlow.from_client_config(json.loads(gmail_secret), SCOPES)
+        else:
+            flow = InstalledAppFlow.from_client_secrets_file(SECRETS_PATH, SCOPES)
+        creds = flow.run_local_server(port=_PORT)
+        self._persist(creds)
+        return creds
+
+    def _refresh(self, creds: Credentials) -> None:
+        previous = creds.token
+        creds.refresh(Request())
+        if creds.token != previous:
+            self._persist(creds)
+
+    def _persist(self, creds: Credentials) -> None:
+        SECRETS_DIR.mkdir(parents=True, exist_ok=True)
+        data = creds.to_json()
+        if os.path.exists(TOKEN_PATH):
+            with open(TOKEN_PATH) as token:
+                if token.read() == data:
+                    return
+        with open(TOKEN_PATH, "w") as token:
+            token.write(data)
+
+
+registry = CredentialRegistry()
@@ -0,0 +1,248 @@
+"""
+ingest.py
+
+Dispatches fetched emails to the `main` graph through the LangGraph SDK.
+
+Shared by the cron graph and `scripts/run_ingest.py`. Gmail fetching feeds
+per-worker queues while N workers make the SDK calls (`threads.get`,
+`threads.update`, `runs.create`) concurrently. Emails are sharded by thread,
+so two messages of the same thread are always handled by the same worker, in
+the order they were fetched.
+
+With a `triage` function, fetched emails are first grouped into batches of
+`triage_batch_size` and triaged with one call per batch. Each result travels
+with its run input as `precomputed_triage`. In an early-stopping pass a batch
+is only triaged once the workers have handled the previous one, and an email
+the ledger already knows ends the pass before anything after it is triaged.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+import zlib
+from functools import lru_cache
+from typing import AsyncIterator, Awaitable, Callable
+
+import httpx
+
+from eaia.ledger import DispatchLedger
+from eaia.schemas import EmailData, RespondTo
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 8
+# Per-worker backlog; the Gmail producer waits once a worker is this far behind.
+_QUEUE_SIZE = 32
+
+TriageBatch = Callable[[list[EmailData]], Awaitable[dict[str, RespondTo]]]
+
+
+def thread_uuid(gmail_thread_id: str) -> str:
+    """LangGraph thread id for a Gmail thread."""
+    return str(uuid.UUID(hex=hashlib.md5(gmail_thread_id.encode("UTF-8")).hexdigest()))
+
+
+@lru_cache
+def get_ledger() -> DispatchLedger:
+    """Process-wide dispatch ledger, stored at `EAIA_LEDGER_DB` if set."""
+    return DispatchLedger(db_path=os.getenv("EAIA_LEDGER_DB"))
+
+
+async def dispatch_email(
+    client,
+    email: EmailData,
+    rerun: bool = False,
+    ledger: DispatchLedger | None = None,
+    triage: RespondTo | None = None,
+    assistant_id: str = "main",
+) -> bool:
+    """Start a `main` run for one email, on `assistant_id` (an assistant ID,
+    or a graph ID for its default assistant).
+
+    Returns False, without dispatching, if the thread's latest dispatched email
+    is this one (unless `rerun` is set). With a `ledger`, emails it knows were
+    dispatched are reported as seen without asking the LangGraph server. A
+    `triage` result is passed to the run so it skips its own triage LLM call.
+    """
+    if (
+        ledger is not None
+        and not rerun
+        and "user_respond" not in email
+        and ledger.contains(email["thread_id"], email["id"])
+    ):
+        return False
+    thread_id = thread_uuid(email["thread_id"])
+    try:
+        thread_info = await client.threads.get(thread_id)
+    except httpx.HTTPStatusError as e:
+        if "user_respond" in email:
+            return True
+        if e.response.status_code == 404:
+            thread_info = await client.threads.create(thread_id=thread_id)
+        else:
+            raise e
+    if "user_respond" in email:
+        await client.threads.update_state(thread_id, None, as_node="__end__")
+        return True
+    recent_email = thread_info["metadata"].get("email_id")
+    if recent_email == email["id"] and not rerun:
+        if ledger is not None:
+            ledger.add(email["thread_id"], email["id"])
+        return False
+    run_input = {"email": email}
+    if triage is not None:
+        run_input["precomputed_triage"] = {"email_id": email["id"], **triage.model_dump()}
+    await client.runs.create(
+        thread_id,
+        assistant_id,
+        input=run_input,
+        multitask_strategy="rollback",
+    )
+    # Only mark the email seen once its run exists, so a crash in between
+    # leads to a retry rather than a lost email.
+    await client.threads.update(thread_id, metadata={"email_id": email["id"]})
+    if ledger is not None:
+        ledger.add(email["thread_id"], email["id"])
+    return True
+
+
+async def dispatch_emails(
+    client,
+    emails: AsyncIterator[EmailData],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    early: bool = True,
+    rerun: bool = False,
+    ledger: DispatchLedger | None = None,
+    triage: TriageBatch | None = None,
+    triage_batch_size: int = 0,
+    assistant_id: str = "main",
+) -> int:
+    """Dispatch emails with `concurrency` workers; returns the number dispatched.
+
+    With `early`, reaching an already dispatched email stops the pass: nothing
+    more is fetched and queued emails are dropped. Emails already being
+    handled by other workers still finish. Without `early`, seen emails are
+    skipped, or dispatched again if `rerun` is set.
+
+    With `triage` and a `triage_batch_size` above 1, emails are triaged in
+    batches before they are queued. With `early`, each batch waits for the
+    previous one to be dispatched, so no batch past the stop is triaged.
+    """
+    queues = [asyncio.Queue(maxsize=_QUEUE_SIZE) for _ in range(concurrency)]
+    stop = asyncio.Event()
+    errors: list[BaseException] = []
+    dispatched = 0
+
+    async def worker(queue: asyncio.Queue):
+        nonlocal dispatched
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            try:
+                if stop.is_set():
+                    continue
+                email, result = item
+                if await dispatch_email(
+                    client,
+                    email,
+                    rerun=rerun and not early,
+                    ledger=ledger,
+                    triage=result,
+                    assistant_id=assistant_id,
+                ):
+                    if "user_respond" not in email:
+                        dispatched += 1
+                elif early:
+                    stop.set()
+            except Exception as e:
+                # Keep draining so the producer never blocks on a dead worker.
+                errors.append(e)
+                stop.set()
+            finally:
+                queue.task_done()
+
+    async def drained():
+        await asyncio.gather(*(queue.join() for queue in queues))
+
+    workers = [asyncio.create_task(worker(queue)) for queue in queues]
+    if triage is not None and triage_batch_size > 1:
+        items = _triaged(
+            emails,
+            triage,
+            triage_batch_size,
+            stop,
+            ledger,
+            drained if early else None,
+        )
+    else:
+        items = ((email, None) async for email in emails)
+    try:
+        async for email, result in items:
+            if stop.is_set():
+                break
+            shard = zlib.crc32(email["thread_id"].encode("UTF-8")) % concurrency
+            await queues[shard].put((email, result))
+    finally:
+        for queue in queues:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    if errors:
+        raise errors[0]
+    logger.info(f"Dispatched {dispatched} emails.")
+    return dispatched
+
+
+async def _triaged(
+    emails: AsyncIterator[EmailData],
+    triage: TriageBatch,
+    batch_size: int,
+    stop: asyncio.Event,
+    ledger: DispatchLedger | None,
+    drained: Callable[[], Awaitable[None]] | None = None,
+) -> AsyncIterator[tuple[EmailData, RespondTo | None]]:
+    """Yield emails with their batch triage result, if any.
+
+    `user_respond` emails and emails the ledger already knows are not sent to
+    the model. A failed batch only costs the precomputed results; those runs
+    triage on their own.
+
+    With `drained` (early-stopping passes), each batch first waits for the
+    emails yielded so far to be handled and is not triaged if that stopped the
+    pass; an email the ledger knows is yielded untriaged, to stop the pass,
+    and nothing after it is read.
+    """
+    batch: list[EmailData] = []
+
+    def known(email: EmailData) -> bool:
+        return ledger is not None and ledger.contains(email["thread_id"], email["id"])
+
+    async def flush():
+        candidates = [
+            email for email in batch if "user_respond" not in email and not known(email)
+        ]
+        if candidates and drained is not None:
+            await drained()
+        results = {}
+        if candidates and not stop.is_set():
+            try:
+                results = await triage(candidates)
+            except Exception as e:
+                logger.warning(f"Batch triage of {len(candidates)} emails failed: {e}")
+        return [(email, results.get(email["id"])) for email in batch]
+
+    async for email in emails:
+        if drained is not None and "user_respond" not in email and known(email):
+            for item in await flush():
+                yield item
+            yield email, None
+            return
+        batch.append(email)
+        if len(batch) >= batch_size:
+            for item in await flush():
+                yield item
+            batch = []
+    if batch:
+        for item in await flush():
+            yield item
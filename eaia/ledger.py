@@ -0,0 +1,118 @@
+"""
+ledger.py
+
+Local record of emails already dispatched to the `main` graph.
+
+Ingest used to ask the LangGraph server (`threads.get`) about every fetched
+email just to find out it had already been dispatched. `DispatchLedger` keeps
+dispatched `(thread_id, email_id)` pairs in SQLite, fronted by an in-memory
+Bloom filter so that unknown emails never touch the database. Only a
+confirmed ledger hit skips the server; anything else still goes through the
+usual `threads.get` check, so other ingest processes are never ignored.
+Entries expire after a TTL and the filter is rebuilt on compaction.
+"""
+import hashlib
+import math
+import sqlite3
+import time
+
+# Pairs older than this are dropped; ingest only re-sees recent mail.
+_TTL = 14 * 24 * 60 * 60.0
+_COMPACT_INTERVAL = 60 * 60.0
+# Minimum Bloom filter capacity; it is resized on compaction.
+_CAPACITY = 10_000
+_ERROR_RATE = 0.01
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings (double hashing on one blake2b digest)."""
+
+    def __init__(self, capacity: int, error_rate: float = _ERROR_RATE):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("UTF-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+
+class DispatchLedger:
+    """Dispatched `(thread_id, email_id)` pairs, by Gmail ids.
+
+    `db_path` is a SQLite file; without one the ledger only lives as long as
+    the process (which still covers every tick of a long-running cron worker).
+    """
+
+    def __init__(
+        self,
+        db_path: str | None = None,
+        ttl: float = _TTL,
+        capacity: int = _CAPACITY,
+    ):
+        self.ttl = ttl
+        self.min_capacity = capacity
+        self._db = sqlite3.connect(db_path or ":memory:", check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS dispatched ("
+            "thread_id TEXT, email_id TEXT, dispatched_at REAL, "
+            "PRIMARY KEY (thread_id, email_id))"
+        )
+        self.compact()
+
+    @staticmethod
+    def _key(thread_id: str, email_id: str) -> str:
+        return f"{thread_id}/{email_id}"
+
+    def contains(self, thread_id: str, email_id: str) -> bool:
+        """True only if the pair was dispatched within the TTL."""
+        if self._key(thread_id, email_id) not in self._bloom:
+            return False
+        row = self._db.execute(
+            "SELECT 1 FROM dispatched "
+            "WHERE thread_id = ? AND email_id = ? AND dispatched_at >= ?",
+            (thread_id, email_id, time.time() - self.ttl),
+        ).fetchone()
+        return row is not None
+
+    def add(self, thread_id: str, email_id: str) -> None:
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO dispatched VALUES (?, ?, ?)",
+                (thread_id, email_id, time.time()),
+            )
+        self._bloom.add(self._key(thread_id, email_id))
+        self._count += 1
+        if (
+            self._count > self._capacity
+            or time.monotonic() - self._compacted_at > _COMPACT_INTERVAL
+        ):
+            self.compact()
+
+    def compact(self) -> None:
+        """Drop expired pairs and rebuild the Bloom filter for what is left."""
+        with self._db:
+            self._db.execute(
+                "DELETE FROM dispatched WHERE dispatched_at < ?",
+                (time.time() - self.ttl,),
+            )
+        rows = self._db.execute("SELECT thread_id, email_id FROM dispatched").fetchall()
+        self._count = len(rows)
+        # Leave room to grow so the filter is not rebuilt on every insert.
+        self._capacity = max(self.min_capacity, 2 * self._count)
+        self._bloom = BloomFilter(self._capacity)
+        for thread_id, email_id in rows:
+            self._bloom.add(self._key(thread_id, email_id))
+        self._compacted_at = time.monotonic()
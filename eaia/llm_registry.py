@@ -0,0 +1,158 @@
+"""
+llm_registry.py
+
+Process-wide registry of chat models, keyed by (provider, model, params).
+
+Graph nodes used to build a new `ChatOpenAI` or `ChatAnthropic` on every
+execution, and with it a new HTTP client, so calls under load kept paying
+for new connections and TLS handshakes. `get_chat_model` hands out one
+pre-built model per key and event loop. OpenAI models share one pooled
+`httpx.AsyncClient` per loop, with the limits below. Anthropic models are
+reused as is, together with the client they open on first use.
+
+Every registered model carries a `ModelMetrics` callback handler that counts
+in-flight calls and records call latencies in a histogram. `model_stats()`
+returns them per model.
+"""
+import asyncio
+import bisect
+import json
+import logging
+import time
+import weakref
+from uuid import UUID
+
+import httpx
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_anthropic import ChatAnthropic
+from langchain_core.language_models import BaseChatModel
+from langchain_openai import ChatOpenAI
+
+logger = logging.getLogger(__name__)
+
+_LIMITS = httpx.Limits(
+    max_connections=50, max_keepalive_connections=20, keepalive_expiry=120
+)
+_TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+# Upper bounds (seconds) of the latency histogram buckets; the last is open.
+LATENCY_BUCKETS = (0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0)
+_BUCKET_LABELS = [f"<={bound}s" for bound in LATENCY_BUCKETS] + [
+    f">{LATENCY_BUCKETS[-1]}s"
+]
+# Per-loop model cache; httpx connection pools cannot be shared across loops.
+_MODELS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = (
+    weakref.WeakKeyDictionary()
+)
+_METRICS: dict[str, "ModelMetrics"] = {}
+
+
+class ModelMetrics(BaseCallbackHandler):
+    """In-flight count and latency histogram for one registered model."""
+
+    run_inline = True
+
+    def __init__(self, name: str):
+        self.name = name
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self._started: dict[UUID, float] = {}
+
+    def _start(self, run_id: UUID) -> None:
+        self._started[run_id] = time.monotonic()
+        self.in_flight += 1
+
+    def _end(self, run_id: UUID) -> None:
+        started = self._started.pop(run_id, None)
+        if started is None:
+            return
+        self.in_flight -= 1
+        elapsed = time.monotonic() - started
+        self.calls += 1
+        self.total_seconds += elapsed
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+    def on_chat_model_start(
+        self, serialized, messages, *, run_id: UUID, **kwargs
+    ) -> None:
+        self._start(run_id)
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, **kwargs) -> None:
+        self._start(run_id)
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs) -> None:
+        self.errors += 1
+        self._end(run_id)
+
+    def quantile(self, q: float) -> float | None:
+        """Upper bound of the bucket holding the `q` quantile (inf if open-ended)."""
+        if not self.calls:
+            return None
+        rank = q * self.calls
+        seen = 0
+        for bound, count in zip((*LATENCY_BUCKETS, float("inf")), self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "errors": self.errors,
+            "mean_seconds": self.total_seconds / self.calls if self.calls else None,
+            "p50_seconds": self.quantile(0.5),
+            "p95_seconds": self.quantile(0.95),
+            "histogram": dict(zip(_BUCKET_LABELS, self.buckets)),
+        }
+
+
+def _build(
+    provider: str, model: str, params: dict, clients: dict, metrics: ModelMetrics
+) -> BaseChatModel:
+    if provider == "openai":
+        if "http" not in clients:
+            clients["http"] = httpx.AsyncClient(limits=_LIMITS, timeout=_TIMEOUT)
+        return ChatOpenAI(
+            model=model,
+            http_async_client=clients["http"],
+            callbacks=[metrics],
+            **params,
+        )
+    if provider == "anthropic":
+        return ChatAnthropic(model=model, callbacks=[metrics], **params)
+    raise ValueError(f"Unknown model provider: {provider}")
+
+
+def get_chat_model(provider: str, model: str, **params) -> BaseChatModel:
+    """Shared chat model for `provider` ("openai" or "anthropic"), `model` and
+    constructor `params`, built once per event loop."""
+    name = f"{provider}:{model}"
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # No loop to pool for (sync callers): build an unshared model.
+        return _build(provider, model, params, {}, _metrics(name))
+    clients = _MODELS.setdefault(loop, {})
+    key = (provider, model, json.dumps(params, sort_keys=True, default=str))
+    if key not in clients:
+        clients[key] = _build(provider, model, params, clients, _metrics(name))
+        logger.info(f"Registered chat model {name} with params {key[2]}")
+    return clients[key]
+
+
+def _metrics(name: str) -> ModelMetrics:
+    if name not in _METRICS:
+        _METRICS[name] = ModelMetrics(name)
+    return _METRICS[name]
+
+
+def model_stats() -> dict[str, dict]:
+    """In-flight counts and latency histograms per `provider:model`."""
+    return {name: metrics.stats() for name, metrics in _METRICS.items()}
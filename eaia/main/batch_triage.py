@@ -0,0 +1,127 @@
+"""Triage several emails in one structured-output LLM call.
+
+During ingest bursts, one `triage_input` call per email repeats the same
+instructions built from `triage_no`, `triage_email` and `triage_notify`.
+`triage_batch` sends those instructions once, followed by up to N emails,
+and gets back one `RespondTo` per email ID. Ingest passes each result to the
+email's `main` run as `precomputed_triage`, which `triage_input` uses instead
+of calling the model.
+
+Emails that triage rules or the triage cache already answer are left out, as
+`triage_input` decides those without the LLM anyway. Few-shot examples are
+searched per email and shown once for the whole batch.
+"""
+
+import asyncio
+import logging
+
+from langgraph.store.base import BaseStore
+
+from eaia.llm_registry import get_chat_model
+from eaia.main.config import get_config_async
+from eaia.main.fewshot import format_similar_examples_store, search_few_shot_examples
+from eaia.main.prompt_bundle import get_prompt_cache_usage
+from eaia.main.triage import render_triage_instructions, triage_prompt
+from eaia.main.triage_cache import get_examples_version, get_triage_cache, triage_version
+from eaia.main.triage_rules import get_triage_rules
+from eaia.schemas import BatchTriage, EmailData, RespondTo, email_thread
+
+logger = logging.getLogger(__name__)
+
+# Few-shot examples shown for a whole batch, taken in turn from each email's nearest.
+_MAX_EXAMPLES = 15
+
+# Follows the same static instructions as single-email triage
+batch_triage_tail = """
+
+{fewshotexamples}
+
+Below are {count} separate email threads, each inside an <email> tag with its ID. \
+Determine how to handle each of them independently. Return exactly one result per email, \
+with its `email_id`.
+
+{emails}"""
+
+batch_email_template = """<email id="{email_id}">
+From: {author}
+To: {to}
+Subject: {subject}
+
+{email_thread}
+</email>"""
+
+
+def _interleave(searches: list) -> list:
+    """Round-robin over each email's examples, without duplicates."""
+    examples, seen = [], set()
+    for rank in range(max((len(items) for items in searches), default=0)):
+        for items in searches:
+            if rank < len(items) and items[rank].key not in seen:
+                seen.add(items[rank].key)
+                examples.append(items[rank])
+    return examples[:_MAX_EXAMPLES]
+
+
+async def triage_batch(
+    emails: list[EmailData], config: dict, store: BaseStore
+) -> dict[str, RespondTo]:
+    """Triage `emails` in one LLM call; returns results by email ID.
+
+    Emails answered by triage rules or the cache, and emails the model did
+    not return a result for, are missing from the result.
+    """
+    prompt_config = await get_config_async(config)
+    assistant_id = config["configurable"].get("assistant_id", "default")
+    model_name = config["configurable"].get("model", "gpt-4o")
+    rules = get_triage_rules(prompt_config, assistant_id)
+    cache = get_triage_cache(assistant_id)
+    version = triage_version(
+        triage_prompt,
+        prompt_config,
+        model_name,
+        await get_examples_version(store, assistant_id),
+    )
+    pending = [
+        email
+        for email in emails
+        if rules.peek(email) is None and cache.peek(email, version) is None
+    ]
+    if not pending:
+        return {}
+
+    searches = await asyncio.gather(
+        *(search_few_shot_examples(email, store, config) for email in pending)
+    )
+    examples = _interleave([items or [] for items in searches])
+    instructions = render_triage_instructions(prompt_config, assistant_id)
+    input_message = instructions + batch_triage_tail.format(
+        count=len(pending),
+        emails="\n\n".join(
+            batch_email_template.format(
+                email_id=email["id"],
+                email_thread=email_thread(email),
+                author=email["from_email"],
+                to=email.get("to_email", ""),
+                subject=email["subject"],
+            )
+            for email in pending
+        ),
+        fewshotexamples=format_similar_examples_store(examples) if examples else "",
+    )
+    llm = get_chat_model("openai", model_name, temperature=0, streaming=False)
+    model = llm.with_structured_output(BatchTriage).bind(
+        tool_choice={"type": "function", "function": {"name": "BatchTriage"}}
+    ).with_config(callbacks=[get_prompt_cache_usage("batch_triage")])
+    batch = await model.ainvoke(input_message)
+
+    ids = {email["id"] for email in pending}
+    results = {
+        result.email_id: RespondTo(logic=result.logic, response=result.response)
+        for result in batch.results
+        if result.email_id in ids
+    }
+    logger.info(
+        f"Batch triaged {len(results)} of {len(pending)} emails in one call "
+        f"({len(emails) - len(pending)} left to rules or cache)"
+    )
+    return results
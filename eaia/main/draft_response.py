@@ -1,7 +1,6 @@
 """Core agent responsible for drafting email."""
 
 from langchain_core.runnables import RunnableConfig
-from langchain_openai import ChatOpenAI
 from langgraph.store.base import BaseStore
 
 from eaia.schemas import (
@@ -13,8 +12,12 @@ from eaia.schemas import (
     SendCalendarInvite,
     Ignore,
     email_template,
+    email_thread,
 )
+from eaia.llm_registry import get_chat_model
 from eaia.main.config import get_config
+from eaia.main.preferences import get_preferences
+from eaia.main.prompt_bundle import get_prompt_bundle, get_prompt_cache_usage
 
 EMAIL_WRITING_INSTRUCTIONS = """You are {full_name}'s executive assistant. You are a top-notch executive assistant who cares about {name} performing as well as possible.
 
@@ -70,20 +73,22 @@ Note that you should only call this if working to schedule a meeting - if a meet
 # Background information: information you may find helpful when responding to emails or deciding what to do.
 
 {random_preferences}"""
-draft_prompt = """{instructions}
+# Everything up to the email is static per assistant, so it is a cacheable prefix
+draft_prompt = EMAIL_WRITING_INSTRUCTIONS + """
 
 Remember to call a tool correctly! Use the specified names exactly - not add `functions::` to the start. Pass all required arguments.
 
 Here is the email thread. Note that this is the full email thread. Pay special attention to the most recent email.
 
-{email}"""
+"""
 
 
 async def draft_response(state: State, config: RunnableConfig, store: BaseStore):
     """Write an email to a customer."""
     model = config["configurable"].get("model", "gpt-4o")
-    llm = ChatOpenAI(
-        model=model,
+    llm = get_chat_model(
+        "openai",
+        model,
         temperature=0,
         parallel_tool_calls=False,
         tool_choice="required",
@@ -99,49 +104,27 @@ async def draft_response(state: State, config: RunnableConfig, store: BaseStore)
     if len(messages) > 0:
         tools.append(Ignore)
     prompt_config = get_config(config)
-    namespace = (config["configurable"].get("assistant_id", "default"),)
-    key = "schedule_preferences"
-    result = await store.aget(namespace, key)
-    if result and "data" in result.value:
-        schedule_preferences = result.value["data"]
-    else:
-        await store.aput(namespace, key, {"data": prompt_config["schedule_preferences"]})
-        schedule_preferences = prompt_config["schedule_preferences"]
-    key = "random_preferences"
-    result = await store.aget(namespace, key)
-    if result and "data" in result.value:
-        random_preferences = result.value["data"]
-    else:
-        await store.aput(
-            namespace, key, {"data": prompt_config["background_preferences"]}
-        )
-        random_preferences = prompt_config["background_preferences"]
-    key = "response_preferences"
-    result = await store.aget(namespace, key)
-    if result and "data" in result.value:
-        response_preferences = result.value["data"]
-    else:
-        await store.aput(namespace, key, {"data": prompt_config["response_preferences"]})
-        response_preferences = prompt_config["response_preferences"]
-    _prompt = EMAIL_WRITING_INSTRUCTIONS.format(
-        schedule_preferences=schedule_preferences,
-        random_preferences=random_preferences,
-        response_preferences=response_preferences,
+    assistant_id = config["configurable"].get("assistant_id", "default")
+    preferences = await get_preferences(store, assistant_id, prompt_config)
+    prefix = get_prompt_bundle("draft_response", assistant_id).render(
+        draft_prompt,
+        schedule_preferences=preferences["schedule_preferences"],
+        random_preferences=preferences["random_preferences"],
+        response_preferences=preferences["response_preferences"],
         name=prompt_config["name"],
         full_name=prompt_config["full_name"],
         background=prompt_config["background"],
     )
-    input_message = draft_prompt.format(
-        instructions=_prompt,
-        email=email_template.format(
-            email_thread=state["email"]["page_content"],
-            author=state["email"]["from_email"],
-            subject=state["email"]["subject"],
-            to=state["email"].get("to_email", ""),
-        ),
+    input_message = prefix + email_template.format(
+        email_thread=email_thread(state["email"]),
+        author=state["email"]["from_email"],
+        subject=state["email"]["subject"],
+        to=state["email"].get("to_email", ""),
     )
 
-    model = llm.bind_tools(tools)
+    model = llm.bind_tools(tools).with_config(
+        callbacks=[get_prompt_cache_usage("draft_response")]
+    )
     messages = [{"role": "user", "content": input_message}] + messages
     i = 0
     while i < 5:
@@ -0,0 +1,158 @@
+"""Embedding text for triage examples and a cached embedding function.
+
+Few-shot retrieval used to embed `str({"input": email})`, the repr of the
+whole `EmailData` dict with its IDs and raw HTML. `embedding_text` is the
+canonical, length-bounded text instead: sender, subject and the head of the
+body with markup and quoted replies removed. `save_email` stores it as the
+indexed `embedding_text` field of each example, and `get_few_shot_examples`
+queries with it.
+
+`aembed_texts` is the store's embedding function (see `langgraph.json`).
+Vectors are cached by a hash of the model and text, in an in-memory LRU in
+front of a SQLite file (`EAIA_EMBEDDING_CACHE_DB`), so triage retries,
+rollbacks and reruns of an email do not call the embedding API again.
+"""
+
+import hashlib
+import html
+import logging
+import os
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+from langchain_openai import OpenAIEmbeddings
+
+from eaia.schemas import EmailData
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+_MAX_BODY_CHARS = 1500
+_MAX_ENTRIES = 4096
+_MAX_DISK_ENTRIES = 100_000
+# Disk entries beyond the cap are pruned after this many writes.
+_PRUNE_EVERY = 1000
+
+_TAG = re.compile(r"<(script|style)\b.*?</\1>|<[^>]+>", re.IGNORECASE | re.DOTALL)
+_WHITESPACE = re.compile(r"\s+")
+
+
+def clean_body(text: str) -> str:
+    """Plain text of an email body: markup, quoted lines and extra whitespace removed."""
+    text = html.unescape(_TAG.sub(" ", text or ""))
+    lines = [line for line in text.splitlines() if not line.lstrip().startswith(">")]
+    return _WHITESPACE.sub(" ", " ".join(lines)).strip()
+
+
+def embedding_text(email: EmailData) -> str:
+    """Canonical text embedded for an email: sender, subject and body head."""
+    body = clean_body(email.get("page_content", ""))[:_MAX_BODY_CHARS]
+    return (
+        f"From: {email.get('from_email', '')}\n"
+        f"Subject: {email.get('subject', '')}\n\n"
+        f"{body}"
+    )
+
+
+class EmbeddingCache:
+    """Content-addressed vectors: in-memory LRU over an optional SQLite file."""
+
+    def __init__(self, db_path: str | None = None, max_entries: int = _MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, list[float]] = OrderedDict()
+        self._writes = 0
+        self._db = sqlite3.connect(db_path or ":memory:", check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key TEXT PRIMARY KEY, vector BLOB, used REAL)"
+            )
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("UTF-8")).hexdigest()
+
+    def get(self, key: str) -> list[float] | None:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        row = self._db.execute(
+            "SELECT vector FROM embeddings WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        vector = np.frombuffer(row[0], dtype=np.float32).tolist()
+        self._remember(key, vector)
+        return vector
+
+    def put(self, key: str, vector: list[float]) -> None:
+        self._remember(key, vector)
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                (key, np.asarray(vector, dtype=np.float32).tobytes(), time.time()),
+            )
+        self._writes += 1
+        if self._writes % _PRUNE_EVERY == 0:
+            self.prune()
+
+    def _remember(self, key: str, vector: list[float]) -> None:
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def prune(self, max_entries: int = _MAX_DISK_ENTRIES) -> None:
+        """Drop the least recently written disk entries beyond `max_entries`."""
+        with self._db:
+            self._db.execute(
+                "DELETE FROM embeddings WHERE key NOT IN "
+                "(SELECT key FROM embeddings ORDER BY used DESC LIMIT ?)",
+                (max_entries,),
+            )
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+        }
+
+
+@lru_cache
+def get_embedding_cache() -> EmbeddingCache:
+    """Process-wide embedding cache, stored at `EAIA_EMBEDDING_CACHE_DB` if set."""
+    return EmbeddingCache(db_path=os.getenv("EAIA_EMBEDDING_CACHE_DB"))
+
+
+@lru_cache
+def _embedder() -> OpenAIEmbeddings:
+    return OpenAIEmbeddings(model=EMBEDDING_MODEL)
+
+
+async def aembed_texts(texts: list[str]) -> list[list[float]]:
+    """Store embedding function; only texts not in the cache reach the API."""
+    cache = get_embedding_cache()
+    keys = [cache.key(EMBEDDING_MODEL, text) for text in texts]
+    vectors = {key: cache.get(key) for key in set(keys)}
+    missing = {key: text for key, text in zip(keys, texts) if vectors[key] is None}
+    if missing:
+        embedded = await _embedder().aembed_documents(list(missing.values()))
+        for key, vector in zip(missing, embedded):
+            cache.put(key, vector)
+            vectors[key] = vector
+        logger.info(
+            f"Embedded {len(missing)} of {len(texts)} texts; cache {cache.stats()}"
+        )
+    return [vectors[key] for key in keys]
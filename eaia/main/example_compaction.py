@@ -0,0 +1,154 @@
+"""Compaction of an assistant's triage examples.
+
+Every human triage decision is saved as an example, so without compaction the
+`(assistant_id, "triage_examples")` namespace only grows: search slows down
+and the few-shot prompt fills up with near-duplicates of the same newsletter.
+`compact_examples` walks the examples from newest to oldest and:
+
+- merges each example into a newer kept one whose `embedding_text` vector is
+  at least `similarity` (cosine) close, counting it in the kept example's
+  `merged` field (the newer decision wins),
+- moves examples saved under random keys to their content-addressed
+  `example_key`, so `save_email` finds them again,
+- re-puts examples saved without an `embedding_text` field, which the store
+  indexed as a whole document, so search embeds only their `embedding_text`,
+- keeps at most `max_examples`, dropping the oldest.
+
+The examples version is bumped when anything changed, with the written and
+deleted keys in the change log, so the triage cache, the local example index
+and the classifier resync. Log entries older than `CHANGE_LOG_MAX_AGE` are
+pruned. The cron job runs
+`maybe_compact_examples`, which compacts at most once per `interval`.
+"""
+
+import logging
+import time
+
+import numpy as np
+from langgraph.store.base import BaseStore
+
+from eaia.main.embedding import aembed_texts, embedding_text
+from eaia.main.example_index import example_key, example_text
+from eaia.main.triage_cache import bump_examples_version, prune_example_changes
+
+logger = logging.getLogger(__name__)
+
+MAX_EXAMPLES = 500
+SIMILARITY = 0.97
+COMPACTION_INTERVAL = 24 * 60 * 60.0
+# Workers that have not synced for longer list all examples once instead.
+CHANGE_LOG_MAX_AGE = 7 * 24 * 60 * 60.0
+_PAGE_SIZE = 100
+# Store location of the last compaction time, outside the examples namespace.
+_STATE_NAMESPACE = "triage_compaction"
+_STATE_KEY = "last_run"
+
+
+async def _list_examples(store: BaseStore, namespace: tuple) -> list:
+    items, offset = [], 0
+    while True:
+        page = await store.asearch(namespace, limit=_PAGE_SIZE, offset=offset)
+        items.extend(item for item in page if isinstance(item.value.get("input"), dict))
+        if len(page) < _PAGE_SIZE:
+            return items
+        offset += _PAGE_SIZE
+
+
+async def compact_examples(
+    store: BaseStore,
+    assistant_id: str = "default",
+    max_examples: int = MAX_EXAMPLES,
+    similarity: float = SIMILARITY,
+) -> dict:
+    """Merge near-duplicate examples and cap the namespace; returns counts."""
+    namespace = (assistant_id, "triage_examples")
+    items = await _list_examples(store, namespace)
+    items.sort(key=lambda item: item.updated_at, reverse=True)
+    stats = {
+        "examples": len(items),
+        "merged": 0,
+        "dropped": 0,
+        "rekeyed": 0,
+        "reindexed": 0,
+    }
+    if not items:
+        return stats
+
+    vectors = np.asarray(
+        await aembed_texts([example_text(item.value) for item in items]),
+        dtype=np.float32,
+    )
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    # Kept examples, newest first, with the number of examples merged into each
+    kept: list[list] = []
+    kept_rows: list[int] = []
+    deleted = []
+    for row, item in enumerate(items):
+        if kept_rows:
+            scores = vectors[kept_rows] @ vectors[row]
+            nearest = int(np.argmax(scores))
+            if scores[nearest] >= similarity:
+                kept[nearest][1] += 1 + item.value.get("merged", 0)
+                deleted.append(item)
+                stats["merged"] += 1
+                continue
+        kept.append([item, 0])
+        kept_rows.append(row)
+    for item, _ in kept[max_examples:]:
+        deleted.append(item)
+        stats["dropped"] += 1
+    kept = kept[:max_examples]
+
+    deleted_keys = {item.key for item in deleted}
+    written = []
+    for item, merged in kept:
+        key = example_key(item.value["input"])
+        reindex = "embedding_text" not in item.value
+        if not merged and key == item.key and not reindex:
+            continue
+        value = {
+            **item.value,
+            "embedding_text": item.value.get("embedding_text")
+            or embedding_text(item.value["input"]),
+        }
+        if merged:
+            value["merged"] = value.get("merged", 0) + merged
+        await store.aput(namespace, key, value, index=["embedding_text"])
+        written.append(key)
+        if key != item.key:
+            deleted_keys.add(item.key)
+            stats["rekeyed"] += 1
+        elif reindex and not merged:
+            stats["reindexed"] += 1
+        # A merged example may already have been stored under the content key.
+        deleted_keys.discard(key)
+    for key in deleted_keys:
+        await store.adelete(namespace, key)
+
+    if written or deleted_keys:
+        await bump_examples_version(
+            store, assistant_id, upserts=written, deletes=deleted_keys
+        )
+    stats["examples"] = len(kept)
+    stats["pruned_changes"] = await prune_example_changes(
+        store, assistant_id, CHANGE_LOG_MAX_AGE
+    )
+    logger.info(f"Compacted triage examples for {assistant_id}: {stats}")
+    return stats
+
+
+async def maybe_compact_examples(
+    store: BaseStore,
+    assistant_id: str = "default",
+    interval: float = COMPACTION_INTERVAL,
+    **kwargs,
+) -> dict | None:
+    """`compact_examples`, unless it already ran within the last `interval` seconds."""
+    state_namespace = (assistant_id, _STATE_NAMESPACE)
+    item = await store.aget(state_namespace, _STATE_KEY)
+    now = time.time()
+    if item and now - item.value["time"] < interval:
+        return None
+    stats = await compact_examples(store, assistant_id, **kwargs)
+    await store.aput(state_namespace, _STATE_KEY, {"time": now, **stats}, index=False)
+    return stats
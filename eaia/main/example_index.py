@@ -0,0 +1,291 @@
+"""In-process vector index over an assistant's triage examples.
+
+Few-shot lookups used to cost a remote embedding plus a store search for
+every email. The index keeps the example vectors in one contiguous, L2
+normalised float32 matrix and answers top-k queries locally: a matrix-vector
+product for small sets, and an HNSW graph (`hnswlib`, optional) from
+`_HNSW_MIN` examples on. Query vectors come from the cached `aembed_texts`,
+so an email seen before costs no API call at all.
+
+The store stays the source of truth. `sync` catches up with the
+`(assistant_id, "triage_examples")` namespace whenever the examples version
+changes, reading only the keys in the examples change log since its last
+sync (the whole namespace the first time): new keys are embedded (cache hits
+for anything the store embedded in this process) and added, changed values
+are refreshed, and keys gone from the store are dropped. Few-shot prompts use `search_diverse` (maximal
+marginal relevance), so near-duplicate examples do not fill all the slots.
+`save_email` also adds its example right away. With
+`EAIA_EXAMPLE_INDEX_DIR` set, the index is snapshotted after each sync, as
+a `.npy` matrix that a new worker memory-maps at startup plus a JSON file
+with the keys, values and the examples version it reflects.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from typing import Any, NamedTuple
+
+import numpy as np
+from langgraph.store.base import BaseStore, GetOp
+
+from eaia.main.embedding import aembed_texts, embedding_text
+from eaia.main.triage_cache import get_example_changes
+from eaia.schemas import EmailData
+
+try:
+    import hnswlib
+except ImportError:  # Brute force only
+    hnswlib = None
+
+logger = logging.getLogger(__name__)
+
+# Below this many examples a matrix-vector product is faster than HNSW.
+_HNSW_MIN = 2048
+_PAGE_SIZE = 100
+
+
+class Example(NamedTuple):
+    key: str
+    value: dict[str, Any]
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0)
+
+
+def example_key(email: EmailData) -> str:
+    """Content-addressed store key of a triage example: the same email text
+    always maps to the same example."""
+    return hashlib.sha256(embedding_text(email).encode("UTF-8")).hexdigest()[:32]
+
+
+def example_text(value: dict) -> str:
+    # Examples saved before `embedding_text` existed are embedded the same way.
+    return value.get("embedding_text") or embedding_text(value["input"])
+
+
+class ExampleIndex:
+    """Top-k cosine search over one assistant's triage examples."""
+
+    def __init__(self, snapshot_path: str | None = None):
+        # Taken from the first vector added, so any embedding model works.
+        self.dims: int | None = None
+        self.snapshot_path = snapshot_path
+        self.version: str | None = None
+        # Change log position of the last sync (see `get_example_changes`).
+        self.cursor: int | None = None
+        self._examples: list[Example] = []
+        self._positions: dict[str, int] = {}
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._hnsw = None
+        if snapshot_path and os.path.exists(f"{snapshot_path}.json"):
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._examples)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._positions
+
+    def add(self, examples: list[Example], vectors: list[list[float]]) -> None:
+        pairs = [
+            (example, vector)
+            for example, vector in zip(examples, vectors)
+            if example.key not in self._positions
+        ]
+        if not pairs:
+            return
+        size = len(self._examples)
+        new = _normalize(np.asarray([vector for _, vector in pairs], dtype=np.float32))
+        if self.dims is None:
+            self.dims = new.shape[1]
+        elif new.shape[1] != self.dims:
+            raise ValueError(f"Expected {self.dims} dimensions, got {new.shape[1]}")
+        if size + len(new) > len(self._vectors) or not self._vectors.flags.writeable:
+            # Grow into RAM; a memory-mapped snapshot is read-only.
+            capacity = max(64, 2 * (size + len(new)))
+            grown = np.zeros((capacity, self.dims), dtype=np.float32)
+            if size:
+                grown[:size] = self._vectors[:size]
+            self._vectors = grown
+        self._vectors[size : size + len(new)] = new
+        for example, _ in pairs:
+            self._positions[example.key] = len(self._examples)
+            self._examples.append(example)
+        if self._hnsw is not None:
+            if len(self._examples) > self._hnsw.get_max_elements():
+                self._hnsw.resize_index(2 * len(self._examples))
+            self._hnsw.add_items(new, np.arange(size, size + len(new)))
+        self._maybe_build_hnsw()
+
+    def remove(self, keys: set[str]) -> None:
+        keep = [i for i, example in enumerate(self._examples) if example.key not in keys]
+        if len(keep) == len(self._examples):
+            return
+        self._vectors = np.ascontiguousarray(self._vectors[keep])
+        self._examples = [self._examples[i] for i in keep]
+        self._positions = {example.key: i for i, example in enumerate(self._examples)}
+        self._hnsw = None
+        self._maybe_build_hnsw()
+
+    def _maybe_build_hnsw(self) -> None:
+        if hnswlib is None or self._hnsw is not None or len(self) < _HNSW_MIN:
+            return
+        index = hnswlib.Index(space="ip", dim=self.dims)
+        index.init_index(max_elements=2 * len(self), ef_construction=200, M=16)
+        index.add_items(self._vectors[: len(self)], np.arange(len(self)))
+        index.set_ef(64)
+        self._hnsw = index
+
+    def _nearest(self, query: np.ndarray, k: int) -> list[int]:
+        """Positions of the `k` rows most similar to a normalised query."""
+        size = len(self._examples)
+        k = min(k, size)
+        if not k:
+            return []
+        if self._hnsw is not None:
+            labels, _ = self._hnsw.knn_query(query, k=k)
+            return [int(i) for i in labels[0]]
+        scores = self._vectors[:size] @ query
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])].tolist()
+
+    def search(self, vector: list[float], k: int = 5) -> list[Example]:
+        """The `k` examples most similar to `vector`, most similar first."""
+        query = _normalize(np.asarray(vector, dtype=np.float32))
+        return [self._examples[i] for i in self._nearest(query, k)]
+
+    def search_diverse(
+        self,
+        vector: list[float],
+        k: int = 5,
+        candidates: int = 20,
+        lambda_mult: float = 0.7,
+    ) -> list[Example]:
+        """Maximal marginal relevance: `k` of the `candidates` nearest examples,
+        each picked for similarity to the query (weight `lambda_mult`) minus
+        similarity to the examples already picked."""
+        query = _normalize(np.asarray(vector, dtype=np.float32))
+        pool = self._nearest(query, max(k, candidates))
+        relevance = self._vectors[pool] @ query
+        # Highest similarity to a picked example (dissimilar ones count as 0)
+        redundancy = np.zeros(len(pool), dtype=np.float32)
+        selected: list[int] = []
+        while pool and len(selected) < k:
+            scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+            best = int(np.argmax(scores))
+            selected.append(pool.pop(best))
+            relevance = np.delete(relevance, best)
+            redundancy = np.delete(redundancy, best)
+            if pool:
+                redundancy = np.maximum(
+                    redundancy, self._vectors[pool] @ self._vectors[selected[-1]]
+                )
+        return [self._examples[i] for i in selected]
+
+    async def add_examples(self, examples: list[Example]) -> None:
+        """Embed (through the embedding cache) and add examples.
+
+        Examples already in the index only get their value refreshed: their
+        keys are content-addressed, so the text (and vector) is the same.
+        """
+        new = []
+        for example in examples:
+            if example.key in self:
+                self._examples[self._positions[example.key]] = example
+            else:
+                new.append(example)
+        if new:
+            vectors = await aembed_texts([example_text(e.value) for e in new])
+            self.add(new, vectors)
+
+    async def sync(self, store: BaseStore, assistant_id: str, version: str) -> None:
+        """Match the store's examples, when the examples version changed."""
+        if version == self.version:
+            return
+        namespace = (assistant_id, "triage_examples")
+        changes = await get_example_changes(store, assistant_id, self.cursor)
+        listed: dict[str, Example] = {}
+        if changes.upserts is None:
+            offset = 0
+            while True:
+                items = await store.asearch(namespace, limit=_PAGE_SIZE, offset=offset)
+                for item in items:
+                    if isinstance(item.value.get("input"), dict):
+                        listed[item.key] = Example(item.key, item.value)
+                if len(items) < _PAGE_SIZE:
+                    break
+                offset += _PAGE_SIZE
+            removed = set(self._positions) - set(listed)
+        else:
+            keys = list(changes.upserts)
+            items = await store.abatch([GetOp(namespace, key) for key in keys])
+            removed = set(changes.deletes) & set(self._positions)
+            for key, item in zip(keys, items):
+                if item is not None and isinstance(item.value.get("input"), dict):
+                    listed[key] = Example(key, item.value)
+                elif key in self:
+                    removed.add(key)
+        added = sum(key not in self for key in listed)
+        self.remove(removed)
+        await self.add_examples(list(listed.values()))
+        self.cursor = changes.cursor
+        self.version = version
+        logger.info(
+            f"Example index for {assistant_id}: +{added} -{len(removed)}, "
+            f"{len(self)} examples ({'hnsw' if self._hnsw else 'brute force'})"
+        )
+        # Also persists examples `save_email` added directly since the last sync.
+        self.save()
+
+    def save(self) -> None:
+        """Write the snapshot, if there is a snapshot path."""
+        if not self.snapshot_path:
+            return
+        size = len(self._examples)
+        with open(f"{self.snapshot_path}.npy.tmp", "wb") as f:
+            np.save(f, self._vectors[:size])
+        with open(f"{self.snapshot_path}.json.tmp", "w") as f:
+            json.dump(
+                {
+                    "version": self.version,
+                    "cursor": self.cursor,
+                    "dims": self.dims,
+                    "examples": [[e.key, e.value] for e in self._examples],
+                },
+                f,
+            )
+        os.replace(f"{self.snapshot_path}.npy.tmp", f"{self.snapshot_path}.npy")
+        os.replace(f"{self.snapshot_path}.json.tmp", f"{self.snapshot_path}.json")
+
+    def load(self) -> None:
+        with open(f"{self.snapshot_path}.json") as f:
+            state = json.load(f)
+        vectors = np.load(f"{self.snapshot_path}.npy", mmap_mode="r")
+        if len(vectors) != len(state["examples"]):
+            logger.warning(f"Ignoring mismatched index snapshot {self.snapshot_path}")
+            return
+        self.dims = state["dims"]
+        self._vectors = vectors
+        self._examples = [Example(key, value) for key, value in state["examples"]]
+        self._positions = {example.key: i for i, example in enumerate(self._examples)}
+        self.version = state["version"]
+        self.cursor = state.get("cursor")
+        self._maybe_build_hnsw()
+
+
+_INDEXES: dict[str, ExampleIndex] = {}
+
+
+def get_example_index(assistant_id: str = "default") -> ExampleIndex:
+    """Index for an assistant, snapshotted under `EAIA_EXAMPLE_INDEX_DIR` if set."""
+    if assistant_id not in _INDEXES:
+        directory = os.getenv("EAIA_EXAMPLE_INDEX_DIR")
+        path = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, assistant_id)
+        _INDEXES[assistant_id] = ExampleIndex(snapshot_path=path)
+    return _INDEXES[assistant_id]
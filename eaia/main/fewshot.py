@@ -1,8 +1,15 @@
 """Fetches few shot examples for triage step."""
 
+import logging
+
 from langgraph.store.base import BaseStore
+from eaia.main.embedding import aembed_texts, embedding_text
+from eaia.main.example_index import get_example_index
+from eaia.main.triage_cache import get_examples_version
 from eaia.schemas import EmailData
 
+logger = logging.getLogger(__name__)
+
 
 template = """Email Subject: {subject}
 Email From: {from_email}
@@ -29,42 +36,55 @@ def format_similar_examples_store(examples):
     return "\n\n------------\n\n".join(strs)
 
 
-async def get_few_shot_examples(email: EmailData, store: BaseStore, config):
+async def search_few_shot_examples(email: EmailData, store: BaseStore, config):
+    """Stored triage examples most similar to `email`, or None if the search failed.
+
+    Served by the local example index; the store search is the fallback.
+    """
     import asyncio
     import os
     import tempfile
     
+    assistant_id = config["configurable"].get("assistant_id", "default")
+    try:
+        index = get_example_index(assistant_id)
+        version = await get_examples_version(store, assistant_id)
+        await index.sync(store, assistant_id, version)
+        if not len(index):
+            return []
+        vector = (await aembed_texts([embedding_text(email)]))[0]
+        return index.search_diverse(vector, k=5)
+    except Exception:
+        logger.warning(
+            "Error in local example index, searching the store", exc_info=True
+        )
+
     # Handle the tiktoken blocking issue by preparing the environment
     # before making any search requests
-    
-    # Create a wrapper function to perform the actual search
-    async def perform_search():
-        namespace = (
-            config["configurable"].get("assistant_id", "default"),
-            "triage_examples",
-        )
-        try:
-            # Define the synchronous operation that might cause blocking
-            def sync_search_operation():
-                # Pre-calculate and set the environment variables that tiktoken needs
-                # to avoid os.getcwd() being called in an async context
-                cwd = os.getcwd()
-                temp_dir = os.path.join(tempfile.gettempdir(), "data-gym-cache")
-                os.makedirs(temp_dir, exist_ok=True)
-                os.environ["TIKTOKEN_CACHE_DIR"] = temp_dir
-                return None  # Just setup, no actual search here
-            
-            # Run potentially blocking setup in a thread
-            await asyncio.to_thread(sync_search_operation)
-            
-            # Now that environment is set up, do the actual search
-            return await store.asearch(namespace, query=str({"input": email}), limit=5)
-        except Exception as e:
-            print(f"Error in search operation: {str(e)}")
-            return None
-    
-    # Execute the search with proper async handling
-    result = await perform_search()
+    namespace = (assistant_id, "triage_examples")
+    try:
+        # Define the synchronous operation that might cause blocking
+        def sync_search_operation():
+            # Pre-calculate and set the environment variables that tiktoken needs
+            # to avoid os.getcwd() being called in an async context
+            cwd = os.getcwd()
+            temp_dir = os.path.join(tempfile.gettempdir(), "data-gym-cache")
+            os.makedirs(temp_dir, exist_ok=True)
+            os.environ["TIKTOKEN_CACHE_DIR"] = temp_dir
+            return None  # Just setup, no actual search here
+        
+        # Run potentially blocking setup in a thread
+        await asyncio.to_thread(sync_search_operation)
+        
+        # Now that environment is set up, do the actual search
+        return await store.asearch(namespace, query=embedding_text(email), limit=5)
+    except Exception as e:
+        print(f"Error in search operation: {str(e)}")
+        return None
+
+
+async def get_few_shot_examples(email: EmailData, store: BaseStore, config):
+    result = await search_few_shot_examples(email, store, config)
     
     if result is None:
         return ""
@@ -4,10 +4,10 @@ from datetime import datetime
 
 from langchain_core.messages import ToolMessage
 from langchain_core.runnables import RunnableConfig
-from langchain_openai import ChatOpenAI
 from langgraph.prebuilt import create_react_agent
 
-from eaia.gmail import get_events_for_days
+from eaia.async_gmail import get_events_for_days
+from eaia.llm_registry import get_chat_model
 from eaia.schemas import State
 
 from eaia.main.config import get_config
@@ -66,7 +66,7 @@ Subject: {subject}
 async def find_meeting_time(state: State, config: RunnableConfig):
     """Write an email to a customer."""
     model = config["configurable"].get("model", "gpt-4o")
-    llm = ChatOpenAI(model=model, temperature=0)
+    llm = get_chat_model("openai", model, temperature=0)
     agent = create_react_agent(llm, [get_events_for_days])
     current_date = datetime.now()
     prompt_config = get_config(config)
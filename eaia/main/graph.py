@@ -4,6 +4,7 @@ from dotenv import load_dotenv
 load_dotenv()
 
 """Overall agent."""
+import asyncio
 import json
 from typing import TypedDict, Literal
 from langgraph.graph import END, StateGraph
@@ -22,11 +23,13 @@ from eaia.main.human_inbox import (
     notify,
     send_cal_invite,
 )
-from eaia.gmail import (
-    send_email,
-    mark_as_read,
-    send_calendar_invite,
+from eaia.async_gmail import (
+    asend_email,
+    amark_as_read,
+    aapply_labels,
+    asend_calendar_invite,
 )
+from eaia.gmail_labels import TRIAGE_LABELS
 from eaia.schemas import (
     State,
 )
@@ -34,13 +37,13 @@ from eaia.schemas import (
 
 def route_after_triage(
     state: State,
-) -> Literal["draft_response", "mark_as_read_node", "notify"]:
+) -> Literal["draft_response", "mark_as_read_node", "notify_label_node"]:
     if state["triage"].response == "email":
         return "draft_response"
     elif state["triage"].response == "no":
         return "mark_as_read_node"
     elif state["triage"].response == "notify":
-        return "notify"
+        return "notify_label_node"
     elif state["triage"].response == "question":
         return "draft_response"
     else:
@@ -117,12 +120,12 @@ def enter_after_human(
                 raise ValueError
 
 
-def send_cal_invite_node(state, config):
+async def send_cal_invite_node(state, config):
     tool_call = state["messages"][-1].tool_calls[0]
     _args = tool_call["args"]
     email = get_config(config)["email"]
     try:
-        send_calendar_invite(
+        await asend_calendar_invite(
             _args["emails"],
             _args["title"],
             _args["start_time"],
@@ -135,14 +138,14 @@ def send_cal_invite_node(state, config):
     return {"messages": [ToolMessage(content=message, tool_call_id=tool_call["id"])]}
 
 
-def send_email_node(state, config):
+async def send_email_node(state, config):
     tool_call = state["messages"][-1].tool_calls[0]
     _args = tool_call["args"]
     email = get_config(config)["email"]
     new_receipients = _args["new_recipients"]
     if isinstance(new_receipients, str):
         new_receipients = json.loads(new_receipients)
-    send_email(
+    await asend_email(
         state["email"]["id"],
         _args["content"],
         email,
@@ -150,8 +153,26 @@ def send_email_node(state, config):
     )
 
 
-def mark_as_read_node(state):
-    mark_as_read(state["email"]["id"])
+async def mark_as_read_node(state: State, config):
+    labels = []
+    if get_config(config).get("triage_labels") and state["triage"].response == "no":
+        labels.append(TRIAGE_LABELS["no"])
+    # The write queue sends these as one batchModify call.
+    await asyncio.gather(
+        *(
+            amark_as_read(message_id, labels=labels)
+            for message_id in [
+                state["email"]["id"],
+                *state["email"].get("coalesced_ids", []),
+            ]
+        )
+    )
+
+
+async def notify_label_node(state: State, config):
+    # Kept out of `notify`, which runs again every time its interrupt resumes.
+    if get_config(config).get("triage_labels"):
+        await aapply_labels(state["email"]["id"], [TRIAGE_LABELS["notify"]])
 
 
 def human_node(state: State):
@@ -173,6 +194,7 @@ graph_builder.add_node(mark_as_read_node)
 graph_builder.add_node(send_email_draft)
 graph_builder.add_node(send_email_node)
 graph_builder.add_node(bad_tool_name)
+graph_builder.add_node(notify_label_node)
 graph_builder.add_node(notify)
 graph_builder.add_node(send_cal_invite_node)
 graph_builder.add_node(send_cal_invite)
@@ -189,6 +211,7 @@ graph_builder.add_edge("send_email_node", "mark_as_read_node")
 graph_builder.add_edge("rewrite", "send_email_draft")
 graph_builder.add_edge("send_email_draft", "human_node")
 graph_builder.add_edge("mark_as_read_node", END)
+graph_builder.add_edge("notify_label_node", "notify")
 graph_builder.add_edge("notify", "human_node")
 graph_builder.add_conditional_edges("human_node", enter_after_human)
 graph = graph_builder.compile()
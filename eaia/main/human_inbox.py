@@ -1,5 +1,6 @@
 """Parts of the graph that require human input."""
 
+import logging
 import uuid
 
 from langsmith import traceable
@@ -9,6 +10,11 @@ from langgraph.store.base import BaseStore
 from typing import TypedDict, Literal, Union, Optional
 from langgraph_sdk import get_client
 from eaia.main.config import get_config
+from eaia.main.embedding import embedding_text
+from eaia.main.example_index import Example, example_key, get_example_index
+from eaia.main.triage_cache import bump_examples_version
+
+logger = logging.getLogger(__name__)
 
 LGC = get_client()
 
@@ -63,11 +69,22 @@ async def save_email(state: State, config, store: BaseStore, status: str):
         config["configurable"].get("assistant_id", "default"),
         "triage_examples",
     )
-    key = state["email"]["id"]
+    key = example_key(state["email"])
     response = await store.aget(namespace, key)
-    if response is None:
-        data = {"input": state["email"], "triage": status}
-        await store.aput(namespace, str(uuid.uuid4()), data)
+    # The latest decision for the same content replaces the earlier one.
+    if response is None or response.value.get("triage") != status:
+        data = {
+            "input": state["email"],
+            "triage": status,
+            "embedding_text": embedding_text(state["email"]),
+        }
+        await store.aput(namespace, key, data, index=["embedding_text"])
+        await bump_examples_version(store, namespace[0], upserts=[key])
+        try:
+            await get_example_index(namespace[0]).add_examples([Example(key, data)])
+        except Exception:
+            # The index catches up from the store on its next sync.
+            logger.warning("Error adding example to the local index", exc_info=True)
 
 
 @traceable
@@ -0,0 +1,70 @@
+"""Cached, batched reads of an assistant's learned preferences.
+
+`draft_response` and `rewrite` fill their prompts with preferences stored at
+`(assistant_id,)`, seeded from the config and later rewritten by reflection.
+They used to read them with one `store.aget` per key, plus one `aput` per
+missing key. `get_preferences` reads all of them in a single `store.abatch`,
+seeds the missing ones in a second batch, and keeps the result in an
+in-process cache for `_TTL` seconds.
+
+Reflection (`update_general`) writes through `put_preference`, which drops
+the assistant's cached preferences, so a learned preference is used by the
+next draft in this process. Writes from other processes show up once the
+TTL expires.
+"""
+
+import time
+
+from langgraph.store.base import BaseStore, GetOp, PutOp
+
+# Store key -> config key the store value is seeded from.
+PREFERENCE_KEYS = {
+    "schedule_preferences": "schedule_preferences",
+    "random_preferences": "background_preferences",
+    "response_preferences": "response_preferences",
+    "rewrite_instructions": "rewrite_preferences",
+}
+_TTL = 60.0
+
+# assistant_id -> (expiry, preferences)
+_CACHE: dict[str, tuple[float, dict[str, str]]] = {}
+# Bumped by every invalidation, so a read that started earlier is not cached.
+_GENERATIONS: dict[str, int] = {}
+
+
+def invalidate_preferences(assistant_id: str) -> None:
+    _CACHE.pop(assistant_id, None)
+    _GENERATIONS[assistant_id] = _GENERATIONS.get(assistant_id, 0) + 1
+
+
+async def get_preferences(
+    store: BaseStore, assistant_id: str, prompt_config: dict
+) -> dict[str, str]:
+    """All preferences of `assistant_id`, by store key, seeding missing ones
+    from `prompt_config`."""
+    cached = _CACHE.get(assistant_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    generation = _GENERATIONS.get(assistant_id, 0)
+    namespace = (assistant_id,)
+    results = await store.abatch([GetOp(namespace, key) for key in PREFERENCE_KEYS])
+    preferences, seeds = {}, []
+    for (key, config_key), item in zip(PREFERENCE_KEYS.items(), results):
+        if item and "data" in item.value:
+            preferences[key] = item.value["data"]
+        else:
+            preferences[key] = prompt_config[config_key]
+            seeds.append(PutOp(namespace, key, {"data": preferences[key]}))
+    if seeds:
+        await store.abatch(seeds)
+    if _GENERATIONS.get(assistant_id, 0) == generation:
+        _CACHE[assistant_id] = (time.monotonic() + _TTL, preferences)
+    return preferences
+
+
+async def put_preference(
+    store: BaseStore, assistant_id: str, key: str, value: str
+) -> None:
+    """Store a preference and drop the assistant's cached preferences."""
+    await store.aput((assistant_id,), key, {"data": value}, index=False)
+    invalidate_preferences(assistant_id)
@@ -0,0 +1,114 @@
+"""Per-assistant prompt prefixes laid out for provider-side prompt caching.
+
+Providers cache the longest previously seen prefix of a prompt, so every node
+builds its prompt as a static prefix followed by the per-call parts. The
+prefix (instructions filled in from the config and the stored preferences) is
+rendered once per node and assistant, and only rendered again when one of its
+inputs changes, so it stays byte-identical between calls. The per-call parts
+(few-shot examples, drafts, the email itself) are appended after it.
+
+`PromptCacheUsage` is a callback handler, bound to a node's model, that
+records how many input tokens the provider served from its cache. The ratio
+is logged per node after every call; `prompt_cache_report()` returns the
+totals.
+"""
+
+import hashlib
+import json
+import logging
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+logger = logging.getLogger(__name__)
+
+
+class PromptBundle:
+    """Rendered static prefix of one node's prompt for one assistant."""
+
+    def __init__(self, node: str):
+        self.node = node
+        self.key: str | None = None
+        self.prefix = ""
+        self.builds = 0
+
+    def render(self, template: str, **inputs: str) -> str:
+        """`template` filled with `inputs`, re-rendered only when they change."""
+        key = hashlib.sha256(
+            json.dumps([template, inputs], sort_keys=True).encode("UTF-8")
+        ).hexdigest()
+        if key != self.key:
+            self.prefix = template.format(**inputs)
+            self.key = key
+            self.builds += 1
+        return self.prefix
+
+
+_BUNDLES: dict[tuple[str, str], PromptBundle] = {}
+
+
+def get_prompt_bundle(node: str, assistant_id: str = "default") -> PromptBundle:
+    if (node, assistant_id) not in _BUNDLES:
+        _BUNDLES[(node, assistant_id)] = PromptBundle(node)
+    return _BUNDLES[(node, assistant_id)]
+
+
+class PromptCacheUsage(BaseCallbackHandler):
+    """Input and cached input tokens of one node's LLM calls."""
+
+    run_inline = True
+
+    def __init__(self, node: str):
+        self.node = node
+        self.calls = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+
+    def on_llm_end(self, response: LLMResult, **kwargs) -> None:
+        input_tokens = cached_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None) or {}
+                input_tokens += usage.get("input_tokens", 0)
+                details = usage.get("input_token_details") or {}
+                cached_tokens += details.get("cache_read") or 0
+        self.calls += 1
+        self.input_tokens += input_tokens
+        self.cached_tokens += cached_tokens
+        logger.info(
+            f"{self.node}: {cached_tokens} of {input_tokens} input tokens cached; "
+            f"{self.cached_ratio():.0%} over {self.calls} calls"
+        )
+
+    def cached_ratio(self) -> float:
+        if not self.input_tokens:
+            return 0.0
+        return self.cached_tokens / self.input_tokens
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "input_tokens": self.input_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cached_ratio": self.cached_ratio(),
+        }
+
+
+_USAGE: dict[str, PromptCacheUsage] = {}
+
+
+def get_prompt_cache_usage(node: str) -> PromptCacheUsage:
+    """Handler to bind to a node's model with `.with_config(callbacks=[...])`."""
+    if node not in _USAGE:
+        _USAGE[node] = PromptCacheUsage(node)
+    return _USAGE[node]
+
+
+def prompt_cache_report() -> dict[str, dict]:
+    """Cached-token totals per node, with the number of prefix renders."""
+    report = {node: usage.stats() for node, usage in _USAGE.items()}
+    for (node, _), bundle in _BUNDLES.items():
+        if node in report:
+            report[node]["prefix_builds"] = report[node].get("prefix_builds", 0) + bundle.builds
+    return report
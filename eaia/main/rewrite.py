@@ -1,10 +1,11 @@
 """Agent responsible for rewriting the email in a better tone."""
 
-from langchain_openai import ChatOpenAI
-
 from eaia.schemas import State, ReWriteEmail
 
+from eaia.llm_registry import get_chat_model
 from eaia.main.config import get_config
+from eaia.main.preferences import get_preferences
+from eaia.main.prompt_bundle import get_prompt_bundle, get_prompt_cache_usage
 
 
 rewrite_prompt = """You job is to rewrite an email draft to sound more like {name}.
@@ -17,7 +18,10 @@ but adjusting the tone.
 
 Here is the assistant's current draft:
 
-<draft>
+"""
+
+# Per-draft part, after the static instructions so they stay a cacheable prefix
+rewrite_tail = """<draft>
 {draft}
 </draft>
 
@@ -32,33 +36,26 @@ Subject: {subject}
 
 async def rewrite(state: State, config, store):
     model = config["configurable"].get("model", "gpt-4o")
-    llm = ChatOpenAI(model=model, temperature=0)
+    llm = get_chat_model("openai", model, temperature=0)
     prev_message = state["messages"][-1]
     draft = prev_message.tool_calls[0]["args"]["content"]
-    namespace = (config["configurable"].get("assistant_id", "default"),)
-    result = await store.aget(namespace, "rewrite_instructions")
+    assistant_id = config["configurable"].get("assistant_id", "default")
     prompt_config = get_config(config)
-    if result and "data" in result.value:
-        _prompt = result.value["data"]
-    else:
-        await store.aput(
-            namespace,
-            "rewrite_instructions",
-            {"data": prompt_config["rewrite_preferences"]},
-        )
-        _prompt = prompt_config["rewrite_preferences"]
-    input_message = rewrite_prompt.format(
+    preferences = await get_preferences(store, assistant_id, prompt_config)
+    _prompt = preferences["rewrite_instructions"]
+    prefix = get_prompt_bundle("rewrite", assistant_id).render(
+        rewrite_prompt, instructions=_prompt, name=prompt_config["name"]
+    )
+    input_message = prefix + rewrite_tail.format(
         email_thread=state["email"]["page_content"],
         author=state["email"]["from_email"],
         subject=state["email"]["subject"],
         to=state["email"]["to_email"],
         draft=draft,
-        instructions=_prompt,
-        name=prompt_config["name"],
     )
     model = llm.with_structured_output(ReWriteEmail).bind(
         tool_choice={"type": "function", "function": {"name": "ReWriteEmail"}}
-    )
+    ).with_config(callbacks=[get_prompt_cache_usage("rewrite")])
     response = await model.ainvoke(input_message)
     tool_calls = [
         {
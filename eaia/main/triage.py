@@ -1,19 +1,37 @@
 """Agent responsible for triaging the email, can either ignore it, try to respond, or notify user."""
 
+import logging
+
 from langchain_core.runnables import RunnableConfig
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import RemoveMessage
 from langgraph.store.base import BaseStore
 
 from eaia.schemas import (
     State,
     RespondTo,
+    email_thread,
 )
+from eaia.llm_registry import get_chat_model
 from eaia.main.fewshot import get_few_shot_examples
 from eaia.main.config import get_config_async
+from eaia.main.prompt_bundle import get_prompt_bundle, get_prompt_cache_usage
+from eaia.main.triage_cache import (
+    get_examples_version,
+    get_triage_cache,
+    triage_version,
+)
+from eaia.main.triage_classifier import (
+    classifier_settings,
+    get_triage_classifier,
+    should_short_circuit,
+    to_respond_to,
+)
+from eaia.main.triage_rules import get_triage_rules
+
+logger = logging.getLogger(__name__)
 
 
-triage_prompt = """You are {full_name}'s executive assistant. You are a top-notch executive assistant who cares about {name} performing as well as possible.
+triage_instructions = """You are {full_name}'s executive assistant. You are a top-notch executive assistant who cares about {name} performing as well as possible.
 
 {background}. 
 
@@ -30,7 +48,10 @@ There are also other things that {name} should know about, but don't require an
 
 For emails not worth responding to, respond `no`. For something where {name} should respond over email, respond `email`. If it's important to notify {name}, but no email is required, respond `notify`. \
 
-If unsure, opt to `notify` {name} - you will learn from this in the future.
+If unsure, opt to `notify` {name} - you will learn from this in the future."""
+
+# Per-email part, after the static instructions so they stay a cacheable prefix
+triage_tail = """
 
 {fewshotexamples}
 
@@ -42,47 +63,95 @@ Subject: {subject}
 
 {email_thread}"""
 
+triage_prompt = triage_instructions + triage_tail
+
+
+def render_triage_instructions(prompt_config: dict, assistant_id: str) -> str:
+    """Static triage instructions for an assistant, shared with batched triage."""
+    return get_prompt_bundle("triage", assistant_id).render(
+        triage_instructions,
+        name=prompt_config["name"],
+        full_name=prompt_config["full_name"],
+        background=prompt_config["background"],
+        triage_no=prompt_config["triage_no"],
+        triage_email=prompt_config["triage_email"],
+        triage_notify=prompt_config["triage_notify"],
+    )
+
 
 async def triage_input(state: State, config: RunnableConfig, store: BaseStore):
     """Triage input with improved async handling to prevent blocking operations."""
     import asyncio
 
     # Use async versions of operations and wrap any potentially blocking code
-    model = config["configurable"].get("model", "gpt-4o")
+    model_name = config["configurable"].get("model", "gpt-4o")
     
     # Initialize LLM with proper async settings
-    llm = ChatOpenAI(model=model, temperature=0, streaming=False)
-    
-    # Get examples asynchronously
-    examples = await get_few_shot_examples(state["email"], store, config)
+    llm = get_chat_model("openai", model_name, temperature=0, streaming=False)
     
     # Get config using our async-safe function
     prompt_config = await get_config_async(config)
+
+    assistant_id = config["configurable"].get("assistant_id", "default")
+
+    # Deterministic rules answer without the few-shot lookup or an LLM call
+    rules = get_triage_rules(prompt_config, assistant_id)
+    if (response := rules.match(state["email"])) is not None:
+        return _triage_update(state, response)
+
+    # Repeated and near-duplicate emails reuse an earlier result for the same
+    # prompt, config and few-shot examples
+    cache = get_triage_cache(assistant_id)
+    examples_version = await get_examples_version(store, assistant_id)
+    version = triage_version(triage_prompt, prompt_config, model_name, examples_version)
+    if (response := cache.get(state["email"], version)) is not None:
+        logger.info(f"Triage cache hit for email {state['email']['id']}: {cache.stats()}")
+        return _triage_update(state, response)
+
+    # A batched triage call at ingest may already have decided this email
+    precomputed = state.get("precomputed_triage")
+    if precomputed and precomputed.get("email_id") == state["email"]["id"]:
+        response = RespondTo(logic=precomputed["logic"], response=precomputed["response"])
+        cache.put(state["email"], version, response)
+        return _triage_update(state, response)
+
+    # Local kNN over the stored human decisions answers when it is confident
+    prediction = None
+    if (settings := classifier_settings(prompt_config)) is not None:
+        classifier = get_triage_classifier(assistant_id)
+        await classifier.sync(store, assistant_id, examples_version)
+        prediction = classifier.predict(state["email"])
+        if prediction is not None and should_short_circuit(classifier, prediction, settings):
+            return _triage_update(state, to_respond_to(prediction))
+
+    # Get examples asynchronously
+    examples = await get_few_shot_examples(state["email"], store, config)
     
-    # Format prompt (string operations are usually fast enough)
-    input_message = triage_prompt.format(
-        email_thread=state["email"]["page_content"],
+    # Static instructions first, then the examples and the email
+    instructions = render_triage_instructions(prompt_config, assistant_id)
+    input_message = instructions + triage_tail.format(
+        email_thread=email_thread(state["email"]),
         author=state["email"]["from_email"],
         to=state["email"].get("to_email", ""),
         subject=state["email"]["subject"],
         fewshotexamples=examples,
-        name=prompt_config["name"],
-        full_name=prompt_config["full_name"],
-        background=prompt_config["background"],
-        triage_no=prompt_config["triage_no"],
-        triage_email=prompt_config["triage_email"],
-        triage_notify=prompt_config["triage_notify"],
     )
     
     # Set up the model with structured output 
     model = llm.with_structured_output(RespondTo).bind(
         tool_choice={"type": "function", "function": {"name": "RespondTo"}}
-    )
+    ).with_config(callbacks=[get_prompt_cache_usage("triage_input")])
     
     # Make async API call
     response = await model.ainvoke(input_message)
+    cache.put(state["email"], version, response)
+    if prediction is not None:
+        classifier.record(prediction, response.response)
     
-    # Process response
+    return _triage_update(state, response)
+
+
+def _triage_update(state: State, response: RespondTo) -> dict:
     if len(state["messages"]) > 0:
         # List comprehension is fast, no need to offload
         delete_messages = [RemoveMessage(id=m.id) for m in state["messages"]]
@@ -0,0 +1,327 @@
+"""Cache of triage results for repeated and near-duplicate emails.
+
+Newsletters, notifications and reply-all storms reach triage with identical
+or nearly identical content. Emails are fingerprinted by sender, a subject
+template (reply prefixes and numbers stripped), recipients, a hash of the
+coalesced messages shown with it, and a 64-bit simhash of the body. A cached
+`RespondTo` is reused for an email that matches on everything but the body
+and whose body simhash is within a few bits. Candidates are
+found through LSH bands: with `max_distance` below the number of bands, two
+close hashes always share at least one band exactly.
+
+Every entry belongs to a triage version, which hashes the triage prompt, the
+triage config, the model and the few-shot examples version (bumped by
+`save_email`). A cache seeing a new version drops all of its entries.
+
+Each bump also appends the changed example keys to a change log, so the
+local example index and the triage classifier can apply just those changes
+(`get_example_changes`) instead of listing every example on every save.
+"""
+
+import hashlib
+import json
+import re
+import time
+import uuid
+from collections import OrderedDict
+from email.utils import getaddresses, parseaddr
+from typing import Iterable, NamedTuple
+
+from langgraph.store.base import BaseStore
+
+from eaia.schemas import EmailData, RespondTo
+
+_MAX_ENTRIES = 2048
+_TTL = 24 * 60 * 60.0
+_BANDS = 4
+_BAND_BITS = 64 // _BANDS
+_MAX_DISTANCE = 3
+# Config keys that change what triage decides.
+_CONFIG_KEYS = (
+    "name",
+    "full_name",
+    "background",
+    "triage_no",
+    "triage_email",
+    "triage_notify",
+)
+# Store location of the few-shot examples version, outside the examples namespace.
+_VERSION_NAMESPACE = "triage_cache"
+_VERSION_KEY = "examples_version"
+# Time of the oldest change still in the change log, in the same namespace.
+_CHANGES_START_KEY = "changes_start"
+_CHANGES_NAMESPACE = "triage_example_changes"
+_PAGE_SIZE = 100
+# Changes this recent are read again on the next sync, in case a worker's
+# clock is behind; applying a change twice is harmless.
+_CLOCK_GRACE_NS = 60 * 10**9
+
+_REPLY_PREFIX = re.compile(r"^\s*((re|fwd?|aw|wg)\s*(\[\d+\])?\s*:\s*)+", re.IGNORECASE)
+_NUMBER = re.compile(r"\d+")
+_TAG = re.compile(r"<[^>]+>")
+_WORD = re.compile(r"\w+")
+
+
+def subject_template(subject: str) -> str:
+    subject = _REPLY_PREFIX.sub("", subject or "").lower()
+    return " ".join(_NUMBER.sub("#", subject).split())
+
+
+def simhash(text: str) -> int:
+    """64-bit simhash over word trigrams, with numbers and markup ignored."""
+    words = _WORD.findall(_NUMBER.sub("#", _TAG.sub(" ", text or "").lower()))
+    shingles = [" ".join(words[i : i + 3]) for i in range(max(1, len(words) - 2))]
+    weights = [0] * 64
+    for shingle in shingles:
+        value = int.from_bytes(
+            hashlib.blake2b(shingle.encode("UTF-8"), digest_size=8).digest(), "big"
+        )
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def _bands(value: int) -> list[int]:
+    mask = (1 << _BAND_BITS) - 1
+    return [value >> (i * _BAND_BITS) & mask for i in range(_BANDS)]
+
+
+def triage_version(
+    prompt_template: str, prompt_config: dict, model: str, examples_version: str
+) -> str:
+    payload = {
+        "prompt": prompt_template,
+        "config": {key: prompt_config.get(key) for key in _CONFIG_KEYS},
+        "model": model,
+        "examples": examples_version,
+    }
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True).encode("UTF-8")
+    ).hexdigest()[:16]
+
+
+async def get_examples_version(store: BaseStore, assistant_id: str) -> str:
+    item = await store.aget((assistant_id, _VERSION_NAMESPACE), _VERSION_KEY)
+    return item.value["version"] if item else "0"
+
+
+async def bump_examples_version(
+    store: BaseStore,
+    assistant_id: str,
+    upserts: Iterable[str] = (),
+    deletes: Iterable[str] = (),
+) -> None:
+    """Mark the triage few-shot examples as changed; cached results go stale.
+
+    `upserts` and `deletes` are the example keys written and deleted; they go
+    to the change log before the version moves, so a reader seeing the new
+    version also finds its changes.
+    """
+    now = time.time_ns()
+    await store.aput(
+        (assistant_id, _CHANGES_NAMESPACE),
+        f"{now:020d}-{uuid.uuid4().hex[:8]}",
+        {"at": now, "upserts": list(upserts), "deletes": list(deletes)},
+        index=False,
+    )
+    await store.aput(
+        (assistant_id, _VERSION_NAMESPACE),
+        _VERSION_KEY,
+        {"version": hashlib.sha256(str(now).encode()).hexdigest()[:16]},
+        index=False,
+    )
+
+
+class ExampleChanges(NamedTuple):
+    # Pass back as `since` on the next call.
+    cursor: int
+    # Keys written and deleted since `since`; None when the caller has to list
+    # the whole examples namespace instead.
+    upserts: set[str] | None
+    deletes: set[str] | None
+
+
+async def get_example_changes(
+    store: BaseStore, assistant_id: str, since: int | None
+) -> ExampleChanges:
+    """Example keys changed since the cursor `since`.
+
+    Without a cursor, or one older than the oldest logged change, the result
+    has no key sets and the caller lists everything.
+    """
+    now = time.time_ns()
+    cursor = now - _CLOCK_GRACE_NS
+    start = await store.aget((assistant_id, _VERSION_NAMESPACE), _CHANGES_START_KEY)
+    if since is None or (start and since < start.value["at"]):
+        return ExampleChanges(cursor, None, None)
+    namespace = (assistant_id, _CHANGES_NAMESPACE)
+    items, offset = [], 0
+    while True:
+        page = await store.asearch(
+            namespace, filter={"at": {"$gt": since}}, limit=_PAGE_SIZE, offset=offset
+        )
+        items.extend(page)
+        if len(page) < _PAGE_SIZE:
+            break
+        offset += _PAGE_SIZE
+    upserts: set[str] = set()
+    deletes: set[str] = set()
+    for item in sorted(items, key=lambda item: item.value["at"]):
+        upserts.difference_update(item.value["deletes"])
+        deletes.update(item.value["deletes"])
+        deletes.difference_update(item.value["upserts"])
+        upserts.update(item.value["upserts"])
+    return ExampleChanges(max(cursor, since), upserts, deletes)
+
+
+async def prune_example_changes(
+    store: BaseStore, assistant_id: str, max_age: float
+) -> int:
+    """Delete logged changes older than `max_age` seconds; returns how many.
+
+    Readers with an older cursor list the whole namespace once instead.
+    """
+    cutoff = time.time_ns() - int(max_age * 10**9)
+    namespace = (assistant_id, _CHANGES_NAMESPACE)
+    old = []
+    while True:
+        page = await store.asearch(
+            namespace, filter={"at": {"$lt": cutoff}}, limit=_PAGE_SIZE
+        )
+        if not page:
+            break
+        # Move the start first, so no reader trusts a log with a gap.
+        if not old:
+            await store.aput(
+                (assistant_id, _VERSION_NAMESPACE),
+                _CHANGES_START_KEY,
+                {"at": cutoff},
+                index=False,
+            )
+        for item in page:
+            await store.adelete(namespace, item.key)
+        old.extend(page)
+    return len(old)
+
+
+class TriageCache:
+    """LRU + TTL cache of triage results for one assistant."""
+
+    def __init__(
+        self,
+        max_entries: int = _MAX_ENTRIES,
+        ttl: float = _TTL,
+        max_distance: int = _MAX_DISTANCE,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = min(max_distance, _BANDS - 1)
+        self.version: str | None = None
+        self.hits = 0
+        self.misses = 0
+        # fingerprint -> (response, stored at)
+        self._entries: OrderedDict[tuple, tuple[RespondTo, float]] = OrderedDict()
+        self._bands: dict[tuple, set[tuple]] = {}
+
+    @staticmethod
+    def fingerprint(email: EmailData) -> tuple[str, str, str, str, int]:
+        """Everything the triage prompt shows, with the body simhash last."""
+        recipients = sorted(
+            address.lower()
+            for _, address in getaddresses([email.get("to_email", "")])
+            if address
+        )
+        coalesced = hashlib.sha256(
+            json.dumps(
+                [
+                    [message["from_email"], message["snippet"]]
+                    for message in email.get("coalesced_messages", [])
+                ]
+            ).encode("UTF-8")
+        ).hexdigest()[:16]
+        return (
+            parseaddr(email.get("from_email", ""))[1].lower(),
+            subject_template(email.get("subject", "")),
+            ",".join(recipients),
+            coalesced,
+            simhash(email.get("page_content", "")),
+        )
+
+    def _use_version(self, version: str) -> None:
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def get(self, email: EmailData, version: str) -> RespondTo | None:
+        self._use_version(version)
+        best = self._nearest(email)
+        if best is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(best[0])
+        return best[1].model_copy()
+
+    def peek(self, email: EmailData, version: str) -> RespondTo | None:
+        """`get` without counting the lookup or refreshing the entry, for
+        callers that only check whether triage will need the model."""
+        if version != self.version:
+            return None
+        best = self._nearest(email)
+        return None if best is None else best[1].model_copy()
+
+    def _nearest(self, email: EmailData) -> tuple[tuple, RespondTo] | None:
+        *context, body_hash = self.fingerprint(email)
+        now = time.monotonic()
+        best = None
+        for i, band in enumerate(_bands(body_hash)):
+            for key in self._bands.get((*context, i, band), ()):
+                response, stored_at = self._entries[key]
+                distance = bin(key[-1] ^ body_hash).count("1")
+                if now - stored_at > self.ttl or distance > self.max_distance:
+                    continue
+                if best is None or distance < best[0]:
+                    best = (distance, key, response)
+        return None if best is None else (best[1], best[2])
+
+    def put(self, email: EmailData, version: str, response: RespondTo) -> None:
+        self._use_version(version)
+        key = self.fingerprint(email)
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (response.model_copy(), time.monotonic())
+        for i, band in enumerate(_bands(key[-1])):
+            self._bands.setdefault((*key[:-1], i, band), set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: tuple) -> None:
+        del self._entries[key]
+        for i, band in enumerate(_bands(key[-1])):
+            keys = self._bands.get((*key[:-1], i, band))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._bands[(*key[:-1], i, band)]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bands.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+        }
+
+
+_CACHES: dict[str, TriageCache] = {}
+
+
+def get_triage_cache(assistant_id: str = "default") -> TriageCache:
+    if assistant_id not in _CACHES:
+        _CACHES[assistant_id] = TriageCache()
+    return _CACHES[assistant_id]
@@ -0,0 +1,323 @@
+"""Local nearest-neighbour triage classifier trained on stored human decisions.
+
+Every triage decision `save_email` records under `(assistant_id,
+"triage_examples")` becomes a training example. Emails are embedded as
+L2-normalised hashed bag-of-words vectors (sender, sender domain, subject
+template words and body words) in a fixed number of dimensions, so new
+examples are appended to the matrix without refitting anything. Prediction is
+a similarity-weighted vote of the `k` nearest examples, computed with one
+matrix-vector product; the confidence is the winning label's share of the
+vote.
+
+`triage_input` asks the classifier before the few-shot search and the LLM,
+and uses its answer when the confidence clears the configured threshold.
+Whenever the LLM does run while a prediction exists (below the threshold, or
+for a sampled `audit_rate` of confident predictions), the agreement between
+the two is recorded per confidence bin. `Calibration.curve()` is the result;
+`suggest_threshold()` picks the lowest threshold meeting a target agreement.
+"""
+
+import hashlib
+import logging
+import random
+import re
+from email.utils import parseaddr
+from typing import NamedTuple
+
+import numpy as np
+from langgraph.store.base import BaseStore, GetOp
+
+from eaia.main.triage_cache import get_example_changes, subject_template
+from eaia.schemas import EmailData, RespondTo
+
+logger = logging.getLogger(__name__)
+
+_DIMENSIONS = 2048
+_K = 7
+_BODY_CHARS = 2000
+_PAGE_SIZE = 100
+_LABELS = ("no", "email", "notify", "question")
+_BINS = 10
+# Agreement is logged after this many new calibration records.
+_REPORT_EVERY = 50
+
+_TAG = re.compile(r"<[^>]+>")
+_WORD = re.compile(r"[a-z][a-z0-9']+")
+
+
+class Prediction(NamedTuple):
+    response: str
+    confidence: float
+    # Similarity of the nearest example, in [0, 1].
+    similarity: float
+    neighbours: int
+
+
+def _tokens(email: EmailData) -> list[tuple[str, float]]:
+    address = parseaddr(email.get("from_email", ""))[1].lower()
+    tokens = [(f"from:{address}", 2.0), (f"domain:{address.rpartition('@')[2]}", 2.0)]
+    subject = subject_template(email.get("subject", ""))
+    tokens += [(f"subject:{word}", 1.5) for word in _WORD.findall(subject)]
+    body = _TAG.sub(" ", email.get("page_content", "")[:_BODY_CHARS]).lower()
+    tokens += [(f"body:{word}", 1.0) for word in _WORD.findall(body)]
+    return tokens
+
+
+def featurize(email: EmailData, dimensions: int = _DIMENSIONS) -> np.ndarray:
+    """Hashed, sublinear-tf, L2-normalised feature vector of an email."""
+    indices, weights = [], []
+    for token, weight in _tokens(email):
+        digest = hashlib.blake2b(token.encode("UTF-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "big")
+        indices.append(value % dimensions)
+        # The top bit picks the sign, so collisions cancel out on average.
+        weights.append(weight if value >> 63 else -weight)
+    vector = np.zeros(dimensions, dtype=np.float32)
+    if indices:
+        np.add.at(vector, np.array(indices), np.array(weights, dtype=np.float32))
+        vector = np.sign(vector) * np.log1p(np.abs(vector))
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+    return vector
+
+
+class Calibration:
+    """Agreement between classifier predictions and the LLM, per confidence bin."""
+
+    def __init__(self, bins: int = _BINS):
+        self.edges = np.linspace(0.0, 1.0, bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.agreed = np.zeros(bins, dtype=np.int64)
+
+    def record(self, confidence: float, agreed: bool) -> None:
+        index = min(int(confidence * len(self.counts)), len(self.counts) - 1)
+        self.counts[index] += 1
+        self.agreed[index] += int(agreed)
+
+    def curve(self) -> list[dict]:
+        """One entry per non-empty bin: confidence range, count, LLM agreement."""
+        return [
+            {
+                "confidence": (float(self.edges[i]), float(self.edges[i + 1])),
+                "count": int(self.counts[i]),
+                "agreement": float(self.agreed[i] / self.counts[i]),
+            }
+            for i in np.flatnonzero(self.counts)
+        ]
+
+    def suggest_threshold(self, target: float = 0.95, min_count: int = 20) -> float | None:
+        """Lowest bin edge at which predictions at or above it agree with the LLM
+        at least `target` of the time, over at least `min_count` records."""
+        counts = np.cumsum(self.counts[::-1])[::-1]
+        agreed = np.cumsum(self.agreed[::-1])[::-1]
+        for i in range(len(counts)):
+            if counts[i] >= min_count and agreed[i] / counts[i] >= target:
+                return float(self.edges[i])
+        return None
+
+    def __len__(self) -> int:
+        return int(self.counts.sum())
+
+
+class TriageClassifier:
+    """kNN over one assistant's triage examples, grown incrementally."""
+
+    def __init__(self, dimensions: int = _DIMENSIONS, k: int = _K):
+        self.dimensions = dimensions
+        self.k = k
+        self.version: str | None = None
+        # Change log position of the last sync (see `get_example_changes`).
+        self.cursor: int | None = None
+        self.calibration = Calibration()
+        self.predictions = 0
+        self.short_circuits = 0
+        self._positions: dict[str, int] = {}
+        self._vectors = np.zeros((64, dimensions), dtype=np.float32)
+        self._labels = np.zeros(64, dtype=np.int64)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, key: str, email: EmailData, response: str) -> bool:
+        """Add one labelled example; False if the key or label is not usable.
+
+        A known key only gets its label updated (a changed human decision).
+        """
+        if response not in _LABELS:
+            return False
+        if key in self._positions:
+            self._labels[self._positions[key]] = _LABELS.index(response)
+            return False
+        if self._size == len(self._vectors):
+            self._vectors = np.concatenate([self._vectors, np.zeros_like(self._vectors)])
+            self._labels = np.concatenate([self._labels, np.zeros_like(self._labels)])
+        self._vectors[self._size] = featurize(email, self.dimensions)
+        self._labels[self._size] = _LABELS.index(response)
+        self._positions[key] = self._size
+        self._size += 1
+        return True
+
+    def remove(self, keys: set[str]) -> None:
+        keep = [i for key, i in self._positions.items() if key not in keys]
+        if len(keep) == self._size:
+            return
+        keep.sort()
+        capacity = max(64, 2 * len(keep))
+        vectors = np.zeros((capacity, self.dimensions), dtype=np.float32)
+        labels = np.zeros(capacity, dtype=np.int64)
+        vectors[: len(keep)] = self._vectors[keep]
+        labels[: len(keep)] = self._labels[keep]
+        self._vectors, self._labels = vectors, labels
+        position_keys = {i: key for key, i in self._positions.items()}
+        self._positions = {position_keys[i]: new for new, i in enumerate(keep)}
+        self._size = len(keep)
+
+    async def sync(self, store: BaseStore, assistant_id: str, version: str) -> int:
+        """Match the stored examples, when the examples version changed: add new
+        ones, update changed labels and drop examples removed from the store.
+
+        Only the keys in the change log since the last sync are read, unless
+        this is the first sync or the log no longer reaches back that far.
+        """
+        if version == self.version:
+            return 0
+        namespace = (assistant_id, "triage_examples")
+        changes = await get_example_changes(store, assistant_id, self.cursor)
+        added = 0
+        if changes.upserts is None:
+            listed = set()
+            offset = 0
+            while True:
+                items = await store.asearch(namespace, limit=_PAGE_SIZE, offset=offset)
+                for item in items:
+                    if isinstance(item.value.get("input"), dict):
+                        listed.add(item.key)
+                        added += self.add(
+                            item.key, item.value["input"], item.value.get("triage")
+                        )
+                if len(items) < _PAGE_SIZE:
+                    break
+                offset += _PAGE_SIZE
+            self.remove(set(self._positions) - listed)
+        else:
+            keys = list(changes.upserts)
+            items = await store.abatch([GetOp(namespace, key) for key in keys])
+            missing = set(changes.deletes)
+            for key, item in zip(keys, items):
+                if item is None or not isinstance(item.value.get("input"), dict):
+                    missing.add(key)
+                else:
+                    added += self.add(key, item.value["input"], item.value.get("triage"))
+            self.remove(missing)
+        self.cursor = changes.cursor
+        self.version = version
+        if added:
+            logger.info(
+                f"Triage classifier for {assistant_id}: {added} new examples, "
+                f"{self._size} total"
+            )
+        return added
+
+    def predict(self, email: EmailData) -> Prediction | None:
+        """Similarity-weighted vote of the nearest examples, or None without any."""
+        if not self._size:
+            return None
+        self.predictions += 1
+        similarities = self._vectors[: self._size] @ featurize(email, self.dimensions)
+        k = min(self.k, self._size)
+        nearest = np.argpartition(-similarities, k - 1)[:k]
+        weights = np.clip(similarities[nearest], 0.0, None)
+        votes = np.bincount(self._labels[nearest], weights=weights, minlength=len(_LABELS))
+        total = votes.sum()
+        if total <= 0:
+            return None
+        best = int(votes.argmax())
+        return Prediction(
+            response=_LABELS[best],
+            confidence=float(votes[best] / total),
+            similarity=float(weights.max()),
+            neighbours=k,
+        )
+
+    def record(self, prediction: Prediction, llm_response: str) -> None:
+        """Record whether the LLM agreed with a prediction."""
+        self.calibration.record(prediction.confidence, prediction.response == llm_response)
+        if len(self.calibration) % _REPORT_EVERY == 0:
+            logger.info(
+                f"Triage classifier calibration: {self.calibration.curve()}; "
+                f"suggested threshold {self.calibration.suggest_threshold()}"
+            )
+
+    def label_counts(self) -> dict[str, int]:
+        counts = np.bincount(self._labels[: self._size], minlength=len(_LABELS))
+        return dict(zip(_LABELS, counts.tolist()))
+
+    def stats(self) -> dict:
+        return {
+            "examples": self._size,
+            "labels": self.label_counts(),
+            "predictions": self.predictions,
+            "short_circuits": self.short_circuits,
+            "calibration": self.calibration.curve(),
+        }
+
+
+def classifier_settings(prompt_config: dict) -> dict | None:
+    """`triage_classifier` config with defaults, or None when disabled."""
+    settings = prompt_config.get("triage_classifier")
+    if not settings:
+        return None
+    if settings is True:
+        settings = {}
+    return {
+        "threshold": 0.9,
+        "min_examples": 30,
+        "min_similarity": 0.3,
+        "audit_rate": 0.1,
+        **settings,
+    }
+
+
+def should_short_circuit(
+    classifier: TriageClassifier, prediction: Prediction, settings: dict
+) -> bool:
+    """Whether to use a prediction instead of the LLM.
+
+    A sampled `audit_rate` of confident predictions still goes to the LLM, so
+    the calibration curve covers the bins above the threshold too. A "no" is
+    never used while there are no "notify" examples: such an email may well
+    be one to notify about, which the classifier cannot tell yet.
+    """
+    if prediction.response == "no" and not classifier.label_counts()["notify"]:
+        return False
+    confident = (
+        len(classifier) >= settings["min_examples"]
+        and prediction.similarity >= settings["min_similarity"]
+        and prediction.confidence >= settings["threshold"]
+    )
+    if confident and random.random() >= settings["audit_rate"]:
+        classifier.short_circuits += 1
+        return True
+    return False
+
+
+def to_respond_to(prediction: Prediction) -> RespondTo:
+    return RespondTo(
+        logic=(
+            f"Local triage classifier: {prediction.confidence:.0%} of the vote of the "
+            f"{prediction.neighbours} most similar past emails (nearest similarity "
+            f"{prediction.similarity:.2f}) was `{prediction.response}`."
+        ),
+        response=prediction.response,
+    )
+
+
+_CLASSIFIERS: dict[str, TriageClassifier] = {}
+
+
+def get_triage_classifier(assistant_id: str = "default") -> TriageClassifier:
+    if assistant_id not in _CLASSIFIERS:
+        _CLASSIFIERS[assistant_id] = TriageClassifier()
+    return _CLASSIFIERS[assistant_id]
@@ -0,0 +1,145 @@
+"""Deterministic triage rules, evaluated before the triage LLM.
+
+Rules come from the `triage_rules` key of the assistant config. Each rule has
+a `name`, the `response` to give, and one or more conditions, all of which
+must match:
+
+- `from`: sender patterns. A bare domain (`stripe.com`) matches that domain
+  and its subdomains; anything with an `@` is a glob on the address
+  (`*-noreply@docs.google.com`).
+- `subject`: a regex searched in the subject.
+- `headers`: header name -> regex searched in its value, or `true` to only
+  require the header (`List-Unsubscribe`, `Auto-Submitted`, `List-Id`,
+  `Precedence`).
+
+A match produces a `RespondTo` whose `logic` cites the rule, without an LLM
+call. Hit counts are kept per compiled rule set.
+"""
+
+import json
+import logging
+import re
+from email.utils import parseaddr
+from fnmatch import fnmatch
+from functools import lru_cache
+
+from eaia.schemas import EmailData, RespondTo
+
+logger = logging.getLogger(__name__)
+
+
+class TriageRule:
+    def __init__(self, spec: dict):
+        self.name = spec["name"]
+        self.response = spec["response"]
+        patterns = spec.get("from", [])
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        self.senders = [pattern.lower() for pattern in patterns]
+        self.subject = re.compile(spec["subject"]) if spec.get("subject") else None
+        self.headers = {
+            name.lower(): None if value is True else re.compile(value)
+            for name, value in spec.get("headers", {}).items()
+        }
+        if not (self.senders or self.subject or self.headers):
+            raise ValueError(f"Triage rule {self.name!r} has no conditions")
+        # Fail on bad responses at load time rather than on the first match.
+        RespondTo(response=self.response)
+
+    def _match_sender(self, addresses: list[str]) -> str | None:
+        for address in addresses:
+            domain = address.rpartition("@")[2]
+            for pattern in self.senders:
+                if "@" in pattern:
+                    if fnmatch(address, pattern):
+                        return f"sender {address} matches {pattern}"
+                elif domain == pattern or domain.endswith(f".{pattern}"):
+                    return f"sender {address} is from {pattern}"
+        return None
+
+    def match(self, email: EmailData) -> list[str] | None:
+        """Reasons the rule matched, or None if it does not."""
+        reasons = []
+        headers = {k.lower(): v for k, v in email.get("headers", {}).items()}
+        if self.senders:
+            addresses = [
+                parseaddr(value)[1].lower()
+                for value in (email.get("from_email", ""), headers.get("from", ""))
+                if value
+            ]
+            if (reason := self._match_sender(addresses)) is None:
+                return None
+            reasons.append(reason)
+        if self.subject is not None:
+            if not self.subject.search(email.get("subject", "")):
+                return None
+            reasons.append(f"subject matches /{self.subject.pattern}/")
+        for name, pattern in self.headers.items():
+            if name not in headers:
+                return None
+            if pattern is not None and not pattern.search(headers[name]):
+                return None
+            reasons.append(f"has {name} header")
+        return reasons
+
+
+def _respond_to(rule: TriageRule, reasons: list[str]) -> RespondTo:
+    return RespondTo(
+        logic=f"Matched triage rule `{rule.name}`: {'; '.join(reasons)}.",
+        response=rule.response,
+    )
+
+
+class TriageRules:
+    """Compiled rule set; the first matching rule wins."""
+
+    def __init__(self, specs: list[dict]):
+        self.rules = [TriageRule(spec) for spec in specs]
+        self.evaluated = 0
+        self.hits = {rule.name: 0 for rule in self.rules}
+
+    def match(self, email: EmailData) -> RespondTo | None:
+        self.evaluated += 1
+        for rule in self.rules:
+            reasons = rule.match(email)
+            if reasons is not None:
+                self.hits[rule.name] += 1
+                logger.info(
+                    f"Triage rule {rule.name} matched email {email['id']} "
+                    f"(rules hit {self.hit_rate():.0%} of {self.evaluated} emails)"
+                )
+                return _respond_to(rule, reasons)
+        return None
+
+    def peek(self, email: EmailData) -> RespondTo | None:
+        """`match` without counting the lookup, for callers that only check
+        whether triage will need the model."""
+        for rule in self.rules:
+            reasons = rule.match(email)
+            if reasons is not None:
+                return _respond_to(rule, reasons)
+        return None
+
+    def hit_rate(self) -> float:
+        """Share of evaluated emails triaged by a rule, i.e. LLM calls saved."""
+        if not self.evaluated:
+            return 0.0
+        return sum(self.hits.values()) / self.evaluated
+
+    def stats(self) -> dict:
+        return {
+            "evaluated": self.evaluated,
+            "hit_rate": self.hit_rate(),
+            "hits": dict(self.hits),
+        }
+
+
+@lru_cache(maxsize=32)
+def _compile(assistant_id: str, specs_json: str) -> TriageRules:
+    return TriageRules(json.loads(specs_json))
+
+
+def get_triage_rules(prompt_config: dict, assistant_id: str = "default") -> TriageRules:
+    """Compiled rules for an assistant, reused while its `triage_rules` are unchanged."""
+    specs = prompt_config.get("triage_rules") or []
+    return _compile(assistant_id, json.dumps(specs, sort_keys=True))
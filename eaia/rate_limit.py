@@ -0,0 +1,178 @@
+"""
+rate_limit.py
+
+Rate limiting for Google API calls and run dispatch.
+
+`QuotaLimiter` is a token bucket counted in Google quota units rather than
+requests: each method costs what Google charges for it (`messages.send` is 20
+times a `messages.get`). One limiter per API is shared by the sync and async
+clients of the whole process, and can be awaited from asyncio or waited on
+from threads. When Google still throttles us (429, or 403 `rateLimitExceeded`)
+the bucket halves its rate and recovers gradually. Callers retry throttled
+and 5xx responses with jittered exponential backoff (`retry_delay`).
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+# Gmail quota units per method; Gmail allows 250 units per user per second.
+GMAIL_QUOTA_UNITS = {
+    "getProfile": 1,
+    "messages.get": 5,
+    "messages.list": 5,
+    "messages.send": 100,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+    "threads.get": 10,
+    "threads.list": 10,
+    "history.list": 2,
+    "labels.list": 1,
+    "labels.create": 5,
+}
+GMAIL_UNITS_PER_SECOND = 250.0
+# Calendar charges one unit per request; its per-user default is 600 per minute.
+CALENDAR_UNITS_PER_SECOND = 10.0
+
+MAX_ATTEMPTS = 5
+_BACKOFF_BASE = 1.0
+_BACKOFF_CAP = 32.0
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+# A 5xx does not mean these were not applied, so only quota rejections are retried.
+_NON_IDEMPOTENT = {
+    "gmail.users.messages.send",
+    "gmail.users.labels.create",
+    "calendar.events.insert",
+}
+# Throttled rates recover by this fraction of the full rate per second.
+_RECOVERY = 0.05
+_UTILIZATION_WINDOW = 10.0
+
+
+class RateLimiter:
+    """Spaces out `acquire()` calls to at most `rate` per second."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class QuotaLimiter:
+    """Token bucket of quota units, shared across threads and event loops.
+
+    Acquiring reserves units immediately (the bucket may go into debt) and
+    returns after the caller's share of time has passed, so waiters are served
+    in order.
+    """
+
+    def __init__(self, units_per_second: float, burst: float | None = None):
+        self.max_rate = units_per_second
+        self.rate = units_per_second
+        self.capacity = burst if burst is not None else units_per_second
+        self.throttled = 0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._spent: deque[tuple[float, float]] = deque()
+        self._lock = threading.Lock()
+
+    def _reserve(self, units: float) -> float:
+        """Take `units` and return how long the caller must wait."""
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._updated
+            self._updated = now
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + elapsed * _RECOVERY * self.max_rate)
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._tokens -= units
+            self._spent.append((now, units))
+            self._prune(now)
+            return max(0.0, -self._tokens / self.rate)
+
+    async def acquire(self, units: float = 1) -> None:
+        wait = self._reserve(units)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self, units: float = 1) -> None:
+        wait = self._reserve(units)
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttle(self) -> None:
+        """Google rejected a request for quota: halve the rate."""
+        with self._lock:
+            self.throttled += 1
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+
+    def _prune(self, now: float) -> None:
+        # Spending older than the longest window is never read again.
+        cutoff = now - _UTILIZATION_WINDOW
+        while self._spent and self._spent[0][0] < cutoff:
+            self._spent.popleft()
+
+    def utilization(self, window: float = _UTILIZATION_WINDOW) -> float:
+        """Units spent over the last `window` seconds (at most
+        `_UTILIZATION_WINDOW`), as a share of the full rate.
+
+        Close to 1.0 means more concurrency will only queue up behind the
+        limiter.
+        """
+        window = min(window, _UTILIZATION_WINDOW)
+        with self._lock:
+            now = time.monotonic()
+            self._prune(now)
+            cutoff = now - window
+            spent = sum(units for at, units in self._spent if at >= cutoff)
+        return spent / (self.max_rate * window)
+
+
+gmail_quota = QuotaLimiter(GMAIL_UNITS_PER_SECOND)
+calendar_quota = QuotaLimiter(CALENDAR_UNITS_PER_SECOND)
+
+
+def quota_for(method_id: str | None) -> tuple[QuotaLimiter, int]:
+    """Limiter and cost for a discovery method id such as `gmail.users.messages.get`."""
+    if method_id and method_id.startswith("calendar."):
+        return calendar_quota, 1
+    method = (method_id or "").removeprefix("gmail.").removeprefix("users.")
+    return gmail_quota, GMAIL_QUOTA_UNITS.get(method, 5)
+
+
+def is_rate_limited(status: int, content: bytes | str | None) -> bool:
+    if status == 429:
+        return True
+    if status != 403 or not content:
+        return False
+    if isinstance(content, bytes):
+        content = content.decode("utf-8", "replace")
+    # `rateLimitExceeded` and `userRateLimitExceeded`.
+    return "ratelimitexceeded" in content.lower()
+
+
+def is_retryable(
+    status: int, content: bytes | str | None = None, method_id: str | None = None
+) -> bool:
+    if is_rate_limited(status, content):
+        return True
+    return status in _RETRY_STATUSES and method_id not in _NON_IDEMPOTENT
+
+
+def retry_delay(attempt: int, retry_after: str | None = None) -> float:
+    """Seconds to wait before retry number `attempt` (0-based), with full jitter."""
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return random.uniform(0, min(_BACKOFF_CAP, _BACKOFF_BASE * 2**attempt))
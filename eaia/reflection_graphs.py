@@ -2,13 +2,14 @@ import os
 from dotenv import load_dotenv
 load_dotenv()
 
-from langchain_anthropic import ChatAnthropic
-from langchain_openai import ChatOpenAI
 from langgraph.graph import StateGraph, START, END, MessagesState
 from langgraph.store.base import BaseStore
 from langgraph.types import Command, Send
 from typing import Optional, TypedDict
 
+from eaia.llm_registry import get_chat_model
+from eaia.main.preferences import put_preference
+
 TONE_INSTRUCTIONS = "Only update the prompt to include instructions on the **style and tone and format** of the response. Do NOT update the prompt to include anything about the actual content - only the style and tone and format. The user sometimes responds differently to different types of people - take that into account, but don't be too specific."
 RESPONSE_INSTRUCTIONS = "Only update the prompt to include instructions on the **content** of the response. Do NOT update the prompt to include anything about the tone or style or format of the response."
 SCHEDULE_INSTRUCTIONS = "Only update the prompt to include instructions on how to send calendar invites - eg when to send them, what title should be, length, time of day, etc"
@@ -67,12 +68,9 @@ You should return the full prompt, so if there's anything from before that you w
 
 async def update_general(state: ReflectionState, config, store: BaseStore):
     print(f"^^ openai api key: {os.getenv('OPENAI_API_KEY')}")
-    reflection_model = ChatOpenAI(
-        model="o1", 
-        disable_streaming=True,
-        openai_api_key=os.getenv("OPENAI_API_KEY"),
-    )
-    # reflection_model = ChatAnthropic(model="claude-3-5-sonnet-latest")
+    # The API key comes from OPENAI_API_KEY, as before, and stays out of the registry key
+    reflection_model = get_chat_model("openai", "o1", disable_streaming=True)
+    # reflection_model = get_chat_model("anthropic", "claude-3-5-sonnet-latest")
     namespace = (state["assistant_key"],)
     key = state["prompt_key"]
     result = await store.aget(namespace, key)
@@ -97,9 +95,8 @@ async def update_general(state: ReflectionState, config, store: BaseStore):
         state["instructions"],
     )
     if output["update_prompt"]:
-        await store.aput(
-            namespace, key, {"data": output["new_prompt"]}, index=False
-        )
+        # Also drops this process's cached preferences for the assistant.
+        await put_preference(store, namespace[0], key, output["new_prompt"])
 
 
 
@@ -157,8 +154,8 @@ class MultiMemoryInput(MessagesState):
 
 
 async def determine_what_to_update(state: MultiMemoryInput):
-    reflection_model = ChatOpenAI(model="gpt-4o", disable_streaming=True)
-    reflection_model = ChatAnthropic(model="claude-3-5-sonnet-latest")
+    # reflection_model = get_chat_model("openai", "gpt-4o", disable_streaming=True)
+    reflection_model = get_chat_model("anthropic", "claude-3-5-sonnet-latest")
     trajectory = get_trajectory_clean(state["messages"])
     types_of_prompts = "\n".join(
         [f"`{p_type}`: {MEMORY_TO_UPDATE[p_type]}" for p_type in state["prompt_types"]]
@@ -1,8 +1,14 @@
-from typing import Annotated, List, Literal
+from typing import Annotated, Dict, List, Literal
 from langgraph.graph.message import AnyMessage
 from langgraph.graph import add_messages
 from pydantic import BaseModel, Field
-from typing_extensions import TypedDict
+from typing_extensions import NotRequired, TypedDict
+
+
+class CoalescedMessage(TypedDict):
+    id: str
+    from_email: str
+    snippet: str
 
 
 class EmailData(TypedDict):
@@ -13,6 +19,26 @@ class EmailData(TypedDict):
     page_content: str
     send_time: str
     to_email: str
+    # Other new messages in the thread, handled together with this one
+    coalesced_ids: NotRequired[List[str]]
+    # Their senders and snippets, oldest first, shown to triage and drafting
+    coalesced_messages: NotRequired[List[CoalescedMessage]]
+    # Mailing-list and automation headers (List-Unsubscribe, Auto-Submitted, ...)
+    headers: NotRequired[Dict[str, str]]
+
+
+def email_thread(email: EmailData) -> str:
+    """Body given to the triage and drafting prompts: the email's content,
+    followed by the other new messages coalesced into it, if any."""
+    coalesced = email.get("coalesced_messages")
+    if not coalesced:
+        return email["page_content"]
+    lines = [f"From: {m['from_email']}\n{m['snippet']}" for m in coalesced]
+    return (
+        email["page_content"]
+        + "\n\nOther new messages in this thread, handled with this one:\n\n"
+        + "\n\n".join(lines)
+    )
 
 
 class RespondTo(BaseModel):
@@ -20,6 +46,16 @@ class RespondTo(BaseModel):
     response: Literal["no", "email", "notify", "question"] = Field(default="no")
 
 
+class EmailTriage(RespondTo):
+    """Triage decision for one email of a batch."""
+    email_id: str = Field(description="ID of the email this decision is for")
+
+
+class BatchTriage(BaseModel):
+    """Triage decisions for a batch of emails, exactly one per email."""
+    results: List[EmailTriage]
+
+
 class ResponseEmailDraft(BaseModel):
     """Draft of an email to send as a response."""
     content: str
@@ -73,6 +109,8 @@ class State(TypedDict):
     email: EmailData
     triage: Annotated[RespondTo, convert_obj]
     messages: Annotated[List[AnyMessage], add_messages]
+    # Result of a batched triage call made at ingest: `{email_id, logic, response}`
+    precomputed_triage: Dict[str, str]
 
 
 email_template = """From: {author}
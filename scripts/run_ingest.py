@@ -7,14 +7,39 @@ load_dotenv()
 
 import argparse
 import asyncio
+from datetime import date
 from typing import Optional
 from bs4 import BeautifulSoup
-from eaia.gmail import fetch_group_emails
+from eaia.async_gmail import afetch_dead_letter_emails, afetch_group_emails
+from eaia.backfill import (
+    DEFAULT_CHUNK_DAYS,
+    DEFAULT_PAGE_SIZE,
+    backfill,
+)
+from eaia.dead_letter import get_dead_letters
+from eaia.gmail_fetch import SYNC_NAMESPACE
+from eaia.ingest import DEFAULT_CONCURRENCY, dispatch_emails, get_ledger
 from eaia.main.config import get_config
 from langgraph_sdk import get_client
 import httpx
-import uuid
-import hashlib
+
+
+async def _print_emails(emails):
+    async for email in emails:
+        print("--- Processing Email --- ")
+        print(f"From: {email.get('from_email', 'N/A')}")
+        print(f"To: {email.get('to_email', 'N/A')}")
+        print(f"Subject: {email.get('subject', 'N/A')}")
+        print(f"Sent: {email.get('send_time', 'N/A')}")
+        page_content = email.get('page_content', '')
+        if page_content:
+            soup = BeautifulSoup(page_content, 'lxml')
+            text_content = soup.get_text(separator=' ', strip=True)
+        else:
+            text_content = ""
+        print(f"Content:\n{text_content[:1000]}...") # Print first 1000 chars of parsed text content
+        print("-------------------------")
+        yield email
 
 
 async def main(
@@ -25,6 +50,15 @@ async def main(
     early: bool = True,
     rerun: bool = False,
     email: Optional[str] = None,
+    incremental: bool = False,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    backfill_start: Optional[str] = None,
+    backfill_end: Optional[str] = None,
+    checkpoint: Optional[str] = None,
+    chunk_days: int = DEFAULT_CHUNK_DAYS,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    gmail_rate: float = 0,
+    dispatch_rate: float = 0,
 ):
     if email is None:
         config = {"configurable": {}}
@@ -38,58 +72,74 @@ async def main(
             url=url
         )
 
-    # TODO: This really should be async
-    for email in fetch_group_emails(
-        email_address,
-        minutes_since=minutes_since,
-        gmail_token=gmail_token,
-        gmail_secret=gmail_secret,
-    ):
-        print("--- Processing Email --- ")
-        print(f"From: {email.get('from_email', 'N/A')}")
-        print(f"To: {email.get('to_email', 'N/A')}")
-        print(f"Subject: {email.get('subject', 'N/A')}")
-        print(f"Sent: {email.get('send_time', 'N/A')}")
-        page_content = email.get('page_content', '')
-        if page_content:
-            soup = BeautifulSoup(page_content, 'lxml')
-            text_content = soup.get_text(separator=' ', strip=True)
-        else:
-            text_content = ""
-        print(f"Content:\n{text_content[:1000]}...") # Print first 1000 chars of parsed text content
-        print("-------------------------")
-
-        thread_id = str(
-            uuid.UUID(hex=hashlib.md5(email["thread_id"].encode("UTF-8")).hexdigest())
+    if backfill_start is not None:
+        start = date.fromisoformat(backfill_start)
+        end = date.fromisoformat(backfill_end) if backfill_end else date.today()
+        await backfill(
+            client,
+            email_address,
+            start,
+            end,
+            checkpoint or f"backfill-{email_address}-{start}-{end}.json",
+            chunk_days=chunk_days,
+            page_size=page_size,
+            concurrency=concurrency,
+            gmail_rate=gmail_rate or None,
+            dispatch_rate=dispatch_rate or None,
+            gmail_token=gmail_token,
+            gmail_secret=gmail_secret,
+            ledger=get_ledger(),
+            dead_letters=get_dead_letters(),
         )
+        return
+
+    sync_state = None
+    if incremental:
         try:
-            thread_info = await client.threads.get(thread_id)
+            item = await client.store.get_item(list(SYNC_NAMESPACE), key=email_address)
+            sync_state = dict(item["value"])
         except httpx.HTTPStatusError as e:
-            if "user_respond" in email:
-                continue
-            if e.response.status_code == 404:
-                thread_info = await client.threads.create(thread_id=thread_id)
-            else:
+            if e.response.status_code != 404:
                 raise e
-        if "user_respond" in email:
-            await client.threads.update_state(thread_id, None, as_node="__end__")
-            continue
-        recent_email = thread_info["metadata"].get("email_id")
-        if recent_email == email["id"]:
-            if early:
-                break
-            else:
-                if rerun:
-                    pass
-                else:
-                    continue
-        await client.threads.update(thread_id, metadata={"email_id": email["id"]})
+            sync_state = {}
+
+    # Retries first, in their own pass: they are older than the listed mail,
+    # which stops at the first email already dispatched.
+    await dispatch_emails(
+        client,
+        _print_emails(
+            afetch_dead_letter_emails(
+                email_address,
+                get_dead_letters(),
+                gmail_token=gmail_token,
+                gmail_secret=gmail_secret,
+            )
+        ),
+        concurrency=concurrency,
+        early=False,
+        ledger=get_ledger(),
+    )
+    await dispatch_emails(
+        client,
+        _print_emails(
+            afetch_group_emails(
+                email_address,
+                minutes_since=minutes_since,
+                gmail_token=gmail_token,
+                gmail_secret=gmail_secret,
+                sync_state=sync_state,
+                dead_letters=get_dead_letters(),
+            )
+        ),
+        concurrency=concurrency,
+        early=early,
+        rerun=rerun,
+        ledger=get_ledger(),
+    )
 
-        await client.runs.create(
-            thread_id,
-            "main",
-            input={"email": email},
-            multitask_strategy="rollback",
+    if sync_state is not None:
+        await client.store.put_item(
+            list(SYNC_NAMESPACE), key=email_address, value=sync_state, index=False
         )
 
 
@@ -137,6 +187,60 @@ if __name__ == "__main__":
         default=None,
         help="The email address to use",
     )
+    parser.add_argument(
+        "--incremental",
+        type=int,
+        default=0,
+        help="whether to only fetch emails added since the last incremental run",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Number of emails to dispatch concurrently",
+    )
+    parser.add_argument(
+        "--backfill-start",
+        type=str,
+        default=None,
+        help="Backfill emails from this date (YYYY-MM-DD) instead of a recent window",
+    )
+    parser.add_argument(
+        "--backfill-end",
+        type=str,
+        default=None,
+        help="End of the backfill range, exclusive (YYYY-MM-DD, default today)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        default=None,
+        help="Backfill checkpoint file; an existing one is resumed",
+    )
+    parser.add_argument(
+        "--chunk-days",
+        type=int,
+        default=DEFAULT_CHUNK_DAYS,
+        help="Days of history listed per backfill chunk",
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=DEFAULT_PAGE_SIZE,
+        help="Messages per Gmail listing page (checkpointed after each page)",
+    )
+    parser.add_argument(
+        "--gmail-rate",
+        type=float,
+        default=0,
+        help="Maximum Gmail API calls per second during backfill, on top of the quota limiter (0 for no limit)",
+    )
+    parser.add_argument(
+        "--dispatch-rate",
+        type=float,
+        default=0,
+        help="Maximum emails dispatched per second during backfill (0 for no limit)",
+    )
 
     args = parser.parse_args()
     asyncio.run(
@@ -148,5 +252,14 @@ if __name__ == "__main__":
             early=bool(args.early),
             rerun=bool(args.rerun),
             email=args.email,
+            incremental=bool(args.incremental),
+            concurrency=args.concurrency,
+            backfill_start=args.backfill_start,
+            backfill_end=args.backfill_end,
+            checkpoint=args.checkpoint,
+            chunk_days=args.chunk_days,
+            page_size=args.page_size,
+            gmail_rate=args.gmail_rate,
+            dispatch_rate=args.dispatch_rate,
         )
     )
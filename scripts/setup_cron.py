@@ -12,6 +12,9 @@ from langgraph_sdk import get_client
 async def main(
     url: Optional[str] = None,
     minutes_since: int = 60,
+    incremental: bool = True,
+    triage_batch_size: int = 0,
+    assistant_id: str = "main",
 ):
     if url is None:
         client = get_client(url="http://127.0.0.1:2024")
@@ -19,7 +22,7 @@ async def main(
         client = get_client(
             url=url
         )
-    await client.crons.create("cron", schedule="*/10 * * * *", input={"minutes_since": minutes_since})
+    await client.crons.create("cron", schedule="*/10 * * * *", input={"minutes_since": minutes_since, "incremental": incremental, "triage_batch_size": triage_batch_size, "assistant_id": assistant_id})
 
 
 
@@ -37,11 +40,34 @@ if __name__ == "__main__":
         default=60,
         help="Only process emails that are less than this many minutes old.",
     )
+    parser.add_argument(
+        "--incremental",
+        type=int,
+        default=1,
+        help="whether to sync from the last seen Gmail history id instead of rescanning the window",
+    )
+
+    parser.add_argument(
+        "--triage-batch-size",
+        type=int,
+        default=0,
+        help="triage up to this many new emails in one LLM call before dispatching them (0 to triage each email in its own run)",
+    )
+
+    parser.add_argument(
+        "--assistant-id",
+        type=str,
+        default="main",
+        help="assistant to start email runs on, and whose config batch triage uses (defaults to the main graph's default assistant)",
+    )
 
     args = parser.parse_args()
     asyncio.run(
         main(
             url=args.url,
             minutes_since=args.minutes_since,
+            incremental=bool(args.incremental),
+            triage_batch_size=args.triage_batch_size,
+            assistant_id=args.assistant_id,
         )
     )
\ No newline at end of file